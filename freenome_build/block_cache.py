@@ -0,0 +1,158 @@
+import io
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__file__)  # noqa: invalid-name
+
+DEFAULT_BLOCK_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'freenome-build', 'blocks')
+DEFAULT_BLOCK_CACHE_SIZE = 10*1024*1024*1024
+DEFAULT_BLOCK_SIZE = 4*1024*1024
+
+
+def default_block_cache_dir():
+    """The block cache directory. This can be set with $FREENOME_BUILD_BLOCK_CACHE_DIR."""
+    return os.environ.get('FREENOME_BUILD_BLOCK_CACHE_DIR', DEFAULT_BLOCK_CACHE_DIR)
+
+
+class BlockCache():
+    """An on-disk cache of fixed size blocks of remote objects, with LRU eviction.
+
+    Blocks are stored at '{cache_dir}/{object key}/{block index}'. The object key must change
+    when the object's contents do (eg it's the object's md5sum), so cached blocks never go
+    stale. When the cache grows past 'max_bytes', the least recently used blocks are removed.
+
+    Several processes can share a cache directory: blocks are written atomically, and a block
+    that another process evicted is just fetched again. Each process only tracks the blocks
+    that it has seen for eviction, though, so the directory can grow past 'max_bytes' by the
+    number of processes times 'max_bytes' in the worst case.
+    """
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_BLOCK_CACHE_SIZE):
+        self.cache_dir = cache_dir if cache_dir is not None else default_block_cache_dir()
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # block path -> size, in least to most recently used order
+        self._blocks = None
+        self._num_bytes = 0
+
+    def _load_index(self):
+        # called with the lock held: index the blocks that are already on disk, oldest first
+        blocks = []
+        for dirpath, _, fnames in os.walk(self.cache_dir):
+            for fname in fnames:
+                if fname.startswith('.'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(dirpath, fname))
+                except FileNotFoundError:
+                    continue
+                blocks.append((stat.st_mtime, os.path.join(dirpath, fname), stat.st_size))
+        self._blocks = OrderedDict((path, size) for _, path, size in sorted(blocks))
+        self._num_bytes = sum(self._blocks.values())
+
+    def _block_path(self, key, block_index):
+        return os.path.join(self.cache_dir, key, str(block_index))
+
+    def _touch(self, path, size):
+        # called with the lock held: mark 'path' as the most recently used block
+        if self._blocks is None:
+            self._load_index()
+        if path in self._blocks:
+            self._num_bytes -= self._blocks.pop(path)
+        self._blocks[path] = size
+        self._num_bytes += size
+
+    def _evict(self):
+        # called with the lock held
+        while self._num_bytes > self.max_bytes and len(self._blocks) > 1:
+            path, size = self._blocks.popitem(last=False)
+            self._num_bytes -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            logger.debug(f"Evicted '{path}' from the block cache")
+
+    def get(self, key, block_index, fetch):
+        """Return block 'block_index' of the object 'key', calling 'fetch()' to get it if it isn't cached."""
+        path = self._block_path(key, block_index)
+        try:
+            with open(path, 'rb') as ifp:
+                data = ifp.read()
+            # the mtime orders the blocks when a new process loads the index
+            os.utime(path)
+        except FileNotFoundError:
+            data = fetch()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.block.')
+            with os.fdopen(fd, 'wb') as ofp:
+                ofp.write(data)
+            os.replace(tmp_path, path)
+        with self._lock:
+            self._touch(path, len(data))
+            self._evict()
+        return data
+
+
+class RangeReader(io.RawIOBase):
+    """A read only, seekable file object for a remote object, that is read in cached blocks.
+
+    'fetch_range(start, end)' must return bytes [start, end) of the object, which is 'size'
+    bytes long. Only the blocks that are read are fetched, and they are kept in 'block_cache'
+    (under 'key') so that reading them again doesn't go to the remote.
+    """
+    def __init__(self, fetch_range, size, key, block_cache, block_size=DEFAULT_BLOCK_SIZE):
+        super().__init__()
+        self._fetch_range = fetch_range
+        self._size = size
+        self._key = key
+        self._block_cache = block_cache
+        self._block_size = block_size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._size + offset
+        else:
+            raise ValueError(f"Invalid whence '{whence}'")
+        if pos < 0:
+            raise ValueError(f"Negative seek position {pos}")
+        self._pos = pos
+        return self._pos
+
+    def _block(self, block_index):
+        start = block_index*self._block_size
+        end = min(start + self._block_size, self._size)
+
+        def fetch():
+            data = self._fetch_range(start, end)
+            if len(data) != end - start:
+                raise IOError(f"Expected {end - start} bytes of '{self._key}' at {start} but got {len(data)}")
+            return data
+        return self._block_cache.get(self._key, block_index, fetch)
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        num_read = 0
+        while num_read < len(view) and self._pos < self._size:
+            block_index, block_offset = divmod(self._pos, self._block_size)
+            block = self._block(block_index)[block_offset:block_offset + len(view) - num_read]
+            view[num_read:num_read + len(block)] = block
+            num_read += len(block)
+            self._pos += len(block)
+        return num_read
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import conda_build.api
+
+logger = logging.getLogger(__file__)  # noqa: invalid-name
+
+# bump this to invalidate every existing cache entry (eg if the key's inputs change)
+CACHE_FORMAT_VERSION = 1
+
+DEFAULT_BUILD_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'freenome-build', 'builds')
+
+# the name of the metadata file in each cache entry
+ENTRY_FILENAME = 'entry.json'
+
+_HASH_BLOCK_SIZE = 1024*1024
+
+
+def default_build_cache_dir():
+    """The build cache directory. This can be set with $FREENOME_BUILD_CACHE_DIR (eg to a CI cache dir)."""
+    return os.environ.get('FREENOME_BUILD_CACHE_DIR', DEFAULT_BUILD_CACHE_DIR)
+
+
+def _source_files(path):
+    """Return the sorted paths (relative to 'path') of the source files in the repo at 'path'.
+
+    These are the files that git tracks. If 'path' isn't in a git repo (or git isn't
+    installed), we fall back to every file under 'path'.
+    """
+    try:
+        output = subprocess.check_output(['git', 'ls-files', '-z'], cwd=path, stderr=subprocess.DEVNULL)
+        return sorted(fname for fname in output.decode().split('\0') if fname)
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        logger.debug(f"Can't list the files that git tracks in '{path}', hashing every file in it")
+    fnames = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = [dirname for dirname in dirnames if dirname != '.git']
+        fnames.extend(os.path.relpath(os.path.join(dirpath, filename), path) for filename in filenames)
+    return sorted(fnames)
+
+
+def _hash_file(hasher, fpath):
+    with open(fpath, 'rb') as ifp:
+        while True:
+            block = ifp.read(_HASH_BLOCK_SIZE)
+            if not block:
+                return
+            hasher.update(block)
+
+
+def source_hash(path, version):
+    """Return a hex digest of everything that goes into building the package at 'path'.
+
+    This covers the contents of the repo's source files (as they are in the working tree,
+    so uncommitted changes count), conda-build/meta.yaml (even if it isn't tracked),
+    'version', and the platform and python version that the package is built with.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps(
+        [CACHE_FORMAT_VERSION, version, sys.platform, list(sys.version_info[:2])]).encode())
+    fnames = _source_files(path)
+    if 'conda-build/meta.yaml' not in fnames:
+        fnames.append('conda-build/meta.yaml')
+    for fname in fnames:
+        fpath = os.path.join(path, fname)
+        # skip tracked files that were deleted from the working tree, and symlinks to directories
+        if not os.path.isfile(fpath):
+            continue
+        # the name is null terminated so that it can't run into the contents
+        hasher.update(fname.encode() + b'\0')
+        file_hasher = hashlib.sha256()
+        _hash_file(file_hasher, fpath)
+        hasher.update(file_hasher.digest())
+    return hasher.hexdigest()
+
+
+class BuildCache():
+    """A directory of built packages keyed by source_hash.
+
+    Each entry is a local conda channel (so it can be passed to 'conda install -c') that
+    holds the packages built from a recipe, plus a metadata file that records which
+    channels the packages have been uploaded to:
+
+    {cache_dir}/{key}/{subdir}/{package}.tar.bz2
+    {cache_dir}/{key}/entry.json
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir if cache_dir is not None else default_build_cache_dir()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _read_entry(self, key):
+        try:
+            with open(os.path.join(self._entry_dir(key), ENTRY_FILENAME)) as ifp:
+                return json.load(ifp)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_entry(self, key, entry):
+        entry_path = os.path.join(self._entry_dir(key), ENTRY_FILENAME)
+        with open(entry_path + '.tmp', 'w') as ofp:
+            json.dump(entry, ofp)
+        os.replace(entry_path + '.tmp', entry_path)
+
+    def lookup(self, key):
+        """Return the paths of the cached packages for 'key', or None if they aren't cached."""
+        entry = self._read_entry(key)
+        if entry is None:
+            return None
+        package_paths = [os.path.join(self._entry_dir(key), package) for package in entry['packages']]
+        if not all(os.path.exists(package_path) for package_path in package_paths):
+            return None
+        return package_paths
+
+    def store(self, key, package_paths):
+        """Copy the packages in 'package_paths' into the cache, and return the paths of the copies."""
+        cached_paths = self.lookup(key)
+        if cached_paths is not None:
+            return cached_paths
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # the packages' paths relative to the channel dir, eg 'linux-64/pkg-1.0-0.tar.bz2'
+        relative_paths = [
+            os.path.join(os.path.basename(os.path.dirname(package_path)), os.path.basename(package_path))
+            for package_path in package_paths
+        ]
+        # build the entry in a temp dir and then move it into place, so that concurrent
+        # builds (and interrupted ones) never leave a partial entry behind
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=f".{key}.")
+        try:
+            for package_path, relative_path in zip(package_paths, relative_paths):
+                os.makedirs(os.path.dirname(os.path.join(tmp_dir, relative_path)), exist_ok=True)
+                shutil.copy2(package_path, os.path.join(tmp_dir, relative_path))
+            conda_build.api.update_index([tmp_dir])
+            with open(os.path.join(tmp_dir, ENTRY_FILENAME), 'w') as ofp:
+                json.dump({'packages': relative_paths, 'uploaded_to': []}, ofp)
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            os.rename(tmp_dir, self._entry_dir(key))
+        except OSError:
+            # another process stored the same key first
+            if self.lookup(key) is None:
+                raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        logger.info(f"Cached {', '.join(package_paths)} with key '{key}'")
+        return [os.path.join(self._entry_dir(key), relative_path) for relative_path in relative_paths]
+
+    def is_uploaded(self, key, channel):
+        entry = self._read_entry(key)
+        return entry is not None and channel in entry['uploaded_to']
+
+    def mark_uploaded(self, key, channel):
+        entry = self._read_entry(key)
+        if entry is None:
+            raise KeyError(f"'{key}' is not in the build cache")
+        if channel not in entry['uploaded_to']:
+            entry['uploaded_to'].append(channel)
+            self._write_entry(key, entry)
@@ -0,0 +1,242 @@
+import csv
+import gzip
+import logging
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from freenome_build.trace import span
+
+logger = logging.getLogger(__file__)  # noqa: invalid-name
+
+# file extension -> delimiter. None means that the delimiter is sniffed from the header.
+DATA_FILE_EXTENSIONS = {
+    '.csv': ',',
+    '.tsv': '\t',
+    '.txt': None,
+}
+
+# the delimiters that we try when sniffing a file's format
+SNIFF_DELIMITERS = ',\t|;'
+
+TableDataFile = namedtuple('TableDataFile', ['table', 'path', 'compressed', 'delimiter', 'columns'])
+
+
+class TableDependencyCycleError(RuntimeError):
+    pass
+
+
+def _open_data_file(path, compressed):
+    return gzip.open(path, 'rb') if compressed else open(path, 'rb')
+
+
+def _sniff_delimiter(header):
+    try:
+        return csv.Sniffer().sniff(header, delimiters=SNIFF_DELIMITERS).delimiter
+    except csv.Error:
+        raise ValueError(f"Could not determine the delimiter from the header line '{header.strip()}'")
+
+
+def inspect_data_file(path):
+    """Return a TableDataFile describing the data file at 'path'.
+
+    The file name (minus extensions) is the table name, eg 'public.sample.tsv.gz' is
+    loaded into 'public.sample'. The first line is a header containing the column names.
+    """
+    basename = os.path.basename(path)
+    compressed = basename.endswith('.gz')
+    if compressed:
+        basename = basename[:-3]
+    table, ext = os.path.splitext(basename)
+    if ext not in DATA_FILE_EXTENSIONS:
+        raise ValueError(f"Unrecognized test data file extension '{ext}' for '{path}'")
+
+    with _open_data_file(path, compressed) as ifp:
+        header = ifp.readline().decode()
+    delimiter = DATA_FILE_EXTENSIONS[ext] or _sniff_delimiter(header)
+    columns = next(csv.reader([header], delimiter=delimiter))
+    return TableDataFile(table, path, compressed, delimiter, columns)
+
+
+def find_data_files(data_dir):
+    """Return a TableDataFile for every recognized data file in 'data_dir'."""
+    data_files = []
+    for fname in sorted(os.listdir(data_dir)):
+        path = os.path.join(data_dir, fname)
+        stripped = fname[:-3] if fname.endswith('.gz') else fname
+        if os.path.isfile(path) and os.path.splitext(stripped)[1] in DATA_FILE_EXTENSIONS:
+            data_files.append(inspect_data_file(path))
+        else:
+            logger.debug(f"Skipping '{path}' because it isn't a recognized test data file")
+    return data_files
+
+
+def dependency_levels(tables, dependencies):
+    """Group 'tables' into levels so that every table only depends on tables in earlier levels.
+
+    'dependencies' maps a table to the set of tables that it references. Tables within
+    a level are independent of each other, and so can be loaded concurrently.
+    """
+    remaining = {table: set(dependencies.get(table, ())) & set(tables) - {table} for table in tables}
+    levels = []
+    while remaining:
+        level = sorted(table for table, deps in remaining.items() if not deps)
+        if not level:
+            raise TableDependencyCycleError(
+                f"Foreign keys between {sorted(remaining)} form a cycle, so they can't be loaded in order")
+        levels.append(level)
+        for table in level:
+            del remaining[table]
+        for deps in remaining.values():
+            deps.difference_update(level)
+    return levels
+
+
+def _quote_ident(name):
+    return '.'.join('"' + part.replace('"', '""') + '"' for part in name.split('.'))
+
+
+def _table_oids(conn, tables):
+    oids = {}
+    with conn.cursor() as cur:
+        for table in tables:
+            cur.execute("SELECT to_regclass(%s)::oid", (table, ))
+            oid, = cur.fetchone()
+            if oid is None:
+                raise ValueError(f"Test data table '{table}' does not exist")
+            oids[table] = oid
+    return oids
+
+
+def _foreign_key_dependencies(conn, oids):
+    tables_by_oid = {oid: table for table, oid in oids.items()}
+    dependencies = {table: set() for table in oids}
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT conrelid::oid, confrelid::oid FROM pg_constraint "
+            "WHERE contype = 'f' AND conrelid = ANY(%s)",
+            (list(oids.values()), )
+        )
+        for table_oid, referenced_oid in cur.fetchall():
+            if referenced_oid in tables_by_oid:
+                dependencies[tables_by_oid[table_oid]].add(tables_by_oid[referenced_oid])
+    return dependencies
+
+
+def _deferrable_indexes(conn, oids):
+    """Return (index name, index definition) for the indexes that don't back a constraint.
+
+    Primary key and unique indexes are left alone because foreign key checks need them.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid) FROM pg_index "
+            "WHERE indrelid = ANY(%s) "
+            "AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = indexrelid)",
+            (list(oids.values()), )
+        )
+        return cur.fetchall()
+
+
+def _execute_in_connection(connection, func, *args):
+    with connection() as conn:
+        result = func(conn, *args)
+        conn.commit()
+        return result
+
+
+def _copy_data_file(conn, data_file):
+    columns = ', '.join(_quote_ident(column) for column in data_file.columns)
+    delimiter = data_file.delimiter.replace("'", "''")
+    # other delimiters are postgres text format files (eg from psql's \copy), where '\N' is NULL
+    # and quotes aren't special
+    copy_format = 'csv' if data_file.delimiter == ',' else 'text'
+    copy_sql = (f"COPY {_quote_ident(data_file.table)} ({columns}) FROM STDIN "
+                f"WITH (FORMAT {copy_format}, DELIMITER E'{delimiter}')")
+    logger.info(f"Loading '{data_file.path}' into '{data_file.table}'")
+    with span('copy', table=data_file.table), \
+            _open_data_file(data_file.path, data_file.compressed) as ifp, conn.cursor() as cur:
+        # skip the header
+        ifp.readline()
+        cur.copy_expert(copy_sql, ifp)
+        return cur.rowcount
+
+
+def _execute_statements(conn, statements):
+    with conn.cursor() as cur:
+        for statement in statements:
+            logger.debug(f"Executing '{statement}'")
+            cur.execute(statement)
+
+
+def _run_concurrently(executor, connection, func, args_list):
+    futures = [executor.submit(_execute_in_connection, connection, func, *args) for args in args_list]
+    return [future.result() for future in futures]
+
+
+def load_data_dir(connection, data_dir, max_workers=4, defer_indexes=True):
+    """Load every data file in 'data_dir' into the table of the same name using COPY.
+
+    'connection' is a callable that returns a context manager yielding a psycopg2 connection
+    (eg DbConnectionData.connection). Tables are loaded in foreign key dependency order,
+    and tables that don't depend on each other are loaded concurrently (each in its own
+    connection and transaction). If 'defer_indexes' is True then indexes that don't back
+    a constraint are dropped before the load and rebuilt (concurrently) at the end. They're
+    rebuilt if the load fails too, but if the process is killed they stay dropped: their
+    definitions are logged before they're dropped so that they can be recreated by hand.
+
+    Returns a dict mapping table name to the number of rows loaded.
+    """
+    data_files = find_data_files(data_dir)
+    if not data_files:
+        raise ValueError(f"'{data_dir}' does not contain any test data files")
+    files_by_table = {}
+    for data_file in data_files:
+        if data_file.table in files_by_table:
+            raise ValueError(
+                f"'{files_by_table[data_file.table].path}' and '{data_file.path}' both load '{data_file.table}'")
+        files_by_table[data_file.table] = data_file
+
+    with connection() as conn:
+        oids = _table_oids(conn, files_by_table)
+        levels = dependency_levels(list(files_by_table), _foreign_key_dependencies(conn, oids))
+        indexes = _deferrable_indexes(conn, oids) if defer_indexes else []
+        if indexes:
+            logger.info(f"Deferring the build of {len(indexes)} indexes until the data is loaded")
+            for _, index_def in indexes:
+                logger.info(f"Dropping index '{index_def}'")
+            _execute_statements(conn, [f"DROP INDEX {index_name}" for index_name, _ in indexes])
+        conn.commit()
+
+    row_counts = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        load_failed = False
+        try:
+            for level in levels:
+                counts = _run_concurrently(
+                    executor, connection, _copy_data_file, [(files_by_table[table], ) for table in level])
+                row_counts.update(zip(level, counts))
+        except BaseException:
+            load_failed = True
+            raise
+        finally:
+            # rebuild the indexes even if the load failed so that we don't leave the schema modified
+            try:
+                with span('rebuild-indexes'):
+                    _run_concurrently(
+                        executor, connection, _execute_statements, [([index_def], ) for _, index_def in indexes])
+            except Exception:
+                if not load_failed:
+                    raise
+                # re-raise the load's error, which is the one that needs fixing
+                logger.exception("Failed to rebuild the indexes after the load failed, they can be recreated with: "
+                                 + '; '.join(index_def for _, index_def in indexes))
+        with span('analyze'):
+            _run_concurrently(
+                executor, connection, _execute_statements,
+                [([f"ANALYZE {_quote_ident(table)}"], ) for table in files_by_table]
+            )
+
+    for table, count in row_counts.items():
+        logger.info(f"Loaded {count} rows into '{table}'")
+    return row_counts
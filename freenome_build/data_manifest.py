@@ -1,12 +1,21 @@
 import os
 import codecs
+import errno
+import fnmatch
 import hashlib
+import io
+import mmap
+import re
 import subprocess
 import logging
+import threading
 from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import portalocker
 
+from freenome_build.block_cache import BlockCache, RangeReader, DEFAULT_BLOCK_SIZE
+from freenome_build.readiness import backoff_delays
 from freenome_build.util import get_gcs_blob, BlobNotFoundError
 
 logger = logging.getLogger(__name__)
@@ -14,7 +23,16 @@ logger = logging.getLogger(__name__)
 # TODOs
 # (1) decide on the interface (eg do we need separate local/remote prefixes)
 # (2) update so that only a single writer can be open at once
-# (3) add 'get_local_path' method
+
+
+# the directory (in a local prefix) for the locks that are held while files are downloaded
+LOCKS_DIRNAME = '.locks'
+
+# files at least this large are downloaded with several streams (see download_ranges)
+DEFAULT_MULTI_STREAM_THRESHOLD = 1024*1024*1024
+DEFAULT_NUM_STREAMS = 8
+DEFAULT_RANGE_SIZE = 64*1024*1024
+DEFAULT_MAX_RANGE_ATTEMPTS = 5
 
 
 class FileAlreadyExistsError(Exception):
@@ -37,7 +55,90 @@ def hex_to_base64(hex_str):
     return codecs.encode(codecs.decode(hex_str, 'hex'), 'base64').strip().decode('ascii')
 
 
-def calc_md5sum_from_fname(fname):
+# how files are read when they are hashed:
+#   default: normal buffered reads (the file ends up in the page cache)
+#   dontneed: sequential readahead, and each block is dropped from the page cache once it's read
+#   direct: O_DIRECT reads that bypass the page cache (falls back to dontneed where unsupported)
+CACHE_MODES = ('default', 'dontneed', 'direct')
+
+_READ_BLOCK_SIZE = 8*1024*1024
+
+
+def _fadvise(fd, offset, length, advice_name):
+    # posix_fadvise isn't available on every platform (eg macOS), and it's only a hint anyway
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, offset, length, getattr(os, advice_name))
+
+
+def _open_direct(fname):
+    """Return a file descriptor for O_DIRECT reads of 'fname', or None if it isn't supported."""
+    if not hasattr(os, 'O_DIRECT'):
+        return None
+    try:
+        return os.open(fname, os.O_RDONLY | os.O_DIRECT)
+    except OSError as inst:
+        # eg tmpfs doesn't support O_DIRECT
+        logger.debug(f"Can't open '{fname}' with O_DIRECT, falling back to buffered reads: {inst}")
+        return None
+
+
+def iter_file_blocks(fname, cache_mode='default', block_size=_READ_BLOCK_SIZE):
+    """Yield the contents of 'fname' in blocks, reading it according to 'cache_mode' (see CACHE_MODES).
+
+    'dontneed' and 'direct' keep hashing a large file from pushing everything else out of the
+    page cache. Note that 'dontneed' also drops pages that were cached before we read them.
+    """
+    if cache_mode not in CACHE_MODES:
+        raise ValueError(f"Unknown cache mode '{cache_mode}', expected one of {CACHE_MODES}")
+
+    fd = _open_direct(fname) if cache_mode == 'direct' else None
+    if fd is not None:
+        # there's no readahead hint: O_DIRECT reads skip the page cache, and so readahead
+        # too. 'block_size' reads keep the disk busy instead.
+        try:
+            # O_DIRECT needs page aligned buffers, which anonymous mmaps are
+            buffer = mmap.mmap(-1, block_size)
+            try:
+                offset = 0
+                while True:
+                    try:
+                        num_read = os.readv(fd, [buffer])
+                    except OSError as inst:
+                        # some filesystems accept O_DIRECT opens and then fail the reads
+                        if inst.errno != errno.EINVAL or offset > 0:
+                            raise
+                        logger.debug(f"Can't read '{fname}' with O_DIRECT, falling back to buffered reads: {inst}")
+                        break
+                    if num_read == 0:
+                        return
+                    yield buffer[:num_read]
+                    offset += num_read
+            finally:
+                buffer.close()
+        finally:
+            os.close(fd)
+
+    with open(fname, 'rb', buffering=0) as ifp:
+        if cache_mode != 'default':
+            _fadvise(ifp.fileno(), 0, 0, 'POSIX_FADV_SEQUENTIAL')
+            _fadvise(ifp.fileno(), 0, 0, 'POSIX_FADV_NOREUSE')
+        offset = 0
+        while True:
+            block = ifp.read(block_size)
+            if not block:
+                return
+            yield block
+            if cache_mode != 'default':
+                _fadvise(ifp.fileno(), offset, len(block), 'POSIX_FADV_DONTNEED')
+            offset += len(block)
+
+
+def calc_md5sum_from_fname(fname, cache_mode='default'):
+    if cache_mode != 'default':
+        hasher = hashlib.md5()
+        for block in iter_file_blocks(fname, cache_mode):
+            hasher.update(block)
+        return hex_to_base64(hasher.hexdigest())
     hex_str = subprocess.run(
         ["md5sum", fname],
         stdout=subprocess.PIPE
@@ -45,6 +146,61 @@ def calc_md5sum_from_fname(fname):
     return hex_to_base64(hex_str)
 
 
+class _HashingReader():
+    """A file-like object that md5s the bytes that are read from 'fp' as they are read.
+
+    Resumable uploads seek back to the last committed offset when they retry, so each byte
+    is only hashed the first time that it's read.
+    """
+    def __init__(self, fp):
+        self._fp = fp
+        self._hasher = hashlib.md5()
+        # the offset that everything before has been hashed
+        self._hashed = 0
+
+    def read(self, size=-1):
+        offset = self._fp.tell()
+        if offset > self._hashed:
+            # hash the bytes that a forward seek skipped over
+            self._fp.seek(self._hashed)
+            self._hasher.update(self._fp.read(offset - self._hashed))
+            self._hashed = offset
+        data = self._fp.read(size)
+        if offset + len(data) > self._hashed:
+            self._hasher.update(data[self._hashed - offset:])
+            self._hashed = offset + len(data)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._fp.seek(offset, whence)
+
+    def tell(self):
+        return self._fp.tell()
+
+    def md5sum(self):
+        return hex_to_base64(self._hasher.hexdigest())
+
+
+class _HashingWriter():
+    """A file-like object that md5s the bytes that are written to 'fp' as they are written."""
+    def __init__(self, fp):
+        self._fp = fp
+        self._hasher = hashlib.md5()
+
+    def write(self, data):
+        self._hasher.update(data)
+        return self._fp.write(data)
+
+    def tell(self):
+        return self._fp.tell()
+
+    def flush(self):
+        self._fp.flush()
+
+    def md5sum(self):
+        return hex_to_base64(self._hasher.hexdigest())
+
+
 def calc_md5sum_from_fp(fp):
     fpos = fp.tell()
     m = hashlib.md5()
@@ -54,12 +210,117 @@ def calc_md5sum_from_fp(fp):
     return hex_to_base64(m.hexdigest())
 
 
+class _InOrderHasher():
+    """md5 the ranges of a file as they are written, in file order, whatever order they finish in.
+
+    Finished ranges are hashed as soon as every range before them has finished, by reading
+    them back from the file (they are usually still in the page cache).
+    """
+    def __init__(self, fd):
+        self._fd = fd
+        self._hasher = hashlib.md5()
+        self._lock = threading.Lock()
+        self._offset = 0
+        # start -> end of the finished ranges that haven't been hashed yet
+        self._finished = {}
+
+    def finished(self, start, end):
+        with self._lock:
+            self._finished[start] = end
+            while self._offset in self._finished:
+                end = self._finished.pop(self._offset)
+                while self._offset < end:
+                    block = os.pread(self._fd, min(end - self._offset, 1024*1024), self._offset)
+                    self._hasher.update(block)
+                    self._offset += len(block)
+
+    def md5sum(self):
+        assert not self._finished, "A range was never finished"
+        return hex_to_base64(self._hasher.hexdigest())
+
+
+def _pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        num_written = os.pwrite(fd, view, offset)
+        view = view[num_written:]
+        offset += num_written
+
+
+def download_ranges(blob, local_abs_path, size, num_streams=DEFAULT_NUM_STREAMS,
+                    range_size=DEFAULT_RANGE_SIZE, max_attempts=DEFAULT_MAX_RANGE_ATTEMPTS):
+    """Download 'blob' to 'local_abs_path' in 'num_streams' parallel byte ranges, and return its md5sum.
+
+    The file is preallocated (sparsely) to 'size' bytes and each range is written in place,
+    so the ranges can finish in any order. A range that fails is retried on its own, up to
+    'max_attempts' times.
+    """
+    fd = os.open(local_abs_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+        hasher = _InOrderHasher(fd)
+
+        # set when a range has failed for good, so that the other ranges stop
+        aborted = threading.Event()
+
+        def download_range(start, end):
+            delays = backoff_delays(0.5, 30)
+            for attempt in range(1, max_attempts + 1):
+                if aborted.is_set():
+                    return
+                try:
+                    # 'end' is inclusive for blobs
+                    data = blob.download_as_bytes(start=start, end=end - 1)
+                    if len(data) != end - start:
+                        raise IOError(f"Expected {end - start} bytes but got {len(data)}")
+                    break
+                except Exception as inst:
+                    if attempt == max_attempts:
+                        raise
+                    delay = next(delays)
+                    logger.warning(f"Failed to download bytes {start}-{end} of '{local_abs_path}' (attempt "
+                                   f"{attempt} of {max_attempts}), retrying in {delay:.1f} seconds: {inst}")
+                    aborted.wait(delay)
+            _pwrite_all(fd, data, start)
+            hasher.finished(start, end)
+
+        with ThreadPoolExecutor(max_workers=num_streams) as executor:
+            futures = [executor.submit(download_range, start, min(start + range_size, size))
+                       for start in range(0, size, range_size)]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                # don't download the rest of the object once it can't be completed
+                aborted.set()
+                for future in futures:
+                    future.cancel()
+                raise
+        return hasher.md5sum()
+    finally:
+        os.close(fd)
+
+
 DataManifestRecord = namedtuple(
     'DataManifestRecord',
     ['name', 'relative_local_path', 'relative_remote_path', 'md5sum', 'size', 'notes']
 )
 
 
+def record_tags(record):
+    """Return the set of tags of 'record', from a 'tags=a,b' token in its notes."""
+    match = re.search(r'(?:^|\s)tags=(\S+)', record.notes)
+    if match is None:
+        return set()
+    return {tag for tag in match.group(1).split(',') if tag}
+
+
+def record_priority(record):
+    """Return the priority of 'record', from a 'priority=N' token in its notes (default 0)."""
+    match = re.search(r'(?:^|\s)priority=(-?\d+)', record.notes)
+    return int(match.group(1)) if match is not None else 0
+
+
 class _DataManifestBase(OrderedDict):
     """Track and manage data file dependencies
 
@@ -74,10 +335,37 @@ class _DataManifestBase(OrderedDict):
     def _get_gcs_blob(self, remote_relative_path):
         return get_gcs_blob(self.remote_prefix, remote_relative_path)
 
-    def _verify_record(self, record, local_abs_path, check_md5sums=True):
+    def select(self, names=None, patterns=None, tags=None):
+        """Return the records that match any of 'names', 'patterns' or 'tags'.
+
+        'patterns' are globs over the records' local paths (eg 'hg38/*.fa'), and 'tags' are
+        matched against the tags in the records' notes (see record_tags). If none of them are
+        given, every record is selected. Records are ordered by descending priority (see
+        record_priority) and then by size, so that important and small files come first.
+        """
+        if names is None and patterns is None and tags is None:
+            records = list(self.values())
+        else:
+            names = set(names or ())
+            missing_names = names - set(self)
+            if missing_names:
+                raise KeyError(f"{sorted(missing_names)} are not in '{self.fname}'")
+            patterns = list(patterns or ())
+            tags = set(tags or ())
+            records = [
+                record for record in self.values()
+                if record.name in names
+                or any(fnmatch.fnmatch(os.path.normpath(record.relative_local_path), pattern)
+                       for pattern in patterns)
+                or record_tags(record) & tags
+            ]
+        return sorted(records, key=lambda record: (-record_priority(record), int(record.size)))
+
+    def _verify_record(self, record, local_abs_path, check_md5sums=True, cache_mode='default'):
         """Verify that the file at 'local_abs_path' matches that in record.
 
-        If check_md5sums is True then verify that the md5sums match (this is slow).
+        If check_md5sums is True then verify that the md5sums match (this is slow). The file
+        is read according to 'cache_mode' (see CACHE_MODES).
         """
         # check that the file exists
         if not os.path.exists(local_abs_path):
@@ -93,7 +381,7 @@ class _DataManifestBase(OrderedDict):
         # ensure the md5sum matches
         if check_md5sums:
             logger.info(f"Calculating md5sum for '{local_abs_path}'.")
-            local_md5sum = calc_md5sum_from_fname(local_abs_path)
+            local_md5sum = calc_md5sum_from_fname(local_abs_path, cache_mode=cache_mode)
             logger.debug(f"Calculated md5sum '{local_md5sum}' for '{local_abs_path}'.")
             if local_md5sum != record.md5sum:
                 raise FileMismatchError(
@@ -132,40 +420,117 @@ class _DataManifestBase(OrderedDict):
 
 
 class DataManifestReader(_DataManifestBase):
-    def _sync_record(self, record, local_abs_path):
+    # these can be overridden per reader, eg reader.num_streams = 16
+    multi_stream_threshold = DEFAULT_MULTI_STREAM_THRESHOLD
+    num_streams = DEFAULT_NUM_STREAMS
+    range_size = DEFAULT_RANGE_SIZE
+
+    def _download_record(self, record, local_abs_path):
+        """Download 'record' to 'local_abs_path', verifying its md5sum as it is written."""
+        logger.info(f"Copying '{record.relative_remote_path}' to '{local_abs_path}'.")
+        blob = self._get_gcs_blob(record.relative_remote_path)
+        # download to a temporary file so that a failed download never leaves a partial file at
+        # 'local_abs_path', and md5 the contents as they stream in rather than re-reading them
+        tmp_path = local_abs_path + '.download'
+        try:
+            if int(record.size) >= self.multi_stream_threshold:
+                local_md5sum = download_ranges(
+                    blob, tmp_path, int(record.size), num_streams=self.num_streams, range_size=self.range_size)
+            else:
+                with open(tmp_path, 'wb') as ofp:
+                    writer = _HashingWriter(ofp)
+                    blob.download_to_file(writer)
+                local_md5sum = writer.md5sum()
+            local_fsize = os.path.getsize(tmp_path)
+            if local_fsize != int(record.size):
+                raise FileMismatchError(
+                    f"Downloaded '{record.relative_remote_path}' has size '{local_fsize}' "
+                    f"vs '{record.size}' in the manifest")
+            if local_md5sum != record.md5sum:
+                raise FileMismatchError(
+                    f"Downloaded '{record.relative_remote_path}' has md5sum '{local_md5sum}' "
+                    f"vs '{record.md5sum}' in the manifest")
+            os.replace(tmp_path, local_abs_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _fetch_record(self, record, local_prefix):
+        """Download 'record' to 'local_prefix' unless another process already has."""
+        local_abs_path = os.path.join(local_prefix, record.relative_local_path)
+        # hold a lock while downloading so that processes that need the same file wait for
+        # the first one to download it, rather than all downloading it at once. The locks are
+        # kept out of the data tree, so that they don't show up next to the files.
+        lock_path = os.path.join(local_prefix, LOCKS_DIRNAME, os.path.normpath(record.relative_local_path) + '.lock')
+        for dirname in (os.path.dirname(local_abs_path), os.path.dirname(lock_path)):
+            os.makedirs(dirname, exist_ok=True)
+        with portalocker.Lock(lock_path, 'a', flags=portalocker.LOCK_EX):
+            if not os.path.exists(local_abs_path):
+                self._download_record(record, local_abs_path)
+
+    def _sync_record(self, record, local_prefix):
+        local_abs_path = os.path.join(local_prefix, record.relative_local_path)
         # if local_path already exists, then make sure that it matches the remote file
         if os.path.exists(local_abs_path):
             self._verify_record(record, local_abs_path)
         # otherwise, copy it to the correct location
         else:
-            # copy the file to local_path
-            logger.info(f"Copying '{record.remote_path}' to '{local_abs_path}'.")
-            blob = self._get_gcs_blob(record.remote_path)
-            # make sure the directory exists
-            dirname = os.path.dirname(local_abs_path)
-            if not os.path.exists(dirname):
-                os.makedirs(dirname)
-            blob.download_to_filename(local_abs_path)
-            assert os.path.getsize(local_abs_path) == int(record.size), "{}, {}".format(
-                os.path.getsize(local_abs_path), record.size
-            )
-            # skip this assert because it is slow (and filesize should catch anything weird)
-            # assert calc_md5sum(local_path) == local_md5sum
-
-    def sync(self, local_prefix):
-        """Sync the remote files to a local path."""
-        for record in self.values():
-            local_abs_path = os.path.join(local_prefix, record.local_path)
-            self._sync_record(record, local_abs_path)
-
-    def verify(self, local_prefix, check_md5sums=False):
+            self._fetch_record(record, local_prefix)
+
+    def get_local_path(self, name):
+        """Return the local path of the file 'name', downloading it if it isn't there yet.
+
+        Only this file is downloaded (and its md5sum verified), so this is much cheaper than
+        syncing the whole manifest when only a few of its files are needed. Files that are
+        already present are only checked against the manifest's file size.
+        """
+        record = self[name]
+        local_abs_path = os.path.join(self.local_prefix, record.relative_local_path)
+        if not os.path.exists(local_abs_path):
+            self._fetch_record(record, self.local_prefix)
+        self._verify_record(record, local_abs_path, check_md5sums=False)
+        return local_abs_path
+
+    def open_remote(self, name, block_cache=None, block_size=DEFAULT_BLOCK_SIZE):
+        """Return a read only, seekable binary file object for the remote copy of the file 'name'.
+
+        Reads are served by ranged reads of the remote object, 'block_size' bytes at a time,
+        and the blocks are kept in 'block_cache' (by default, a BlockCache in its default
+        directory). This is much cheaper than syncing a large file when only part of it is
+        needed, eg one region of an indexed file.
+        """
+        record = self[name]
+        blob = self._get_gcs_blob(record.relative_remote_path)
+        if block_cache is None:
+            block_cache = BlockCache()
+        # key the blocks by the object's contents, so that the cache never serves stale blocks
+        key = codecs.encode(codecs.decode(record.md5sum.encode('ascii'), 'base64'), 'hex').decode('ascii')
+        raw = RangeReader(
+            lambda start, end: blob.download_as_bytes(start=start, end=end - 1),
+            int(record.size), key, block_cache, block_size=block_size
+        )
+        return io.BufferedReader(raw, buffer_size=block_size)
+
+    def sync(self, local_prefix, names=None, patterns=None, tags=None):
+        """Sync the remote files to a local path.
+
+        Only the files selected by 'names', 'patterns' and 'tags' are synced (see select).
+        """
+        for record in self.select(names, patterns, tags):
+            self._sync_record(record, local_prefix)
+
+    def verify(self, local_prefix, check_md5sums=False, names=None, patterns=None, tags=None,
+               cache_mode='default'):
         """Ensure that the files at 'local_prefix' match the manifest.
 
-        If 'slow' is True, then additionally ensure that the md5sum's match.
+        If 'check_md5sums' is True, then additionally ensure that the md5sum's match. Only the
+        files selected by 'names', 'patterns' and 'tags' are checked (see select). Use
+        cache_mode='dontneed' or 'direct' to keep the files out of the page cache (see CACHE_MODES).
         """
-        for record in self.values():
-            local_abs_path = os.path.join(local_prefix, record.local_path)
-            self._verify_record(record, local_abs_path, check_md5sums=check_md5sums)
+        for record in self.select(names, patterns, tags):
+            local_abs_path = os.path.join(local_prefix, record.relative_local_path)
+            self._verify_record(record, local_abs_path, check_md5sums=check_md5sums, cache_mode=cache_mode)
 
 
 class DataManifestWriter(_DataManifestBase):
@@ -215,14 +580,6 @@ class DataManifestWriter(_DataManifestBase):
         if name in self:
             raise KeyAlreadyExistsError("'{record.name}' is duplicated in '{self.fname}'")
 
-        # make sure that we can open the file that we want to add for reading
-        with open(fname) as _: # noqa
-            pass
-
-        # find the file's file size and calculate the checksum
-        logger.info(f"Calculating md5sum for '{fname}'")
-        local_md5sum = calc_md5sum_from_fname(fname)
-        logger.debug(f"Calculated md5sum '{local_md5sum}' for '{fname}'.")
         local_fsize = os.path.getsize(fname)
         logger.debug(f"Calculated filesize '{local_fsize}' for '{fname}'.")
 
@@ -230,26 +587,34 @@ class DataManifestWriter(_DataManifestBase):
         blob = self._get_gcs_blob(remote_relative_path)
         try:
             blob.reload()
-            # if it exists, make sure that it is the same as the local file
-            if local_md5sum != blob.md5_hash:
-                raise FileAlreadyExistsError(
-                    f"File '{self.remote_prefix}{remote_relative_path}' already exists with md5sum"
-                    f"'{blob.md5_hash}' vs '{local_md5sum}' for '{fname}')"
-                )
-            if local_fsize != blob.size:
-                raise FileAlreadyExistsError(
-                    f"File '{self.remote_prefix}{remote_relative_path}' already exists with file "
-                    f"size '{blob.size}' vs '{local_fsize}' for '{fname}')"
-                )
-        # if we can't find the file, upload it
+        # if we can't find the file, upload it and calculate the checksum as it is uploaded
         except BlobNotFoundError:
             logger.info(f"Uploading '{fname}' to '{self.remote_prefix}{remote_relative_path}'")
-            blob.upload_from_filename(fname)
+            with open(fname, 'rb') as ifp:
+                reader = _HashingReader(ifp)
+                blob.upload_from_file(reader, size=local_fsize)
+            local_md5sum = reader.md5sum()
+            logger.debug(f"Calculated md5sum '{local_md5sum}' for '{fname}'.")
             assert blob.size == local_fsize, \
                 "We just uploaded this file so the filesizes should match"
             assert blob.md5_hash == local_md5sum, \
                 f"We just uploaded this file so the md5sums should match " \
                 f"('{blob.md5_hash}' vs '{local_md5sum}')"
+        # if it exists, make sure that it is the same as the local file
+        else:
+            if local_fsize != blob.size:
+                raise FileAlreadyExistsError(
+                    f"File '{self.remote_prefix}{remote_relative_path}' already exists with file "
+                    f"size '{blob.size}' vs '{local_fsize}' for '{fname}')"
+                )
+            logger.info(f"Calculating md5sum for '{fname}'")
+            local_md5sum = calc_md5sum_from_fname(fname)
+            logger.debug(f"Calculated md5sum '{local_md5sum}' for '{fname}'.")
+            if local_md5sum != blob.md5_hash:
+                raise FileAlreadyExistsError(
+                    f"File '{self.remote_prefix}{remote_relative_path}' already exists with md5sum"
+                    f"'{blob.md5_hash}' vs '{local_md5sum}' for '{fname}')"
+                )
         assert blob.md5_hash is not None
         assert blob.size is not None
 
@@ -4,14 +4,23 @@ import random
 import socket
 import subprocess
 import string
-import time
-from typing import Tuple
+import sys
+import threading
+from typing import List, Tuple
 
 import json
 import psycopg2
+import yaml
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import closing
 from urllib.parse import urlparse
 
+from freenome_build.bulk_load import load_data_dir
+from freenome_build.k8s import PodWatcher, MAX_POD_WAIT_TIME
+from freenome_build.pool import ConnectionPool, DEFAULT_MAX_POOL_SIZE
+from freenome_build.readiness import wait_for_postgres
+from freenome_build.sql import execute_sql_script
+from freenome_build.trace import span, traced
 from freenome_build.util import norm_abs_join_path, change_directory, get_git_repo_name, run_and_log
 
 logger = logging.getLogger(__file__)  # noqa: invalid-name
@@ -20,17 +29,80 @@ logger = logging.getLogger(__file__)  # noqa: invalid-name
 MAX_DB_WAIT_TIME = 10
 
 # The maximum amount of time in seconds to wait for a k8s db to come up.
-MAX_CONTAINER_CHECKS = 600
+MAX_CONTAINER_WAIT_TIME = MAX_POD_WAIT_TIME
+
+# The data directory of the postgres image
+PGDATA_PATH = '/var/lib/postgresql/data'
+
+# Server settings for the 'ephemeral' profile. These give up crash safety, which we
+# don't need for a throwaway test database, in exchange for much faster writes.
+EPHEMERAL_PG_SETTINGS = [
+    ('fsync', 'off'),
+    ('synchronous_commit', 'off'),
+    ('full_page_writes', 'off'),
+    # minimal WAL lets COPY into tables created in the same transaction skip the WAL entirely
+    ('wal_level', 'minimal'),
+    ('max_wal_senders', '0'),
+    ('max_wal_size', '4GB'),
+    ('checkpoint_timeout', '1h'),
+]
+
+# The default shared_buffers for the ephemeral profile
+DEFAULT_EPHEMERAL_SHARED_BUFFERS = '256MB'
 
 
 class DbConnectionData():
-    def __init__(self, host, port, dbname, user, password=None):
+    def __init__(self, host, port, dbname, user, password=None, max_pool_size=DEFAULT_MAX_POOL_SIZE):
         self.host = host
         self.port = port
         self.dbname = dbname
         self.user = user
         self.password = password
-        self.conn = None
+        self.max_pool_size = max_pool_size
+        # connection pools keyed by (user, dbname)
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+
+    def connect(self, user: str = None, dbname: str = None):
+        """Open a new (unpooled) psycopg2 connection to the db.
+
+        'user' and 'dbname' override the values in this object -- if 'user' is overridden then we
+        connect without a password (eg to connect as the superuser before the db is set up).
+        """
+        password = self.password if user is None else None
+        return psycopg2.connect(
+            host=self.host,
+            port=self.port,
+            dbname=dbname or self.dbname,
+            user=user or self.user,
+            password=password
+        )
+
+    def pool(self, user: str = None, dbname: str = None) -> ConnectionPool:
+        """Return the connection pool for 'user' and 'dbname' (see connect), creating it if necessary."""
+        key = (user or self.user, dbname or self.dbname)
+        with self._pools_lock:
+            if key not in self._pools:
+                self._pools[key] = ConnectionPool(
+                    lambda: self.connect(user=user, dbname=dbname), max_size=self.max_pool_size)
+            return self._pools[key]
+
+    def connection(self, user: str = None, dbname: str = None):
+        """Check out a pooled connection for the duration of a with block.
+
+        eg:
+        with conn_data.connection() as conn:
+            ...
+        """
+        return self.pool(user=user, dbname=dbname).connection()
+
+    def close_pools(self, dbname: str = None) -> None:
+        """Close the connection pools (only the pools for 'dbname' if it is set)."""
+        with self._pools_lock:
+            keys = [key for key in self._pools if dbname is None or key[1] == dbname]
+            pools = [self._pools.pop(key) for key in keys]
+        for pool in pools:
+            pool.close()
 
     @classmethod
     def from_conn_string(cls, conn_string):
@@ -61,8 +133,15 @@ class ContainerDoesNotExistError(Exception):
     pass
 
 
-def _execute_sql_script(sql_script_path, dbuser, dbname, host, port):
-    pass
+def _execute_sql_script(conn_data: DbConnectionData, script, user: str = None, dbname: str = None,
+                        stop_on_error: bool = True) -> None:
+    """Execute the SQL in 'script' (a string or file-like object) against the db in conn_data.
+
+    See DbConnectionData.connect for 'user' and 'dbname', and freenome_build.sql.execute_sql_script
+    for 'stop_on_error'.
+    """
+    with conn_data.connection(user=user, dbname=dbname) as conn:
+        execute_sql_script(conn, script, stop_on_error=stop_on_error)
 
 
 def _find_free_port():
@@ -71,6 +150,7 @@ def _find_free_port():
         return s.getsockname()[1]
 
 
+@traced('run-migrations')
 def _run_migrations(conn_data: DbConnectionData, repo_path: str) -> None:
     # check if 'migrate' exists in repo_path/database/
     repo_migrate_path = norm_abs_join_path(repo_path, "./database/migrate")
@@ -88,8 +168,8 @@ def _run_migrations(conn_data: DbConnectionData, repo_path: str) -> None:
 
     with change_directory(sqitch_path):
         try:
-            run_and_log(
-                f"sqitch deploy {conn_data.sqitch_string}")
+            with span('sqitch-deploy'):
+                run_and_log(f"sqitch deploy {conn_data.sqitch_string}")
         except subprocess.CalledProcessError as inst:
             # we don't care if there's nothing to deploy
             if inst.stderr.decode().strip() == 'Nothing to deploy (empty plan)':
@@ -98,47 +178,23 @@ def _run_migrations(conn_data: DbConnectionData, repo_path: str) -> None:
                 raise
 
 
-def _wait_for_db_cluster_to_start(host: str, port: int, max_wait_time=MAX_DB_WAIT_TIME, recheck_interval=0.2) -> None:
-    conn_str = f"dbname=postgres user=postgres host={host} port={port}"
-    for _ in range(int(max_wait_time/recheck_interval)+1):
-        try:
-            with psycopg2.connect(conn_str) as _: # noqa
-                # we just want to see if we can connect, so if we do then connect
-                logger.debug(f"Database at '{host}:{port}' is up!")
-                return
-        except psycopg2.OperationalError:
-            logger.debug(f"DB cluster at '{host}:{port}' is not yet up.")
-            time.sleep(recheck_interval)
-            continue
-
-    raise RuntimeError(f"Aborting because the DB did not start within {MAX_DB_WAIT_TIME} seconds.")
-
-
-def _wait_for_container(pod_id: str):
-    last_timestamp = ""
-    event_cmd = f"kubectl get events -o json --sort-by=.metadata.creationTimestamp " \
-                f"--field-selector involvedObject.name={pod_id}"
-    pod_status_cmd = f"kubectl get pod {pod_id}"
-    attempts = 0
-    while attempts < MAX_CONTAINER_CHECKS:
-        # We need to do this separately from checking for events since the
-        # "Started" event doesn't necessarily mean the pod is ready.
-        pod_status = subprocess.check_output(pod_status_cmd, shell=True).decode().strip()
-        if 'Running' in pod_status:
-            return
-        # If the pod isn't running yet, check for any new events.
-        events = json.loads(subprocess.check_output(event_cmd, shell=True).decode().strip())['items']
-        for event in events:
-            # If this is a new event, log it.
-            if last_timestamp < event['firstTimestamp']:
-                logger.info(f"Container status: {event['message']}")
-            # If there was an error, raise an exception
-            if 'Error' in event['message']:
-                raise RuntimeError(f"Container failed to start: {event['message']}")
-        if len(events) > 0:
-            last_timestamp = events[-1]['firstTimestamp']
-        time.sleep(1)
-    raise RuntimeError(f"Container failed to start after {MAX_CONTAINER_CHECKS} seconds")
+@traced('wait-for-db')
+def _wait_for_db_cluster_to_start(host: str, port: int, max_wait_time=MAX_DB_WAIT_TIME, recheck_interval=0.05,
+                                  log_cmd: str = None) -> None:
+    """Wait for the db cluster at host:port to accept connections.
+
+    'recheck_interval' is the initial delay between checks -- subsequent checks back off
+    exponentially. If 'log_cmd' is set then we also watch its output for the server's
+    ready line (see freenome_build.readiness for details).
+    """
+    wait_for_postgres(host, port, max_wait_time, initial_delay=recheck_interval, log_cmd=log_cmd)
+
+
+@traced('wait-for-pod')
+def _wait_for_container(pod_id: str) -> None:
+    phase_durations = PodWatcher(pod_id, max_wait_time=MAX_CONTAINER_WAIT_TIME).wait_until_running()
+    logger.info(f"Pod '{pod_id}' is running. Time spent in each phase: " + ", ".join(
+        f"{phase}={duration:.1f}s" for phase, duration in phase_durations.items()))
 
 
 def _get_pod_id_from_pod_ip(pod_ip: str) -> str:
@@ -161,22 +217,35 @@ def _remove_existing_container(container_name: str) -> None:
             raise
 
 
-def start_local_database(repo_path: str, project_name: str, dbname: str = None, user: str = None,
-                         port: int = None, password: str = None,
-                         max_wait_time: int = MAX_DB_WAIT_TIME) -> DbConnectionData:
-    """Start a test database in a docker container.
+def _local_container_name(conn_data: DbConnectionData) -> str:
+    return f"{conn_data.dbname}_{conn_data.port}"
 
-    This starts a new test database in a docker container. This function:
-    1) builds the postgres server docker image
-    2) starts the docker container on port 'port'
+
+def _ephemeral_server_args(shared_buffers: str = DEFAULT_EPHEMERAL_SHARED_BUFFERS) -> List[str]:
+    """The postgres command line for the ephemeral profile."""
+    args = ['postgres']
+    for name, value in EPHEMERAL_PG_SETTINGS + [('shared_buffers', shared_buffers)]:
+        args.extend(['-c', f"{name}={value}"])
+    return args
+
+
+def _ephemeral_pod_config(kube_pod_config: str, shared_buffers: str = DEFAULT_EPHEMERAL_SHARED_BUFFERS) -> str:
+    """Return 'kube_pod_config' modified to use the ephemeral profile.
+
+    The database container runs with the ephemeral settings and PGDATA is mounted on
+    a memory backed emptyDir volume.
     """
-    # The default dbname and user are the project_name. We'll also generate a random
-    # password if one wasn't passed in.
-    if dbname is None:
-        dbname = project_name
-    if user is None:
-        user = project_name
+    with open(kube_pod_config) as ifp:
+        config = yaml.safe_load(ifp)
+    container = config['spec']['containers'][0]
+    container['args'] = _ephemeral_server_args(shared_buffers)
+    container.setdefault('volumeMounts', []).append({'name': 'ephemeral-pgdata', 'mountPath': PGDATA_PATH})
+    config['spec'].setdefault('volumes', []).append({'name': 'ephemeral-pgdata', 'emptyDir': {'medium': 'Memory'}})
+    return yaml.safe_dump(config, default_flow_style=False)
+
 
+@traced('docker-build')
+def _build_local_db_image(repo_path: str, dbname: str) -> None:
     # set the path to the Postgres Dockerfile
     docker_file_path = norm_abs_join_path(repo_path, "./database/Dockerfile")
     # if the repo doesn't have a Dockerfile in the database sub-directory, then
@@ -192,6 +261,15 @@ def start_local_database(repo_path: str, project_name: str, dbname: str = None,
     build_cmd = f"docker build --rm -t {dbname}:latest {docker_file_dir}"
     run_and_log(build_cmd)
 
+
+def _start_local_db_container(dbname: str, user: str, port: int = None, password: str = None,
+                              max_wait_time: int = MAX_DB_WAIT_TIME, ephemeral: bool = False,
+                              shared_buffers: str = DEFAULT_EPHEMERAL_SHARED_BUFFERS) -> DbConnectionData:
+    """Start a container from the '{dbname}:latest' image and wait for the db cluster to come up.
+
+    If 'ephemeral' is True then PGDATA is mounted on a tmpfs and the server runs with
+    EPHEMERAL_PG_SETTINGS. If the db cluster doesn't come up then the container is removed.
+    """
     # Find a free port if one wasn't specified
     if port is None:
         port = _find_free_port()
@@ -202,8 +280,13 @@ def start_local_database(repo_path: str, project_name: str, dbname: str = None,
     container_name = f"{dbname}_{port}"
     _remove_existing_container(container_name)
     # starting db
-    run_cmd = f"docker run -d -p {port}:5432 --name {container_name} {dbname}:latest"
-    run_and_log(run_cmd)
+    run_cmd = f"docker run -d -p {port}:5432 --name {container_name}"
+    if ephemeral:
+        run_cmd += f" --tmpfs {PGDATA_PATH}:rw {dbname}:latest {' '.join(_ephemeral_server_args(shared_buffers))}"
+    else:
+        run_cmd += f" {dbname}:latest"
+    with span('docker-run'):
+        run_and_log(run_cmd)
 
     # Get the IP automatically
     try:
@@ -212,15 +295,131 @@ def start_local_database(repo_path: str, project_name: str, dbname: str = None,
         # not everyone sets hostname, this is a good default
         host = '127.0.0.1'
     # Wait for the db to start up before configuring it
-    _wait_for_db_cluster_to_start(host, port, max_wait_time)
+    try:
+        _wait_for_db_cluster_to_start(host, port, max_wait_time, log_cmd=f"docker logs -f {container_name}")
+    except BaseException:
+        # nobody else knows about the container yet, so remove it rather than leak it
+        try:
+            run_and_log(f"docker rm -f {container_name}")
+        except Exception as inst:
+            logger.warning(f"Failed to remove the container '{container_name}': {inst}")
+        raise
 
     conn_data = DbConnectionData(host, port, dbname, user, password)
 
     return conn_data
 
 
+@traced('start-local-database')
+def start_local_database(repo_path: str, project_name: str, dbname: str = None, user: str = None,
+                         port: int = None, password: str = None,
+                         max_wait_time: int = MAX_DB_WAIT_TIME, ephemeral: bool = False,
+                         shared_buffers: str = DEFAULT_EPHEMERAL_SHARED_BUFFERS) -> DbConnectionData:
+    """Start a test database in a docker container.
+
+    This starts a new test database in a docker container. This function:
+    1) builds the postgres server docker image
+    2) starts the docker container on port 'port'
+
+    If 'ephemeral' is True then the database is tuned for speed over durability: PGDATA is on
+    a tmpfs, fsync, synchronous_commit, and full_page_writes are off, and shared_buffers is
+    set to 'shared_buffers'. Only use this for throwaway databases.
+    """
+    # The default dbname and user are the project_name. We'll also generate a random
+    # password if one wasn't passed in.
+    if dbname is None:
+        dbname = project_name
+    if user is None:
+        user = project_name
+
+    _build_local_db_image(repo_path, dbname)
+    return _start_local_db_container(dbname, user, port, password, max_wait_time,
+                                     ephemeral=ephemeral, shared_buffers=shared_buffers)
+
+
+@traced('start-many-local-test-databases')
+def start_many_local_test_databases(repo_path: str, project_name: str, num_dbs: int,
+                                    max_workers: int = None,
+                                    max_wait_time: int = MAX_DB_WAIT_TIME, ephemeral: bool = False,
+                                    shared_buffers: str = DEFAULT_EPHEMERAL_SHARED_BUFFERS
+                                    ) -> List[DbConnectionData]:
+    """Start 'num_dbs' isolated test databases, each in its own docker container.
+
+    This function:
+    1) builds the postgres server docker image once
+    2) starts all of the containers concurrently
+    3) runs setup, the migrations, and the test data insert on the first database only
+    4) dumps the first database and restores the dump into all of the others concurrently
+
+    If any database fails to start, all of the databases that were started are stopped.
+    See start_local_database for 'ephemeral'.
+    """
+    if num_dbs < 1:
+        raise ValueError(f"num_dbs must be at least 1 (got {num_dbs})")
+    if max_workers is None:
+        max_workers = num_dbs
+
+    _build_local_db_image(repo_path, project_name)
+
+    # choose the ports up front so that concurrently started containers can't collide
+    ports = set()
+    while len(ports) < num_dbs:
+        ports.add(_find_free_port())
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                _start_local_db_container, project_name, project_name, port, max_wait_time=max_wait_time,
+                ephemeral=ephemeral, shared_buffers=shared_buffers)
+            for port in sorted(ports)
+        ]
+    # the executor waits for every container to start (or fail), so we know about all of them here
+    conn_datas = [future.result() for future in futures if future.exception() is None]
+    errors = [future.exception() for future in futures if future.exception() is not None]
+
+    try:
+        if errors:
+            raise errors[0]
+
+        # build the snapshot in the first database
+        snapshot_conn_data = conn_datas[0]
+        setup_db(snapshot_conn_data, repo_path)
+        insert_test_data(snapshot_conn_data, repo_path)
+        snapshot = subprocess.check_output(
+            f"docker exec {_local_container_name(snapshot_conn_data)} "
+            f"pg_dump -U postgres {snapshot_conn_data.dbname}",
+            shell=True
+        )
+
+        # and restore it into the rest
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(_restore_local_snapshot, conn_data, repo_path, snapshot)
+                for conn_data in conn_datas[1:]
+            ]
+            for future in as_completed(futures):
+                future.result()
+    except BaseException:
+        stop_many_local_databases(conn_datas)
+        raise
+
+    return conn_datas
+
+
+def _restore_local_snapshot(conn_data: DbConnectionData, repo_path: str, snapshot: bytes) -> None:
+    _create_db_and_user(conn_data, repo_path)
+    _execute_sql_script(conn_data, snapshot.decode(), user='postgres')
+
+
+@traced('start-k8s-database')
 def start_k8s_database(repo_path: str, project_name: str, dbname: str = None, user: str = None,
-                       password: str = None, kube_pod_config: str = None) -> Tuple[DbConnectionData, str]:
+                       password: str = None, kube_pod_config: str = None, ephemeral: bool = False,
+                       shared_buffers: str = DEFAULT_EPHEMERAL_SHARED_BUFFERS) -> Tuple[DbConnectionData, str]:
+    """Start a database in a kubernetes pod.
+
+    If 'ephemeral' is True then PGDATA is on a memory backed volume and the server is tuned
+    for speed over durability (see start_local_database).
+    """
     if dbname is None:
         dbname = project_name
     if user is None:
@@ -230,8 +429,14 @@ def start_k8s_database(repo_path: str, project_name: str, dbname: str = None, us
     if kube_pod_config is None:
         kube_pod_config = norm_abs_join_path(
             os.path.dirname(__file__), "./database_template/db_pod_config.yaml")
-    kcreate_cmd = f"kubectl create -f {kube_pod_config} | sed 's/pod \"\|\" created//g'"  # noqa: W605
-    pod_id = subprocess.check_output(kcreate_cmd, shell=True).decode().strip()
+    if ephemeral:
+        kcreate_cmd = "kubectl create -f - | sed 's/pod \"\|\" created//g'"  # noqa: W605
+        pod_config = _ephemeral_pod_config(kube_pod_config, shared_buffers).encode()
+    else:
+        kcreate_cmd = f"kubectl create -f {kube_pod_config} | sed 's/pod \"\|\" created//g'"  # noqa: W605
+        pod_config = None
+    with span('kubectl-create'):
+        pod_id = subprocess.check_output(kcreate_cmd, shell=True, input=pod_config).decode().strip()
 
     _wait_for_container(pod_id)
 
@@ -243,7 +448,8 @@ def start_k8s_database(repo_path: str, project_name: str, dbname: str = None, us
     return conn_data, pod_id
 
 
-def setup_db(conn_data: DbConnectionData, repo_path: str) -> None:
+@traced('setup-sql')
+def _create_db_and_user(conn_data: DbConnectionData, repo_path: str) -> None:
     # check if 'setup' exists in repo_path/database/
     repo_setup_sql_path = norm_abs_join_path(repo_path, "./database/setup.sql")
     if os.path.exists(repo_setup_sql_path):
@@ -261,11 +467,17 @@ def setup_db(conn_data: DbConnectionData, repo_path: str) -> None:
             setup_sql = ifp.read().format(
                 PGUSER=conn_data.user, PGDATABASE=conn_data.dbname, PGPASSWORD=conn_data.password
             )
-    run_and_log(f"psql -h {conn_data.host} -p {conn_data.port} -U postgres -d postgres",
-                input=setup_sql.encode())
+    # like psql, skip statements that fail (eg if the user already exists)
+    _execute_sql_script(conn_data, setup_sql, user='postgres', dbname='postgres', stop_on_error=False)
+
+
+@traced('setup-db')
+def setup_db(conn_data: DbConnectionData, repo_path: str) -> None:
+    _create_db_and_user(conn_data, repo_path)
     _run_migrations(conn_data, repo_path)
 
 
+@traced('insert-test-data')
 def insert_test_data(conn_data: DbConnectionData, repo_path: str) -> None:
     # check if 'insert_test_data' exists in repo_path/database/
     repo_insert_test_data_path = norm_abs_join_path(
@@ -281,18 +493,25 @@ def insert_test_data(conn_data: DbConnectionData, repo_path: str) -> None:
     if os.path.exists(repo_insert_test_data_sql_path):
         logger.info(f"Inserting data in '{repo_insert_test_data_sql_path}'.")
         with open(repo_insert_test_data_sql_path) as ifp:
-            run_and_log(
-                f"psql {conn_data.conn_string}",
-                input=ifp.read().encode()
-            )
+            _execute_sql_script(conn_data, ifp)
         return
     else:
         logger.info(
             f"The repo at '{repo_path}' does not contain './database/insert_test_data.sql' script")
 
-    raise ValueError(f"'{repo_path}' does not contain an insert test data script or sql file.")
+    repo_test_data_dir = norm_abs_join_path(repo_path, "./database/test_data")
+    if os.path.isdir(repo_test_data_dir):
+        logger.info(f"Bulk loading the data files in '{repo_test_data_dir}'.")
+        load_data_dir(conn_data.connection, repo_test_data_dir)
+        return
+    else:
+        logger.info(
+            f"The repo at '{repo_path}' does not contain a './database/test_data' directory")
+
+    raise ValueError(f"'{repo_path}' does not contain an insert test data script, sql file, or data directory.")
 
 
+@traced('reset-data')
 def reset_data(conn_data: DbConnectionData, repo_path: str) -> None:
     repo_reset_data_path = norm_abs_join_path(
         repo_path, "./database/reset_data")
@@ -302,26 +521,26 @@ def reset_data(conn_data: DbConnectionData, repo_path: str) -> None:
     if os.path.exists(repo_reset_data_path):
         run_and_log(repo_reset_data_path)
     # Check if 'reset_data.sql' exists in repo_path/database
-    elif os.path.exists(repo_reset_data_path):
-        run_and_log(repo_reset_data_path)
+    elif os.path.exists(repo_reset_data_sql_path):
         with open(repo_reset_data_sql_path) as ifp:
-            run_and_log(
-                f"psql {conn_data.conn_string}",
-                input=ifp.read().encode()
-            )
+            _execute_sql_script(conn_data, ifp)
     else:
-        # Drop the database
-        run_and_log(f"psql -h {conn_data.host} -p {conn_data.port} -U postgres -d postgres",
-                    input=f"drop database {conn_data.dbname}")
-        # Drop the user
-        run_and_log(f"psql -h {conn_data.host} -p {conn_data.port} -U postgres -d postgres",
-                    input=f"drop user {conn_data.user}")
+        # Drop the database and the user. We need to close our own connections to
+        # the database first, otherwise postgres won't let us drop it.
+        conn_data.close_pools(dbname=conn_data.dbname)
+        _execute_sql_script(
+            conn_data,
+            f"drop database {conn_data.dbname};\ndrop user {conn_data.user};",
+            user='postgres', dbname='postgres', stop_on_error=False
+        )
         # Recreate the database and run migrations
         setup_db(conn_data, repo_path)
 
 
+@traced('stop-local-database')
 def stop_local_database(conn_data: DbConnectionData) -> None:
-    image_name = f"{conn_data.dbname}_{conn_data.port}"
+    conn_data.close_pools()
+    image_name = _local_container_name(conn_data)
     cmd = f"docker kill {image_name}"
     try:
         run_and_log(cmd)
@@ -340,12 +559,32 @@ def stop_local_database(conn_data: DbConnectionData) -> None:
     run_and_log(cmd)
 
 
+@traced('stop-many-local-databases')
+def stop_many_local_databases(conn_datas: List[DbConnectionData], max_workers: int = None) -> None:
+    """Stop all of the databases in 'conn_datas' concurrently.
+
+    Every database is stopped even if some of them fail -- the first error is re-raised at the end.
+    """
+    if not conn_datas:
+        return
+    with ThreadPoolExecutor(max_workers=max_workers or len(conn_datas)) as executor:
+        futures = [executor.submit(stop_local_database, conn_data) for conn_data in conn_datas]
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    if errors:
+        raise errors[0]
+
+
+@traced('stop-k8s-database')
 def stop_k8s_database(pod_id: str) -> None:
     run_and_log(f"kubectl delete pod {pod_id}")
 
 
+def _profile_kwargs(args):
+    return {'ephemeral': args.ephemeral, 'shared_buffers': args.shared_buffers}
+
+
 def start_local_database_main(args):
-    conn_data = start_local_database(args.path, args.project_name, port=args.port)
+    conn_data = start_local_database(args.path, args.project_name, port=args.port, **_profile_kwargs(args))
     logger.info(f"Successfully started a database. Use the following string to connect:")
     # Printing instead of logging the connection string so that the user can
     # pick it up from stdout
@@ -356,10 +595,11 @@ def start_k8s_database_main(args):
     if args.conn_data:
         conn_data, pod_id = start_k8s_database(args.path, args.project_name, kube_pod_config=args.kube_pod_config,
                                                dbname=args.conn_data.dbname, user=args.conn_data.user,
-                                               port=args.conn_data.port, password=args.conn_data.password)
+                                               port=args.conn_data.port, password=args.conn_data.password,
+                                               **_profile_kwargs(args))
     else:
         conn_data, pod_id = start_k8s_database(args.path, args.project_name,
-                                               kube_pod_config=args.kube_pod_config)
+                                               kube_pod_config=args.kube_pod_config, **_profile_kwargs(args))
     logger.info(f"Successfully started a database. Connect to {pod_id} and use the following string to connect:")
     # Printing instead of logging the connection string and pod id so that the user can
     # pick it up from stdout
@@ -371,9 +611,10 @@ def start_local_test_database_main(args):
     if args.conn_data:
         conn_data = start_local_database(args.path, args.project_name,
                                          dbname=args.conn_data.dbname, user=args.conn_data.user,
-                                         port=args.conn_data.port, password=args.conn_data.password)
+                                         port=args.conn_data.port, password=args.conn_data.password,
+                                         **_profile_kwargs(args))
     else:
-        conn_data = start_local_database(args.path, args.project_name, port=args.port)
+        conn_data = start_local_database(args.path, args.project_name, port=args.port, **_profile_kwargs(args))
     setup_db(conn_data, args.path)
     insert_test_data(conn_data, args.path)
     logger.info(f"Successfully started a database. Use the following string to connect:")
@@ -382,16 +623,27 @@ def start_local_test_database_main(args):
     print(conn_data)
 
 
+def start_many_local_test_databases_main(args):
+    conn_datas = start_many_local_test_databases(args.path, args.project_name, args.num_dbs,
+                                                 max_workers=args.max_workers, **_profile_kwargs(args))
+    logger.info(f"Successfully started {len(conn_datas)} databases. Use the following strings to connect:")
+    # Printing instead of logging the connection strings so that the user can
+    # pick them up from stdout
+    print(json.dumps([conn_data.conn_string for conn_data in conn_datas]))
+
+
 def start_k8s_test_database_main(args):
     # This option needs to be called from within a kubernetes container
     # because this machine needs to be able communicate with the pod
     # that's created
     if args.conn_data:
         conn_data, pod_id = start_k8s_database(args.path, args.conn_data.dbname,
-                                               port=args.conn_data.port, kube_pod_config=args.kube_pod_config)
+                                               port=args.conn_data.port, kube_pod_config=args.kube_pod_config,
+                                               **_profile_kwargs(args))
     else:
-        conn_data, pod_id = start_k8s_database(args.path, args.project_name, kube_pod_config=args.kube_pod_config)
-    _wait_for_db_cluster_to_start(conn_data.host, conn_data.port)
+        conn_data, pod_id = start_k8s_database(args.path, args.project_name, kube_pod_config=args.kube_pod_config,
+                                               **_profile_kwargs(args))
+    _wait_for_db_cluster_to_start(conn_data.host, conn_data.port, log_cmd=f"kubectl logs -f {pod_id}")
     setup_db(conn_data, args.path)
     insert_test_data(conn_data, args.path)
     logger.info(f"Successfully started a database. Connect to {pod_id} and use the following string to connect:")
@@ -425,6 +677,15 @@ def stop_local_database_main(args):
     stop_local_database(args.conn_data)
 
 
+def stop_many_local_databases_main(args):
+    if args.conn_strings_json == '-':
+        conn_strings = json.load(sys.stdin)
+    else:
+        with open(args.conn_strings_json) as ifp:
+            conn_strings = json.load(ifp)
+    stop_many_local_databases([DbConnectionData.from_conn_string(conn_string) for conn_string in conn_strings])
+
+
 def stop_k8s_database_main(args):
     if args.pod_id:
         pod_id = args.pod_id
@@ -468,6 +729,15 @@ def add_db_subparser(subparsers):
         '--kube-pod-config', default=None,
         help='The pod config to use for a kubernetes db. Defaults to the basic template in ./database_template'
     )
+    database_parser.add_argument(
+        '--ephemeral', action='store_true', default=False,
+        help='Tune the database for speed instead of durability when starting it (tmpfs data directory, '
+             'fsync, synchronous_commit, and full_page_writes off). Only use this for throwaway databases.'
+    )
+    database_parser.add_argument(
+        '--shared-buffers', default=DEFAULT_EPHEMERAL_SHARED_BUFFERS,
+        help='shared_buffers for --ephemeral databases. Default: %(default)s'
+    )
     database_parser.add_argument(
         '--pod_id', default=None,
         help='The pod id that will be used when stopping a database. This is only used in stoppnig a database.'
@@ -486,6 +756,16 @@ def add_db_subparser(subparsers):
     # Start a test DB, run migrations, insert the starting data
     database_subparsers.add_parser('start-local-test-db', help='Start a database with all the default data')
 
+    # Start many test DBs, run migrations once, and copy the result into each of them
+    start_many_parser = database_subparsers.add_parser(
+        'start-many', help='Start N local databases with all the default data. '
+                           'Prints a JSON list of connection strings')
+    start_many_parser.add_argument('num_dbs', type=int, help='The number of databases to start')
+    start_many_parser.add_argument(
+        '--max-workers', type=int, default=None,
+        help='The maximum number of databases to provision at once. Default: num_dbs'
+    )
+
     # Start a test DB, run migrations, insert the starting data
     database_subparsers.add_parser('start-k8s-test-db',
                                    help='Start a database with all the default data in a kubernetes pod')
@@ -504,6 +784,14 @@ def add_db_subparser(subparsers):
     # Stop the test db
     database_subparsers.add_parser('stop-local', help='Stop the local test database')
 
+    # Stop the test dbs started by start-many
+    stop_many_parser = database_subparsers.add_parser(
+        'stop-many', help='Stop all of the local test databases started by start-many')
+    stop_many_parser.add_argument(
+        'conn_strings_json',
+        help="A file containing the JSON list of connection strings printed by start-many ('-' for stdin)"
+    )
+
     # Stop the test db
     database_subparsers.add_parser('stop-k8s', help='Stop the kubernetes test database')
 
@@ -528,6 +816,8 @@ def db_main(args):
         start_k8s_database_main(args)
     elif args.test_db_command == 'start-local-test-db':
         start_local_test_database_main(args)
+    elif args.test_db_command == 'start-many':
+        start_many_local_test_databases_main(args)
     elif args.test_db_command == 'start-k8s-test-db':
         start_k8s_test_database_main(args)
     elif args.test_db_command == 'setup-db':
@@ -538,6 +828,8 @@ def db_main(args):
         reset_data_main(args)
     elif args.test_db_command == 'stop-local':
         stop_local_database_main(args)
+    elif args.test_db_command == 'stop-many':
+        stop_many_local_databases_main(args)
     elif args.test_db_command == 'stop-k8s':
         stop_k8s_database_main(args)
     else:
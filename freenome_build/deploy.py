@@ -1,12 +1,120 @@
+import asyncio
+import logging
 import os
+from collections import namedtuple
 
-from freenome_build.util import build_package, run_and_log
+from freenome_build.build_cache import BuildCache, source_hash
+from freenome_build.recipe import render_recipe, requirement_names
+from freenome_build.tasks import TaskGraph, run_command_async
+from freenome_build.upload import AnacondaChannel, DEFAULT_MAX_PARALLEL_UPLOADS, LocalChannel, Uploader
+from freenome_build.util import build_packages, conda_build_cmd
+from freenome_build.trace import traced
 from freenome_build import version_utils
 
+logger = logging.getLogger(__file__)  # noqa: invalid-name
+
 LOCAL_CONDA_BUILD_SCRIPT = os.path.abspath('scripts/conda_build.sh')
 
+# the anaconda cloud user that packages are uploaded to
+UPLOAD_CHANNEL = 'freenome'
+
+# the resources that we budget for each concurrent conda build
+DEFAULT_CPUS_PER_BUILD = 2
+DEFAULT_MEMORY_PER_BUILD = 2*1024*1024*1024
+
+Recipe = namedtuple('Recipe', ['path', 'version', 'package_names', 'requirements', 'cache_key'])
+
+
+class RecipeDependencyCycleError(RuntimeError):
+    pass
+
+
+def _available_memory():
+    """Return the number of bytes of memory available for new processes, or None if we can't tell."""
+    try:
+        with open('/proc/meminfo') as ifp:
+            for line in ifp:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    except FileNotFoundError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError):
+        return None
+
+
+def default_max_parallel_builds(cpus_per_build=DEFAULT_CPUS_PER_BUILD, memory_per_build=DEFAULT_MEMORY_PER_BUILD):
+    """The number of builds that fit in this machine's CPUs and available memory."""
+    max_builds = (os.cpu_count() or 1)//cpus_per_build
+    memory = _available_memory()
+    if memory is not None:
+        max_builds = min(max_builds, memory//memory_per_build)
+    return max(1, max_builds)
+
+
+def read_recipe(path, use_build_cache=True):
+    """Return the Recipe for the repo at 'path'.
+
+    'package_names' are all of the packages that the recipe builds (including the
+    outputs of multi-output recipes), and 'requirements' are the names of all of the
+    packages that they require. They're read from the rendered recipe, so only the
+    requirements that apply to this platform and version are included.
+    """
+    version = version_utils.version(path)
+    package_names = []
+    requirements = set()
+    for metadata in render_recipe(path, version):
+        # each variant of an output is rendered separately
+        if metadata.name() not in package_names:
+            package_names.append(metadata.name())
+        requirements.update(requirement_names(metadata))
+    requirements.difference_update(package_names)
+    cache_key = source_hash(path, version) if use_build_cache else None
+    return Recipe(path, version, package_names, requirements, cache_key)
+
+
+def build_order(recipes):
+    """Sort 'recipes' so that every recipe comes after the recipes that build its requirements.
+
+    Returns a list of (recipe, [the recipes that it depends on]).
+    """
+    recipe_by_package = {}
+    for recipe in recipes:
+        for package_name in recipe.package_names:
+            if package_name in recipe_by_package:
+                raise ValueError(
+                    f"'{package_name}' is built by both '{recipe_by_package[package_name].path}' and '{recipe.path}'")
+            recipe_by_package[package_name] = recipe
+    upstream = {
+        recipe.path: [recipe_by_package[name] for name in sorted(recipe.requirements) if name in recipe_by_package]
+        for recipe in recipes
+    }
+
+    ordered = []
+    done = set()
+    remaining = list(recipes)
+    while remaining:
+        ready = [recipe for recipe in remaining if all(dep.path in done for dep in upstream[recipe.path])]
+        if not ready:
+            raise RecipeDependencyCycleError(
+                f"The requirements of {[recipe.path for recipe in remaining]} form a cycle")
+        for recipe in ready:
+            ordered.append((recipe, upstream[recipe.path]))
+            done.add(recipe.path)
+            remaining.remove(recipe)
+    return ordered
+
+
+def default_channel():
+    """The freenome channel on anaconda.org, using the token in $ANACONDA_TOKEN."""
+    return AnacondaChannel(UPLOAD_CHANNEL, os.environ["ANACONDA_TOKEN"])
+
 
-def build_and_upload_package_from_repo(path='./', upload=True, skip_existing=False, repo_name=None):
+@traced('deploy')
+def build_and_upload_package_from_repo(path='./', upload=True, skip_existing=False, repo_name=None,
+                                       use_build_cache=True, max_parallel_uploads=DEFAULT_MAX_PARALLEL_UPLOADS,
+                                       channel=None):
     """
 
     Args:
@@ -14,25 +122,126 @@ def build_and_upload_package_from_repo(path='./', upload=True, skip_existing=Fal
         upload (bool): upload to freenome conda channel (default True)
         skip_existing (bool): do not build if existing build in local conda install (default False)
         repo_name (str): repo name to build (optional)
+        use_build_cache (bool): reuse the packages from the build cache if the sources haven't
+            changed, and don't re-upload them if they have already been uploaded (default True)
+        max_parallel_uploads (int): the number of packages to upload at once (for multi-output recipes)
+        channel: the channel to upload to (default: the freenome channel on anaconda.org, see
+            freenome_build.upload for the alternatives)
 
     Returns:
         None
 
     """
     version = version_utils.version(path)
-    output_file_path = build_package(path, version, skip_existing=skip_existing)
+    cache_key = source_hash(path, version) if use_build_cache else None
+    build_cache = BuildCache()
+    output_file_paths = build_packages(
+        path, version, skip_existing=skip_existing, cache_key=cache_key, build_cache=build_cache)
 
     if upload:
-        upload_cmd = f'anaconda -t {os.environ["ANACONDA_TOKEN"]} upload --force -u freenome {output_file_path}'
+        if channel is None:
+            channel = default_channel()
+        if cache_key is not None and build_cache.is_uploaded(cache_key, channel.name):
+            logger.info(f"{output_file_paths} have already been uploaded to '{channel.name}', skipping the upload")
+            return
 
-        run_and_log(upload_cmd)
+        Uploader(channel, max_workers=max_parallel_uploads).upload_all(output_file_paths)
+        if cache_key is not None:
+            build_cache.mark_uploaded(cache_key, channel.name)
+
+
+@traced('deploy')
+def build_and_upload_packages_from_repos(paths, upload=True, skip_existing=False, use_build_cache=True,
+                                         max_parallel_builds=None,
+                                         max_parallel_uploads=DEFAULT_MAX_PARALLEL_UPLOADS, channel=None):
+    """Build (and upload) the packages for several repos, eg for a release train.
+
+    Recipes are built after the recipes that build their requirements, and independent
+    recipes are built concurrently -- at most 'max_parallel_builds' at once (default: as
+    many as fit in the machine's CPUs and memory, see default_max_parallel_builds). Each
+    recipe's packages are uploaded as soon as they are built. See
+    build_and_upload_package_from_repo for the other arguments.
+
+    Returns a dict mapping each repo path to the paths of its packages.
+    """
+    if max_parallel_builds is None:
+        max_parallel_builds = default_max_parallel_builds()
+    cpu_count = max(1, (os.cpu_count() or 1)//max_parallel_builds)
+    build_cache = BuildCache()
+    if upload and channel is None:
+        channel = default_channel()
+    # recipes are uploaded concurrently, so each upload task only needs one worker
+    uploader = Uploader(channel, max_workers=1) if upload else None
+    recipes = [read_recipe(path, use_build_cache=use_build_cache) for path in paths]
+    logger.info(f"Building {len(recipes)} recipes, {max_parallel_builds} at a time")
+
+    # repo path -> the paths of the packages that it built
+    package_paths = {}
+    graph = TaskGraph(pool_limits={'build': max_parallel_builds, 'upload': max_parallel_uploads})
+    for recipe, upstream in build_order(recipes):
+        async def build(recipe=recipe, upstream=upstream):
+            if recipe.cache_key is not None:
+                cached_paths = build_cache.lookup(recipe.cache_key)
+                if cached_paths is not None:
+                    logger.info(f"The sources at '{recipe.path}' haven't changed, using the cached packages")
+                    package_paths[recipe.path] = cached_paths
+                    return
+            # cached upstream packages aren't in the local conda-bld channel, so add their channels
+            channels = [
+                'file://' + os.path.join(build_cache.cache_dir, dep.cache_key)
+                for dep in upstream if dep.cache_key is not None
+            ]
+            await run_command_async(
+                conda_build_cmd(recipe.path, recipe.version, skip_existing=skip_existing,
+                                channels=channels, cpu_count=cpu_count),
+                log_prefix=f"build {recipe.package_names[0]}"
+            )
+            output = await run_command_async(
+                conda_build_cmd(recipe.path, recipe.version, output=True, channels=channels), log_level=logging.DEBUG)
+            built_paths = output.stdout.decode().split()
+            if recipe.cache_key is not None:
+                built_paths = await asyncio.get_event_loop().run_in_executor(
+                    None, build_cache.store, recipe.cache_key, built_paths)
+            package_paths[recipe.path] = built_paths
+
+        def upload_recipe(recipe=recipe):
+            if recipe.cache_key is not None and build_cache.is_uploaded(recipe.cache_key, channel.name):
+                logger.info(f"The packages for '{recipe.path}' have already been uploaded, skipping the upload")
+                return
+            uploader.upload_all(package_paths[recipe.path])
+            if recipe.cache_key is not None:
+                build_cache.mark_uploaded(recipe.cache_key, channel.name)
+
+        build_task = graph.add(
+            f"build:{recipe.package_names[0]}", build,
+            deps=[f"build:{dep.package_names[0]}" for dep in upstream], pool='build'
+        )
+        if upload:
+            graph.add(f"upload:{recipe.package_names[0]}", upload_recipe, deps=[build_task], pool='upload')
+    graph.run()
+    return package_paths
 
 
 def deploy_main(args):
-    return build_and_upload_package_from_repo(
-        path=args.path,
+    paths = args.paths or ['./']
+    channel = LocalChannel(args.channel_dir) if args.channel_dir else None
+    if len(paths) == 1:
+        return build_and_upload_package_from_repo(
+            path=paths[0],
+            upload=args.upload,
+            skip_existing=args.skip_existing,
+            use_build_cache=args.use_build_cache,
+            max_parallel_uploads=args.max_parallel_uploads,
+            channel=channel
+        )
+    return build_and_upload_packages_from_repos(
+        paths,
         upload=args.upload,
-        skip_existing=args.skip_existing
+        skip_existing=args.skip_existing,
+        use_build_cache=args.use_build_cache,
+        max_parallel_builds=args.max_parallel_builds,
+        max_parallel_uploads=args.max_parallel_uploads,
+        channel=channel
     )
 
 
@@ -42,6 +251,19 @@ def add_deploy_subparser(subparsers):
     deploy_subparser.add_argument(
         '-u', '--upload', action='store_true', default=False, dest='upload')
     deploy_subparser.add_argument(
-        '-p', '--path', action='store', default='./', dest='path')
+        '-p', '--path', action='append', default=None, dest='paths',
+        help='The repo to deploy (default ./). Repeat to build several repos concurrently')
     deploy_subparser.add_argument(
         '--skip', action='store_true', default=False, dest='skip_existing')
+    deploy_subparser.add_argument(
+        '--no-build-cache', action='store_false', default=True, dest='use_build_cache',
+        help="Always rebuild and re-upload the package, even if the sources haven't changed")
+    deploy_subparser.add_argument(
+        '--max-parallel-builds', type=int, default=None,
+        help='The number of recipes to build at once (default: as many as fit in the CPUs and memory)')
+    deploy_subparser.add_argument(
+        '--max-parallel-uploads', type=int, default=DEFAULT_MAX_PARALLEL_UPLOADS,
+        help='The number of packages to upload at once')
+    deploy_subparser.add_argument(
+        '--channel-dir', default=None,
+        help='Upload to this local channel directory instead of anaconda.org')
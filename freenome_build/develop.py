@@ -1,40 +1,48 @@
 import os
 import logging
-import yaml
+import re
+import shlex
 
-from freenome_build.util import build_package, run_and_log, norm_abs_join_path, change_directory
+from freenome_build.build_cache import source_hash
+from freenome_build.env_cache import EnvCache, current_prefix, env_key
+from freenome_build.recipe import read_meta_yaml, render_requirements
+from freenome_build.util import build_package, run_and_log, YamlNotFoundError
 from freenome_build.github import repo_name
+from freenome_build.trace import span, traced
 from freenome_build import version_utils
 
 logger = logging.getLogger(__file__)  # noqa: invalid-name
 
 
 def get_package_name_from_meta_yaml(path):
-    with open(norm_abs_join_path(path, './conda-build/meta.yaml')) as ifp:
-        data_template = ifp.read()
-        # replace the VERSION template with 0, because we don't actually care
-        # about the version to get the package name, but we need to yaml to be parseable
-        data = yaml.load(data_template.replace("{{ VERSION }}", "0"))
-        return data['package']['name']
+    return read_meta_yaml(path)['package']['name']
 
 
-def setup_development_environment(path):
-    version = version_utils.version(path)
-    logging.debug('version: %s', version)
+def _with_python(requirements):
+    # 'setup.py develop' runs with the environment's python, so the environment needs one
+    if any(re.split(r'[\s=<>!]', spec, 1)[0] == 'python' for spec in requirements):
+        return requirements
+    return sorted(requirements + ['python'])
 
-    # get package name
-    try:
-        package_name = get_package_name_from_meta_yaml(path)
-    except FileNotFoundError:
-        with change_directory(path):
-            package_name = repo_name().replace("_", "-")
 
-    logging.debug('package name: %s', package_name)
+def _install_requirements(requirements, prefix):
+    # conda rejects an install without any specs
+    if not requirements:
+        logger.info(f"There are no requirements to install into '{prefix}'")
+        return
+    specs = ' '.join(shlex.quote(spec) for spec in requirements)
+    if os.path.exists(os.path.join(prefix, 'conda-meta')):
+        run_and_log(f"conda install --yes --prefix {shlex.quote(prefix)} {specs}")
+    else:
+        run_and_log(f"conda create --yes --prefix {shlex.quote(prefix)} {specs}")
 
+
+def _install_dependencies_from_package(path, version, package_name, prefix, use_build_cache):
     # build the package.
     # ( we need to do this to install the dependencies -- which is super hacky but required
     #   because of the jinja templating -- see https://github.com/conda/conda/issues/5126   )
-    output_file_path = build_package(path, version=version, skip_existing=False)
+    cache_key = source_hash(path, version) if use_build_cache else None
+    output_file_path = build_package(path, version=version, skip_existing=False, cache_key=cache_key)
     logger.debug('output build to %s', output_file_path)
 
     # conda install this package, which installs all of the dependencies
@@ -42,9 +50,62 @@ def setup_development_environment(path):
     # extract the local path from the return output_file_path, which is of the form:
     # /tmp/nboley/conda/linux-64/balrog-10-0.tar.bz2
     local_channel = "file://" + os.path.split(os.path.split(output_file_path)[0])[0]
-    run_and_log(f"conda install {package_name}=={version} --only-deps --yes -c {local_channel}")
+    if not os.path.exists(os.path.join(prefix, 'conda-meta')):
+        run_and_log(f"conda create --yes --prefix {prefix}")
+    run_and_log(f"conda install {package_name}=={version} --only-deps --yes -c {local_channel} --prefix {prefix}")
+
+
+@traced('develop')
+def setup_development_environment(path, use_build_cache=True, use_env_cache=True, prefix=None):
+    """Install the dependencies of the repo at 'path', and then install it in develop mode.
+
+    The requirements are read by rendering the recipe, and are installed into the conda
+    environment at 'prefix' (default: the active environment), which is created if it
+    doesn't exist. If 'use_env_cache' is True and the environment was already set up for
+    the same requirements, installing them is skipped. If another environment was set up
+    for them, it is cloned from the environment cache without solving the environment.
+
+    Repos without a recipe are built with bdist_conda to install their dependencies.
+    """
+    if prefix is None:
+        prefix = current_prefix()
+    version = version_utils.version(path)
+    logging.debug('version: %s', version)
+
+    # get package name
+    try:
+        package_name, requirements = render_requirements(path, version)
+        requirements = _with_python(requirements)
+    except YamlNotFoundError:
+        package_name = repo_name(path).replace("_", "-")
+        # bdist_conda packages don't have a recipe, so we can't tell what they require
+        requirements = None
+
+    logging.debug('package name: %s', package_name)
+
+    with span('install-dependencies'):
+        if requirements is None:
+            _install_dependencies_from_package(path, version, package_name, prefix, use_build_cache)
+        elif not use_env_cache:
+            _install_requirements(requirements, prefix)
+        else:
+            env_cache = EnvCache()
+            key = env_key(requirements)
+            if env_cache.installed_key(prefix) == key:
+                logger.info(f"The environment at '{prefix}' already has the requirements of '{package_name}'")
+            elif env_cache.has(key):
+                logger.info(f"Installing the requirements of '{package_name}' from the environment cache")
+                env_cache.install(key, prefix)
+                env_cache.mark_installed(key, prefix)
+            else:
+                _install_requirements(requirements, prefix)
+                env_cache.save(key, prefix)
+                env_cache.mark_installed(key, prefix)
+
     # python setup.py develop $PATH
-    run_and_log("cd {path} && python setup.py develop".format(path=path))
+    with span('setup-py-develop'):
+        python = os.path.join(prefix, 'bin', 'python')
+        run_and_log(f"cd {path} && {python} setup.py develop")
 
 
 def add_develop_subparser(subparsers):
@@ -52,7 +113,17 @@ def add_develop_subparser(subparsers):
         'develop', help='initialize a development environment')
     develop_subparser.required = True
     develop_subparser.add_argument('path', default='.')
+    develop_subparser.add_argument(
+        '--no-build-cache', action='store_false', default=True, dest='use_build_cache',
+        help="Always rebuild the package (for repos without a recipe), even if the sources haven't changed")
+    develop_subparser.add_argument(
+        '--no-env-cache', action='store_false', default=True, dest='use_env_cache',
+        help="Always re-solve and install the dependencies, even if they haven't changed")
+    develop_subparser.add_argument(
+        '--prefix', default=None,
+        help='The conda environment to set up (default: the active environment). It is created if it does not exist')
 
 
 def develop_main(args):
-    setup_development_environment(args.path)
+    setup_development_environment(
+        args.path, use_build_cache=args.use_build_cache, use_env_cache=args.use_env_cache, prefix=args.prefix)
@@ -0,0 +1,86 @@
+import hashlib
+import json
+import logging
+import os
+import shlex
+import sys
+
+from freenome_build.util import run_and_log
+
+logger = logging.getLogger(__file__)  # noqa: invalid-name
+
+# bump this to invalidate every existing cache entry (eg if the key's inputs change)
+CACHE_FORMAT_VERSION = 1
+
+DEFAULT_ENV_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'freenome-build', 'envs')
+
+# the file in an environment's conda-meta dir that records the key of its installed dependencies
+INSTALLED_KEY_FILENAME = 'freenome-build-deps.json'
+
+
+def default_env_cache_dir():
+    """The environment cache directory. This can be set with $FREENOME_BUILD_ENV_CACHE_DIR."""
+    return os.environ.get('FREENOME_BUILD_ENV_CACHE_DIR', DEFAULT_ENV_CACHE_DIR)
+
+
+def current_prefix():
+    """The prefix of the active conda environment."""
+    return os.environ.get('CONDA_PREFIX', sys.prefix)
+
+
+def env_key(requirements):
+    """Return a hex digest that identifies the environment solved for 'requirements' on this platform."""
+    return hashlib.sha256(json.dumps(
+        [CACHE_FORMAT_VERSION, sys.platform, sorted(requirements)]).encode()).hexdigest()
+
+
+class EnvCache():
+    """Solved conda environments keyed by env_key.
+
+    Each entry is an explicit spec file ('conda list --explicit --md5') of an environment
+    that was solved for the key's requirements. Installing from it doesn't need a solve,
+    and the packages are usually already in conda's package cache.
+
+    Environments also record the key that they were installed with, so that an
+    environment that already has the requirements can be left alone.
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir if cache_dir is not None else default_env_cache_dir()
+
+    def _spec_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.txt")
+
+    def has(self, key):
+        return os.path.exists(self._spec_path(key))
+
+    def save(self, key, prefix):
+        """Save the packages installed in the environment at 'prefix' as the entry for 'key'."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        spec = run_and_log(f"conda list --explicit --md5 --prefix {shlex.quote(prefix)}").stdout
+        spec_path = self._spec_path(key)
+        with open(spec_path + '.tmp', 'wb') as ofp:
+            ofp.write(spec)
+        os.replace(spec_path + '.tmp', spec_path)
+        logger.info(f"Saved the environment at '{prefix}' to the environment cache with key '{key}'")
+
+    def install(self, key, prefix):
+        """Install the cached environment for 'key' into 'prefix', creating it if it doesn't exist."""
+        spec_path = shlex.quote(self._spec_path(key))
+        if os.path.exists(os.path.join(prefix, 'conda-meta')):
+            run_and_log(f"conda install --yes --prefix {shlex.quote(prefix)} --file {spec_path}")
+        else:
+            run_and_log(f"conda create --yes --prefix {shlex.quote(prefix)} --file {spec_path}")
+
+    @staticmethod
+    def installed_key(prefix):
+        """Return the key that the environment at 'prefix' was installed with, or None."""
+        try:
+            with open(os.path.join(prefix, 'conda-meta', INSTALLED_KEY_FILENAME)) as ifp:
+                return json.load(ifp)['key']
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    @staticmethod
+    def mark_installed(key, prefix):
+        with open(os.path.join(prefix, 'conda-meta', INSTALLED_KEY_FILENAME), 'w') as ofp:
+            json.dump({'key': key}, ofp)
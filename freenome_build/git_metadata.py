@@ -0,0 +1,111 @@
+import logging
+import os
+import subprocess
+import threading
+
+logger = logging.getLogger(__file__)  # noqa: invalid-name
+
+# abs path -> GitMetadata
+_metadata_cache = {}
+_metadata_cache_lock = threading.Lock()
+
+
+class GitMetadataError(RuntimeError):
+    pass
+
+
+def _git(path, *args):
+    """Run 'git args' in 'path' and return its stripped output, or None if it fails."""
+    proc = subprocess.run(
+        ['git'] + list(args), cwd=path, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if proc.returncode != 0:
+        return None
+    return proc.stdout.decode('utf8').strip()
+
+
+class GitMetadata():
+    """Everything that we need to know about a repo's git checkout.
+
+    The attributes are None if they aren't available (eg the path isn't in a git repo, or
+    there's no remote):
+      toplevel: the root of the checkout
+      remote_url: the url of the 'origin' remote
+      head_sha: the sha of HEAD
+      describe: 'git describe --all HEAD^', eg 'heads/master'
+      dirty: True if tracked files have uncommitted changes
+
+    'describe' and 'dirty' are only read when they're first used, 'git status' is slow on
+    large checkouts and most callers only need the remote.
+    """
+    def __init__(self, path, toplevel=None, remote_url=None, head_sha=None):
+        self.path = path
+        self.toplevel = toplevel
+        self.remote_url = remote_url
+        self.head_sha = head_sha
+        # attribute name -> value, for the attributes that are read lazily
+        self._lazy = {}
+        self._lazy_lock = threading.Lock()
+
+    def _lazy_attr(self, name, read):
+        with self._lazy_lock:
+            if name not in self._lazy:
+                self._lazy[name] = None if self.toplevel is None else read()
+            return self._lazy[name]
+
+    @property
+    def describe(self):
+        return self._lazy_attr('describe', lambda: _git(self.path, 'describe', '--all', 'HEAD^'))
+
+    @property
+    def dirty(self):
+        def read():
+            status = _git(self.path, 'status', '--porcelain', '--untracked-files=no')
+            return None if status is None else bool(status)
+        return self._lazy_attr('dirty', read)
+
+
+def _read_git_metadata(path):
+    # rev-parse gives us the toplevel and HEAD in one go, and fails if 'path' isn't in a repo
+    rev_parse = _git(path, 'rev-parse', '--show-toplevel', 'HEAD')
+    if rev_parse is None:
+        logger.debug(f"'{path}' is not in a git repo")
+        return GitMetadata(path)
+    toplevel, head_sha = (rev_parse.splitlines() + [None])[:2]
+    return GitMetadata(
+        path,
+        toplevel=toplevel,
+        remote_url=_git(path, 'config', '--get', 'remote.origin.url') or None,
+        head_sha=head_sha
+    )
+
+
+def git_metadata(path='.', refresh=False):
+    """Return the GitMetadata of the repo that 'path' is in.
+
+    The git commands run in 'path' (the working directory of the process isn't changed,
+    so this is safe to call from several threads), and the results are cached per path
+    for the life of the process. Pass refresh=True to re-read them (eg after a commit).
+    """
+    path = os.path.abspath(path)
+    with _metadata_cache_lock:
+        metadata = None if refresh else _metadata_cache.get(path)
+    if metadata is None:
+        metadata = _read_git_metadata(path)
+        with _metadata_cache_lock:
+            _metadata_cache[path] = metadata
+    return metadata
+
+
+def clear_git_metadata_cache():
+    with _metadata_cache_lock:
+        _metadata_cache.clear()
+
+
+def remote_repo_name(path='.'):
+    """Return the name of the 'origin' remote's repo (eg 'freenome-build'), for the repo that 'path' is in."""
+    remote_url = git_metadata(path).remote_url
+    if remote_url is None:
+        raise GitMetadataError(f"'{os.path.abspath(path)}' is not in a git repo with an 'origin' remote")
+    # extract the basename, and then strip '.git' off of the end
+    basename = os.path.basename(remote_url.rstrip('/'))
+    return basename[:-4] if basename.endswith('.git') else basename
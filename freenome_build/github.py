@@ -1,29 +1,22 @@
 import os
-import subprocess
 
+from freenome_build.git_metadata import git_metadata
 
-def repo_name():
-    """Return github repository name of current directory
+
+def repo_name(path=None):
+    """Return github repository name of 'path' (default: the current directory)
 
     Returns:
         (str): repo name
     """
-    return os.path.basename(
-        subprocess.run(
-            'git rev-parse --show-toplevel',
-            shell=True,
-            stdout=subprocess.PIPE
-        ).stdout.strip().decode('utf8')).lower().replace('-', '_')
+    toplevel = git_metadata(path or '.').toplevel or ''
+    return os.path.basename(toplevel).lower().replace('-', '_')
 
 
-def environment_name():
+def environment_name(path=None):
     """Returns local environment name
 
     Returns:
         (str): environment name
     """
-    return subprocess.run(
-        'git describe --all HEAD^',
-        shell=True,
-        stdout=subprocess.PIPE
-    ).stdout.strip().decode('utf8').replace('/', '__')
+    return (git_metadata(path or '.').describe or '').replace('/', '__')
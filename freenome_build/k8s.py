@@ -0,0 +1,143 @@
+import codecs
+import json
+import logging
+import os
+import selectors
+import subprocess
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__file__)  # noqa: invalid-name
+
+# The maximum amount of time in seconds to wait for a k8s pod to start running.
+MAX_POD_WAIT_TIME = 600
+
+# container waiting reasons that mean that the pod will never start on its own
+FATAL_WAITING_REASONS = {
+    'ErrImagePull',
+    'ImagePullBackOff',
+    'InvalidImageName',
+    'CrashLoopBackOff',
+    'CreateContainerError',
+    'CreateContainerConfigError',
+}
+
+
+class PodFailedError(RuntimeError):
+    pass
+
+
+def iter_json_objects(chunks):
+    """Yield the JSON objects in a stream of concatenated JSON documents.
+
+    'kubectl get -w -o json' writes one pretty printed object per update with no
+    delimiter, so we incrementally decode from a buffer.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    for chunk in chunks:
+        buf += chunk
+        while True:
+            buf = buf.lstrip()
+            if not buf:
+                break
+            try:
+                obj, end = decoder.raw_decode(buf)
+            except json.JSONDecodeError:
+                # we only have a partial object -- wait for more data
+                break
+            yield obj
+            buf = buf[end:]
+
+
+class PodWatcher():
+    """Follow a pod's status through a single 'kubectl get pod -w' stream.
+
+    'phase_durations' maps each phase the pod has been in to the number of seconds
+    that it spent there (the current phase is included once the watch finishes).
+    """
+    def __init__(self, pod_id: str, kubectl: str = 'kubectl', max_wait_time: float = MAX_POD_WAIT_TIME):
+        self.pod_id = pod_id
+        self.kubectl = kubectl
+        self.max_wait_time = max_wait_time
+        self.phase = None
+        self.phase_durations = OrderedDict()
+        self._phase_start = None
+        self._seen_conditions = set()
+        self._seen_messages = set()
+
+    def _set_phase(self, phase):
+        now = time.monotonic()
+        if self.phase is not None:
+            self.phase_durations[self.phase] = (
+                self.phase_durations.get(self.phase, 0.0) + now - self._phase_start)
+        self.phase = phase
+        self._phase_start = now
+
+    def _update(self, pod):
+        status = pod.get('status', {})
+        phase = status.get('phase')
+        if phase is not None and phase != self.phase:
+            logger.info(f"Pod '{self.pod_id}' is {phase}")
+            self._set_phase(phase)
+
+        for condition in status.get('conditions', []):
+            if condition.get('status') == 'True' and condition['type'] not in self._seen_conditions:
+                self._seen_conditions.add(condition['type'])
+                logger.info(f"Pod '{self.pod_id}' condition: {condition['type']}")
+
+        for container_status in status.get('containerStatuses', []):
+            for state_name, state in container_status.get('state', {}).items():
+                reason = state.get('reason')
+                message = f"{container_status['name']} {state_name}: {reason or ''} {state.get('message', '')}".strip()
+                if reason is not None and message not in self._seen_messages:
+                    self._seen_messages.add(message)
+                    logger.info(f"Container status: {message}")
+                if state_name == 'waiting' and reason in FATAL_WAITING_REASONS:
+                    raise PodFailedError(f"Container failed to start: {message}")
+
+        if phase in ('Failed', 'Succeeded'):
+            raise PodFailedError(
+                f"Container failed to start: pod '{self.pod_id}' is {phase} ({status.get('message', '')})")
+
+        return phase == 'Running'
+
+    def _read_chunks(self, proc, deadline):
+        sel = selectors.DefaultSelector()
+        sel.register(proc.stdout, selectors.EVENT_READ)
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PodFailedError(
+                        f"Container failed to start after {self.max_wait_time} seconds")
+                if not sel.select(timeout=remaining):
+                    continue
+                data = os.read(proc.stdout.fileno(), 65536)
+                if not data:
+                    return
+                yield decoder.decode(data)
+        finally:
+            sel.close()
+
+    def wait_until_running(self):
+        """Block until the pod is running and return 'phase_durations'.
+
+        Raises PodFailedError if the pod fails, or does not start within 'max_wait_time' seconds.
+        """
+        cmd = [self.kubectl, 'get', 'pod', self.pod_id, '--watch', '--output', 'json']
+        logger.debug(f"Running '{' '.join(cmd)}'")
+        deadline = time.monotonic() + self.max_wait_time
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            for pod in iter_json_objects(self._read_chunks(proc, deadline)):
+                if self._update(pod):
+                    return self.phase_durations
+        finally:
+            proc.kill()
+            _, stderr = proc.communicate()
+            self._set_phase(self.phase)
+
+        raise PodFailedError(
+            f"'{' '.join(cmd)}' exited before pod '{self.pod_id}' started running: {stderr.decode().strip()}")
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import logging
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+
+from freenome_build import data_manifest
+from freenome_build.data_manifest import DataManifestReader, hex_to_base64
+
+logger = logging.getLogger(__file__)  # noqa: invalid-name
+
+
+# how long lookup waits for the service before falling back to reading the manifest itself
+DEFAULT_LOOKUP_TIMEOUT = 30
+
+
+def default_socket_path():
+    """The manifest service's socket. This can be set with $FREENOME_BUILD_MANIFEST_SOCKET."""
+    return os.environ.get(
+        'FREENOME_BUILD_MANIFEST_SOCKET',
+        os.path.join(tempfile.gettempdir(), f"freenome-build-manifest-{os.getuid()}.sock")
+    )
+
+
+class ManifestServiceError(RuntimeError):
+    pass
+
+
+def _stat_key(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def _md5sum(fname):
+    with open(fname, 'rb') as ifp:
+        return hex_to_base64(hashlib.md5(ifp.read()).hexdigest())
+
+
+class _LoadedManifest():
+    def __init__(self, reader, stat_key):
+        self.reader = reader
+        self.stat_key = stat_key
+        # name -> the stat key of the local file when it was verified
+        self.verified = {}
+
+
+class ManifestService():
+    """Parsed manifests and their verification state, kept in memory to answer lookups.
+
+    A manifest is re-read when its md5sum changes (which is only checked when the file's
+    stat changes), and the files that were verified against it are forgotten.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (manifest fname, local prefix, remote prefix) -> _LoadedManifest
+        self._manifests = {}
+
+    def _manifest(self, manifest_fname, local_prefix, remote_prefix):
+        # called with the lock held
+        key = (os.path.abspath(manifest_fname), local_prefix, remote_prefix)
+        loaded = self._manifests.get(key)
+        stat_key = _stat_key(manifest_fname)
+        if loaded is not None and loaded.stat_key == stat_key:
+            return loaded
+        if loaded is not None and loaded.reader._md5sum == _md5sum(manifest_fname):
+            loaded.stat_key = stat_key
+            return loaded
+        logger.info(f"Loading '{manifest_fname}'")
+        loaded = _LoadedManifest(DataManifestReader(manifest_fname, local_prefix, remote_prefix), stat_key)
+        self._manifests[key] = loaded
+        return loaded
+
+    def lookup(self, manifest_fname, name, local_prefix, remote_prefix=None, verify=False):
+        """Return {'path': the local path of 'name', 'verified': whether it matches the manifest}.
+
+        If 'verify' is True then a file that hasn't been verified since it (or the manifest)
+        last changed is checked against the manifest's md5sum, and a FileMismatchError is
+        raised if it doesn't match. A missing file is never verified.
+        """
+        with self._lock:
+            loaded = self._manifest(manifest_fname, local_prefix, remote_prefix)
+            record = loaded.reader[name]
+            path = os.path.join(local_prefix, record.relative_local_path)
+            stat_key = _stat_key(path)
+            verified = stat_key is not None and loaded.verified.get(name) == stat_key
+        if verify and not verified and stat_key is not None:
+            # verify outside of the lock, hashing a large file can take a while
+            loaded.reader._verify_record(record, path, check_md5sums=True)
+            with self._lock:
+                loaded.verified[name] = stat_key
+            verified = True
+        return {'path': path, 'verified': verified}
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    # each request is a line of json, eg {"manifest": ..., "name": ..., "local_prefix": ...}
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf8'))
+                response = self.server.service.lookup(
+                    request['manifest'], request['name'], request['local_prefix'],
+                    remote_prefix=request.get('remote_prefix'), verify=request.get('verify', False)
+                )
+            except Exception as inst:
+                response = {'error': type(inst).__name__, 'message': str(inst)}
+            self.wfile.write(json.dumps(response).encode('utf8') + b'\n')
+            self.wfile.flush()
+
+
+class ManifestServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serve a ManifestService on the Unix socket 'socket_path'."""
+    daemon_threads = True
+
+    def __init__(self, socket_path=None):
+        self.service = ManifestService()
+        socket_path = socket_path if socket_path is not None else default_socket_path()
+        # remove the socket of a server that has exited
+        if os.path.exists(socket_path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(socket_path)
+                except ConnectionRefusedError:
+                    os.remove(socket_path)
+                else:
+                    raise ManifestServiceError(f"A manifest service is already running at '{socket_path}'")
+        super().__init__(socket_path, _RequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+# used when the service isn't running
+_local_service = ManifestService()
+
+# the errors that are re-raised from the service's responses
+_SERVICE_ERRORS = {
+    'KeyError': KeyError,
+    'MissingFileError': data_manifest.MissingFileError,
+    'FileMismatchError': data_manifest.FileMismatchError,
+    'FileNotFoundError': FileNotFoundError,
+}
+
+
+def lookup(manifest_fname, name, local_prefix, remote_prefix=None, verify=False, socket_path=None,
+           timeout=DEFAULT_LOOKUP_TIMEOUT, verify_timeout=None):
+    """Look up 'name' in the manifest at 'manifest_fname' (see ManifestService.lookup).
+
+    The lookup is answered by the manifest service at 'socket_path' if it's running, so the
+    manifest is only parsed (and files are only verified) once for every process on the host.
+    Otherwise, or if the service doesn't answer within 'timeout' seconds or fails while
+    answering, the manifest is parsed in this process.
+
+    Verifying a large file can take the service much longer than 'timeout', and falling back
+    would just hash the file twice, so when 'verify' is True only connecting is limited to
+    'timeout' and the service gets 'verify_timeout' seconds to answer (default: no limit).
+    """
+    socket_path = socket_path if socket_path is not None else default_socket_path()
+    # the service doesn't run in our working directory
+    local_prefix = os.path.abspath(local_prefix)
+    request = {
+        'manifest': os.path.abspath(manifest_fname),
+        'name': name,
+        'local_prefix': local_prefix,
+        'remote_prefix': remote_prefix,
+        'verify': verify,
+    }
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(socket_path)
+            if verify:
+                sock.settimeout(verify_timeout)
+            with sock.makefile('rwb') as sock_file:
+                sock_file.write(json.dumps(request).encode('utf8') + b'\n')
+                sock_file.flush()
+                line = sock_file.readline()
+        if not line:
+            raise ConnectionResetError("The manifest service closed the connection without answering")
+        response = json.loads(line.decode('utf8'))
+    # the service isn't running, is hung (socket.timeout is an OSError), or died mid-request
+    except (OSError, ValueError) as inst:
+        logger.debug(f"The manifest service at '{socket_path}' isn't available ({inst}), reading '{manifest_fname}'")
+        return _local_service.lookup(manifest_fname, name, local_prefix, remote_prefix=remote_prefix, verify=verify)
+    if 'error' in response:
+        raise _SERVICE_ERRORS.get(response['error'], ManifestServiceError)(response['message'])
+    return response
+
+
+def add_manifest_service_subparser(subparsers):
+    service_subparser = subparsers.add_parser(
+        'manifest-service', help='serve data manifest lookups to the processes on this host')
+    service_subparser.add_argument(
+        '--socket', default=None, dest='socket_path',
+        help='The Unix socket to listen on (default: $FREENOME_BUILD_MANIFEST_SOCKET or a socket in $TMPDIR)')
+
+
+def manifest_service_main(args):
+    server = ManifestServer(args.socket_path)
+    logger.info(f"Serving data manifest lookups on '{server.server_address}'")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
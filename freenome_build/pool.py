@@ -0,0 +1,166 @@
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+
+logger = logging.getLogger(__file__)  # noqa: invalid-name
+
+# the default maximum number of open connections per pool
+DEFAULT_MAX_POOL_SIZE = 8
+
+# the default number of seconds to wait for a connection when the pool is exhausted
+DEFAULT_POOL_TIMEOUT = 30
+
+# connections that have been idle for longer than this many seconds are checked before being reused
+DEFAULT_HEALTH_CHECK_INTERVAL = 10
+
+
+class PoolTimeoutError(RuntimeError):
+    pass
+
+
+class PoolClosedError(RuntimeError):
+    pass
+
+
+class ConnectionPool():
+    """A thread-safe pool of psycopg2 connections.
+
+    At most 'max_size' connections are open at once -- getconn blocks for up to 'timeout'
+    seconds when they are all checked out. Connections that have been idle for more than
+    'health_check_interval' seconds are pinged before they are handed out, and broken
+    connections are replaced. Connections that are returned mid-transaction are rolled back,
+    and session settings (eg SET search_path) are reset so that they don't leak to the next user.
+    """
+    def __init__(self, connect, max_size=DEFAULT_MAX_POOL_SIZE, timeout=DEFAULT_POOL_TIMEOUT,
+                 health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL):
+        if max_size < 1:
+            raise ValueError(f"max_size must be at least 1 (got {max_size})")
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        # (connection, time it was returned to the pool)
+        self._idle = collections.deque()
+        self._size = 0
+        self._cond = threading.Condition()
+        self.closed = False
+
+    @property
+    def size(self):
+        """The number of open connections (both idle and checked out)."""
+        return self._size
+
+    def _is_healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            if not conn.autocommit:
+                conn.rollback()
+            return True
+        except Exception as inst:
+            logger.debug(f"Discarding pooled connection that failed a health check: {inst}")
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                while True:
+                    if self.closed:
+                        raise PoolClosedError("The connection pool is closed")
+                    if self._idle:
+                        # take the most recently used connection, it's the least likely to be stale
+                        conn, idle_since = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        conn = None
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeoutError(
+                            f"Timed out after {self.timeout} seconds waiting for one of {self.max_size} connections")
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                try:
+                    return self._connect()
+                except BaseException:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            if self._is_healthy(conn, idle_since):
+                return conn
+            self._discard(conn)
+
+    def _reset_session(self, conn):
+        # undo SET and set_config(..., false) (eg from a pg_dump script); RESET ALL takes effect
+        # immediately in autocommit mode, rather than with the next commit
+        prev_autocommit = conn.autocommit
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("RESET ALL")
+        finally:
+            conn.autocommit = prev_autocommit
+
+    def putconn(self, conn):
+        broken = bool(conn.closed)
+        if not broken:
+            status = conn.get_transaction_status()
+            if status == TRANSACTION_STATUS_UNKNOWN:
+                broken = True
+            elif status != TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except Exception:
+                    broken = True
+        if not broken and not self.closed:
+            try:
+                self._reset_session(conn)
+            except Exception as inst:
+                logger.debug(f"Discarding pooled connection whose session couldn't be reset: {inst}")
+                broken = True
+        if broken or self.closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Check out a connection for the duration of a with block."""
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def close(self):
+        """Close all of the idle connections. Checked out connections are closed when they are returned."""
+        with self._cond:
+            self.closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._cond.notify_all()
+        for conn in idle:
+            self._discard(conn)
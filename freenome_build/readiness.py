@@ -0,0 +1,182 @@
+"""Detect when a freshly started postgres server is ready to accept connections.
+
+Readiness is established in two stages:
+1) a cheap TCP connect to check that something is listening on host:port
+2) a postgres protocol level check -- we send a StartupMessage and look at the
+   first response from the server (this is what pg_isready does)
+
+Between attempts we back off exponentially with jitter. If a log stream is
+available (eg 'docker logs -f') we watch it for the "ready to accept connections"
+line and re-check immediately when it appears instead of waiting out the delay.
+"""
+import logging
+import random
+import shlex
+import socket
+import struct
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__file__)  # noqa: invalid-name
+
+# the line that postgres logs once it is accepting connections
+READY_LOG_LINE = 'ready to accept connections'
+
+# postgres protocol version 3.0
+_PROTOCOL_VERSION = 196608
+
+# SQLSTATE for 'cannot_connect_now' -- returned while the server is starting up
+_CANNOT_CONNECT_NOW = '57P03'
+
+
+class DbNotReadyError(RuntimeError):
+    pass
+
+
+def tcp_probe(host: str, port: int, timeout: float = 1.0) -> bool:
+    """Return True if we can open a TCP connection to host:port."""
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def _build_startup_message(user: str, dbname: str) -> bytes:
+    params = b''
+    for key, value in (('user', user), ('database', dbname)):
+        params += key.encode() + b'\x00' + value.encode() + b'\x00'
+    params += b'\x00'
+    body = struct.pack('!i', _PROTOCOL_VERSION) + params
+    return struct.pack('!i', len(body) + 4) + body
+
+
+def _parse_error_fields(payload: bytes) -> dict:
+    fields = {}
+    for field in payload.split(b'\x00'):
+        if field:
+            fields[chr(field[0])] = field[1:].decode(errors='replace')
+    return fields
+
+
+def _recv_exactly(sock: socket.socket, num_bytes: int) -> bytes:
+    data = b''
+    while len(data) < num_bytes:
+        chunk = sock.recv(num_bytes - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by the server")
+        data += chunk
+    return data
+
+
+def postgres_probe(host: str, port: int, user: str = 'postgres', dbname: str = 'postgres',
+                   timeout: float = 1.0) -> bool:
+    """Return True if the postgres server at host:port is accepting connections.
+
+    We don't authenticate -- any response other than 'the database system is
+    starting up' means that the server is ready to accept connections.
+    """
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.sendall(_build_startup_message(user, dbname))
+            msg_type = _recv_exactly(sock, 1)
+            msg_len, = struct.unpack('!i', _recv_exactly(sock, 4))
+            payload = _recv_exactly(sock, msg_len - 4)
+    except OSError as inst:
+        logger.debug(f"Postgres probe of '{host}:{port}' failed: {inst}")
+        return False
+
+    if msg_type == b'E':
+        fields = _parse_error_fields(payload)
+        if fields.get('C') == _CANNOT_CONNECT_NOW:
+            logger.debug(f"DB cluster at '{host}:{port}' is starting up: {fields.get('M')}")
+            return False
+    return True
+
+
+def backoff_delays(initial_delay: float = 0.05, max_delay: float = 1.0, factor: float = 2.0,
+                   jitter: float = 0.5):
+    """Yield an infinite sequence of exponentially increasing, jittered delays.
+
+    Each delay is the un-jittered delay scaled by a random factor in [1-jitter, 1].
+    """
+    delay = initial_delay
+    while True:
+        yield delay * (1 - jitter * random.random())
+        delay = min(delay * factor, max_delay)
+
+
+class LogWatcher():
+    """Watch the output of a log streaming command for a line containing 'pattern'.
+
+    'event' is set every time a matching line is seen.
+    """
+    def __init__(self, cmd: str, pattern: str = READY_LOG_LINE):
+        self.cmd = cmd
+        self.pattern = pattern
+        self.event = threading.Event()
+        self._proc = None
+        self._thread = None
+
+    def _watch(self):
+        for line in self._proc.stdout:
+            if self.pattern in line.decode(errors='replace'):
+                logger.debug(f"Saw '{self.pattern}' in the output of '{self.cmd}'")
+                self.event.set()
+
+    def start(self):
+        try:
+            self._proc = subprocess.Popen(
+                shlex.split(self.cmd), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        # eg docker isn't on the PATH. The log is only a hint, so carry on without it
+        except OSError as inst:
+            logger.warning(f"Failed to run '{self.cmd}', not watching its output: {inst}")
+            return self
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.kill()
+            self._proc.wait()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def wait_for_postgres(host: str, port: int, max_wait_time: float, initial_delay: float = 0.05,
+                      max_delay: float = 1.0, log_cmd: str = None) -> None:
+    """Block until the postgres server at host:port accepts connections.
+
+    If 'log_cmd' is set, it should stream the server log to stdout (eg
+    'docker logs -f $CONTAINER'). Seeing the ready line wakes us up immediately.
+
+    Raises DbNotReadyError if the server is not ready within 'max_wait_time' seconds.
+    """
+    watcher = LogWatcher(log_cmd).start() if log_cmd is not None else None
+    wakeup = watcher.event if watcher is not None else threading.Event()
+    start = time.monotonic()
+    deadline = start + max_wait_time
+    try:
+        for delay in backoff_delays(initial_delay, max_delay):
+            if tcp_probe(host, port) and postgres_probe(host, port):
+                logger.debug(f"Database at '{host}:{port}' is up after {time.monotonic() - start:.2f} seconds!")
+                return
+            logger.debug(f"DB cluster at '{host}:{port}' is not yet up.")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            wakeup.wait(min(delay, remaining))
+            wakeup.clear()
+    finally:
+        if watcher is not None:
+            watcher.stop()
+
+    raise DbNotReadyError(f"Aborting because the DB did not start within {max_wait_time} seconds.")
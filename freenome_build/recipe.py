@@ -0,0 +1,82 @@
+import contextlib
+import os
+import re
+
+import conda_build.api
+import yaml
+
+from freenome_build.util import get_yaml_path
+
+# the sections of a rendered recipe's requirements that can refer to packages built by other recipes
+REQUIREMENT_SECTIONS = ('requirements/build', 'requirements/host', 'requirements/run')
+
+# the requirements that a development environment needs (the paths of the values in the rendered recipe)
+DEVELOP_REQUIREMENT_SECTIONS = ('requirements/host', 'requirements/run', 'test/requires')
+
+
+def read_meta_yaml(path, version='0'):
+    """Return the parsed conda-build/meta.yaml of the repo at 'path'.
+
+    This doesn't evaluate the recipe's jinja templating: statements are dropped, and
+    expressions are replaced with 'version' (they are almost always the version), which
+    is enough to read the package name. Use render_recipe to read the requirements.
+    """
+    with open(get_yaml_path(path)) as ifp:
+        data_template = ifp.read()
+    data_template = re.sub(r"{%.*?%}", "", data_template)
+    data_template = re.sub(r"{{.*?}}", version, data_template)
+    return yaml.safe_load(data_template)
+
+
+def requirement_specs(metadata, sections=REQUIREMENT_SECTIONS):
+    """Return the sorted requirement specs (eg 'numpy >=1.10') in 'sections' of a rendered recipe output."""
+    specs = set()
+    for section in sections:
+        for spec in metadata.get_value(section) or ():
+            specs.add(' '.join(str(spec).split()))
+    return sorted(specs)
+
+
+def requirement_names(metadata, sections=REQUIREMENT_SECTIONS):
+    """Return the names of the packages in 'sections' of a rendered recipe output."""
+    return {spec.split()[0] for spec in requirement_specs(metadata, sections)}
+
+
+@contextlib.contextmanager
+def _version_environ(version):
+    # recipes get the version from $VERSION (see build_packages_from_meta_yaml)
+    prev_version = os.environ.get('VERSION')
+    os.environ['VERSION'] = version
+    try:
+        yield
+    finally:
+        if prev_version is None:
+            del os.environ['VERSION']
+        else:
+            os.environ['VERSION'] = prev_version
+
+
+def render_recipe(path, version):
+    """Render the recipe in the repo at 'path' and return the MetaData of each of its outputs.
+
+    This evaluates the recipe's jinja templating and selectors with the real version,
+    like conda build does, but doesn't build anything or solve the build environments.
+    """
+    with _version_environ(version):
+        rendered = conda_build.api.render(
+            os.path.dirname(get_yaml_path(path)), finalize=False, bypass_env_check=True)
+    return [metadata for metadata, _, _ in rendered]
+
+
+def render_requirements(path, version, sections=DEVELOP_REQUIREMENT_SECTIONS):
+    """Render the recipe in the repo at 'path' and return (package name, requirement specs).
+
+    The requirements are the sorted specs in 'sections' of all of the recipe's outputs,
+    except for the packages that the recipe builds itself (see render_recipe).
+    """
+    all_metadata = render_recipe(path, version)
+    package_names = {metadata.name() for metadata in all_metadata}
+    specs = set()
+    for metadata in all_metadata:
+        specs.update(spec for spec in requirement_specs(metadata, sections) if spec.split()[0] not in package_names)
+    return all_metadata[0].name(), sorted(specs)
@@ -0,0 +1,207 @@
+import collections
+import io
+import logging
+import os
+import selectors
+import signal
+import subprocess
+import time
+
+logger = logging.getLogger(__file__)  # noqa: invalid-name
+
+# the default number of bytes of each of stdout and stderr that are kept in memory
+DEFAULT_CAPTURE_LIMIT = 1024*1024
+
+# partial lines longer than this are logged without waiting for the newline
+MAX_LOG_LINE_LENGTH = 64*1024
+
+# seconds to wait after SIGTERM before we SIGKILL a timed out process group
+KILL_GRACE_PERIOD = 5
+
+READ_SIZE = 64*1024
+
+
+class CommandError(subprocess.CalledProcessError, RuntimeError):
+    """Raised when a command exits with a non-zero return code.
+
+    'stdout' and 'stderr' hold the (bounded) tail of the command's output.
+    """
+    def __str__(self):
+        return f"'{self.cmd}' returned with error code {self.returncode}"
+
+
+class CommandTimeoutError(subprocess.TimeoutExpired, RuntimeError):
+    def __str__(self):
+        return f"'{self.cmd}' timed out after {self.timeout} seconds"
+
+
+class TailBuffer():
+    """Keep the last 'max_bytes' bytes written to it."""
+    def __init__(self, max_bytes=DEFAULT_CAPTURE_LIMIT):
+        self.max_bytes = max_bytes
+        self._chunks = collections.deque()
+        self._size = 0
+        self.truncated = False
+
+    def write(self, data):
+        if not data:
+            return
+        self._chunks.append(data)
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            excess = self._size - self.max_bytes
+            if len(self._chunks[0]) <= excess:
+                self._size -= len(self._chunks.popleft())
+            else:
+                self._chunks[0] = self._chunks[0][excess:]
+                self._size -= excess
+            self.truncated = True
+
+    def getvalue(self):
+        return b''.join(self._chunks)
+
+
+class LineLogger():
+    """Log the lines in a byte stream as they arrive."""
+    def __init__(self, prefix, log_level):
+        self.prefix = prefix
+        self.log_level = log_level
+        self._partial = b''
+
+    def _log(self, line):
+        logger.log(self.log_level, f"{self.prefix}{line.decode(errors='replace').rstrip()}")
+
+    def write(self, data):
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._log(line)
+        if len(self._partial) > MAX_LOG_LINE_LENGTH:
+            self._log(self._partial)
+            self._partial = b''
+
+    def flush(self):
+        if self._partial:
+            self._log(self._partial)
+            self._partial = b''
+
+
+def stdin_for_input(input):
+    """Return (the stdin argument for Popen, the bytes to write to stdin) for 'input'.
+
+    'input' may be None, bytes, str, or an open file object (which is rewound and used as stdin).
+    """
+    if input is None:
+        return None, None
+    elif isinstance(input, io.IOBase):
+        input.flush()
+        input.seek(0)
+        return input, None
+    elif isinstance(input, bytes):
+        return subprocess.PIPE, input
+    elif isinstance(input, str):
+        return subprocess.PIPE, input.encode()
+    else:
+        raise TypeError(f"Unsupported input type '{type(input)}'")
+
+
+def kill_process_group(proc, grace_period=KILL_GRACE_PERIOD):
+    """SIGTERM the process group that 'proc' leads, and SIGKILL it if it is still running after 'grace_period'."""
+    for sig, wait_time in ((signal.SIGTERM, grace_period), (signal.SIGKILL, None)):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            proc.wait(timeout=wait_time)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+
+def run_streaming(cmd, input=None, timeout=None, capture_limit=DEFAULT_CAPTURE_LIMIT,
+                  log_level=logging.INFO, check=True, env=None):
+    """Run 'cmd' in a shell, logging its stdout and stderr line by line as they are written.
+
+    Both streams are read concurrently, so a command that writes a lot to either one
+    can't dead lock. 'input' may be None, bytes, str, or an open file object. Only the
+    last 'capture_limit' bytes of each stream are kept in memory.
+
+    The command runs in its own process group. If it doesn't finish within 'timeout'
+    seconds (or we are interrupted) the whole group is killed. 'env' is the command's
+    environment (default: ours).
+
+    Returns a subprocess.CompletedProcess with the captured stdout and stderr. Raises
+    CommandError if 'check' is True and the command returns a non-zero exit code, and
+    CommandTimeoutError if the timeout expires.
+    """
+    stdin_pipe, stdin_data = stdin_for_input(input)
+    start = time.monotonic()
+    deadline = start + timeout if timeout is not None else None
+    proc = subprocess.Popen(
+        cmd, shell=True, stdin=stdin_pipe, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        start_new_session=True, env=env
+    )
+    captured = {'stdout': TailBuffer(capture_limit), 'stderr': TailBuffer(capture_limit)}
+    line_loggers = {
+        'stdout': LineLogger(f"[{proc.pid} stdout] ", log_level),
+        'stderr': LineLogger(f"[{proc.pid} stderr] ", log_level),
+    }
+
+    sel = selectors.DefaultSelector()
+    try:
+        sel.register(proc.stdout, selectors.EVENT_READ, 'stdout')
+        sel.register(proc.stderr, selectors.EVENT_READ, 'stderr')
+        stdin_view = None
+        if stdin_data is not None:
+            if stdin_data:
+                os.set_blocking(proc.stdin.fileno(), False)
+                sel.register(proc.stdin, selectors.EVENT_WRITE, 'stdin')
+                stdin_view = memoryview(stdin_data)
+            else:
+                proc.stdin.close()
+
+        while sel.get_map():
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    kill_process_group(proc)
+                    raise CommandTimeoutError(
+                        cmd, timeout, output=captured['stdout'].getvalue(), stderr=captured['stderr'].getvalue())
+            for key, _ in sel.select(timeout=remaining):
+                if key.data == 'stdin':
+                    try:
+                        written = os.write(key.fd, stdin_view[:READ_SIZE])
+                    except BrokenPipeError:
+                        written = len(stdin_view)
+                    stdin_view = stdin_view[written:]
+                    if not stdin_view:
+                        sel.unregister(key.fileobj)
+                        key.fileobj.close()
+                    continue
+                data = os.read(key.fd, READ_SIZE)
+                if not data:
+                    sel.unregister(key.fileobj)
+                    continue
+                captured[key.data].write(data)
+                line_loggers[key.data].write(data)
+
+        proc.wait()
+    except BaseException:
+        if proc.poll() is None:
+            kill_process_group(proc)
+        raise
+    finally:
+        sel.close()
+        for line_logger in line_loggers.values():
+            line_logger.flush()
+        for pipe in (proc.stdin, proc.stdout, proc.stderr):
+            if pipe is not None and not pipe.closed:
+                pipe.close()
+
+    logger.debug(f"'{cmd}' exited with code {proc.returncode} after {time.monotonic() - start:.2f} seconds")
+    stdout, stderr = captured['stdout'].getvalue(), captured['stderr'].getvalue()
+    if check and proc.returncode != 0:
+        raise CommandError(proc.returncode, cmd, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout=stdout, stderr=stderr)
@@ -0,0 +1,207 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+
+from freenome_build.data_manifest import (
+    CACHE_MODES,
+    DataManifestReader,
+    FileMismatchError,
+    MissingFileError,
+    hex_to_base64,
+    iter_file_blocks
+)
+
+logger = logging.getLogger(__file__)  # noqa: invalid-name
+
+DEFAULT_MAX_BYTES_PER_SECOND = 50*1024*1024
+# how long to wait between passes over the manifests
+DEFAULT_PASS_INTERVAL = 60*60
+
+_READ_SIZE = 1024*1024
+
+
+class RateLimiter():
+    """Limit a stream of work to 'max_per_second' units per second, by sleeping in 'consume'."""
+    def __init__(self, max_per_second, sleep=time.sleep, clock=time.monotonic):
+        self.max_per_second = max_per_second
+        self._sleep = sleep
+        self._clock = clock
+        self._start = None
+        self._consumed = 0
+
+    def consume(self, amount):
+        now = self._clock()
+        if self._start is None:
+            self._start = now
+        self._consumed += amount
+        # sleep until the work done so far fits under the rate
+        delay = self._consumed/self.max_per_second - (now - self._start)
+        if delay > 0:
+            self._sleep(delay)
+        # forget about idle time, so that it can't be used for a burst later
+        elif delay < -1:
+            self._start = now
+            self._consumed = 0
+
+
+def set_idle_io_priority():
+    """Lower this process's I/O (and CPU) priority, so that it only uses the disk when nothing else does."""
+    os.nice(19)
+    if shutil.which('ionice') is None:
+        logger.warning("'ionice' isn't installed, scrubbing with the normal I/O priority")
+        return
+    subprocess.run(['ionice', '-c', '3', '-p', str(os.getpid())], check=True)
+
+
+def throttled_md5sum(fname, rate_limiter, cache_mode='dontneed'):
+    """Return the (base64) md5sum of 'fname', reading it no faster than 'rate_limiter' allows."""
+    hasher = hashlib.md5()
+    for block in iter_file_blocks(fname, cache_mode, block_size=_READ_SIZE):
+        hasher.update(block)
+        rate_limiter.consume(len(block))
+    return hex_to_base64(hasher.hexdigest())
+
+
+class Scrubber():
+    """Continuously verify the md5sums of the local files in one or more data manifests.
+
+    'manifests' is a list of (manifest fname, local prefix). Files are hashed no faster than
+    'max_bytes_per_second', and are read according to 'cache_mode' (see CACHE_MODES; by
+    default they're dropped from the page cache). Mismatched, missing and unreadable files
+    are logged and passed to 'on_mismatch(manifest_fname, record, error)' as they are found.
+    Manifests that can't be read are reported with a record of None.
+
+    If 'checkpoint_fname' is set, progress is saved there after every file, and a restarted
+    scrubber resumes from where it stopped (a manifest that changed is started over).
+    """
+    def __init__(self, manifests, max_bytes_per_second=DEFAULT_MAX_BYTES_PER_SECOND, checkpoint_fname=None,
+                 on_mismatch=None, pass_interval=DEFAULT_PASS_INTERVAL, cache_mode='dontneed'):
+        self.manifests = [(os.path.abspath(fname), local_prefix) for fname, local_prefix in manifests]
+        self.rate_limiter = RateLimiter(max_bytes_per_second)
+        self.checkpoint_fname = checkpoint_fname
+        self.on_mismatch = on_mismatch
+        self.pass_interval = pass_interval
+        self.cache_mode = cache_mode
+        self._checkpoint = self._load_checkpoint()
+
+    def _load_checkpoint(self):
+        if self.checkpoint_fname is None:
+            return {}
+        try:
+            with open(self.checkpoint_fname) as ifp:
+                return json.load(ifp)
+        except FileNotFoundError:
+            return {}
+
+    def _save_checkpoint(self):
+        if self.checkpoint_fname is None:
+            return
+        with open(self.checkpoint_fname + '.tmp', 'w') as ofp:
+            json.dump(self._checkpoint, ofp)
+        os.replace(self.checkpoint_fname + '.tmp', self.checkpoint_fname)
+
+    def _report(self, manifest_fname, record, error):
+        """Report a bad file, or a manifest that couldn't be read (then 'record' is None)."""
+        if record is None:
+            logger.error(f"Failed to scrub '{manifest_fname}': {error}")
+        else:
+            logger.error(f"Scrubbing '{manifest_fname}' found a bad file: {error}")
+        if self.on_mismatch is not None:
+            self.on_mismatch(manifest_fname, record, error)
+
+    def _scrub_record(self, manifest_fname, local_prefix, record):
+        local_abs_path = os.path.join(local_prefix, record.relative_local_path)
+        try:
+            # check the size first, it's free
+            if not os.path.exists(local_abs_path):
+                raise MissingFileError(f"Can not find '{record.name}' at '{local_abs_path}'")
+            local_fsize = os.path.getsize(local_abs_path)
+            if local_fsize != int(record.size):
+                raise FileMismatchError(
+                    f"'{local_abs_path}' has size '{local_fsize}' vs '{record.size}' in the manifest")
+            local_md5sum = throttled_md5sum(local_abs_path, self.rate_limiter, self.cache_mode)
+            if local_md5sum != record.md5sum:
+                raise FileMismatchError(
+                    f"'{local_abs_path}' has md5sum '{local_md5sum}' vs '{record.md5sum}' in the manifest")
+        # an OSError (eg EIO from a bad sector) is as much a sign of a bad file as a mismatch
+        except (MissingFileError, FileMismatchError, OSError) as inst:
+            self._report(manifest_fname, record, inst)
+            return False
+        return True
+
+    def scrub_manifest(self, manifest_fname, local_prefix):
+        """Verify every file in one manifest, resuming from the checkpoint. Returns the number of bad files."""
+        manifest = DataManifestReader(manifest_fname, local_prefix, None)
+        progress = self._checkpoint.get(manifest_fname)
+        # start over if the manifest changed since the checkpoint
+        if progress is None or progress['md5sum'] != manifest._md5sum:
+            progress = {'md5sum': manifest._md5sum, 'num_done': 0}
+        elif progress['num_done'] > 0:
+            logger.info(f"Resuming scrubbing '{manifest_fname}' after {progress['num_done']} files")
+        num_bad = 0
+        records = list(manifest.values())
+        for record in records[progress['num_done']:]:
+            if not self._scrub_record(manifest_fname, local_prefix, record):
+                num_bad += 1
+            progress['num_done'] += 1
+            self._checkpoint[manifest_fname] = progress
+            self._save_checkpoint()
+        # the next pass starts from the beginning
+        self._checkpoint[manifest_fname] = {'md5sum': manifest._md5sum, 'num_done': 0}
+        self._save_checkpoint()
+        logger.info(f"Scrubbed {len(records)} files in '{manifest_fname}', {num_bad} were bad")
+        return num_bad
+
+    def run(self, num_passes=None):
+        """Scrub all of the manifests 'num_passes' times (default: forever)."""
+        pass_i = 0
+        while num_passes is None or pass_i < num_passes:
+            for manifest_fname, local_prefix in self.manifests:
+                # one manifest that can't be read shouldn't stop the others from being scrubbed
+                try:
+                    self.scrub_manifest(manifest_fname, local_prefix)
+                except Exception as inst:
+                    self._report(manifest_fname, None, inst)
+            pass_i += 1
+            if num_passes is None or pass_i < num_passes:
+                time.sleep(self.pass_interval)
+
+
+def add_scrub_subparser(subparsers):
+    scrub_subparser = subparsers.add_parser(
+        'scrub', help='continuously verify the local files of data manifests in the background')
+    scrub_subparser.add_argument(
+        '--manifest', nargs=2, action='append', required=True, dest='manifests',
+        metavar=('MANIFEST', 'LOCAL_PREFIX'),
+        help='A manifest and the directory its files are in. Can be passed more than once')
+    scrub_subparser.add_argument(
+        '--max-bytes-per-second', type=int, default=DEFAULT_MAX_BYTES_PER_SECOND,
+        help=f"The maximum rate to read files at (default: {DEFAULT_MAX_BYTES_PER_SECOND})")
+    scrub_subparser.add_argument(
+        '--checkpoint', default=None, dest='checkpoint_fname',
+        help='Save progress to this file, and resume from it')
+    scrub_subparser.add_argument(
+        '--pass-interval', type=float, default=DEFAULT_PASS_INTERVAL,
+        help=f"Seconds to wait between passes over the manifests (default: {DEFAULT_PASS_INTERVAL})")
+    scrub_subparser.add_argument(
+        '--cache-mode', choices=CACHE_MODES, default='dontneed',
+        help="How to read files: 'dontneed' and 'direct' keep them out of the page cache (default: dontneed)")
+    scrub_subparser.add_argument(
+        '--once', action='store_true', default=False,
+        help='Scrub the manifests once and exit, rather than continuously')
+
+
+def scrub_main(args):
+    set_idle_io_priority()
+    scrubber = Scrubber(
+        args.manifests,
+        max_bytes_per_second=args.max_bytes_per_second,
+        checkpoint_fname=args.checkpoint_fname,
+        pass_interval=args.pass_interval,
+        cache_mode=args.cache_mode
+    )
+    scrubber.run(num_passes=1 if args.once else None)
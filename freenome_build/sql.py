@@ -0,0 +1,267 @@
+import io
+import logging
+import re
+
+logger = logging.getLogger(__file__)  # noqa: invalid-name
+
+# the number of statements to send to the server in a single round trip
+DEFAULT_BATCH_SIZE = 500
+
+# statements that postgres refuses to run inside of a transaction block
+_NON_TRANSACTIONAL_PAT = re.compile(
+    r"^\s*("
+    r"(CREATE|DROP)\s+(DATABASE|TABLESPACE)"
+    r"|ALTER\s+SYSTEM"
+    r"|VACUUM"
+    r"|(CREATE|DROP)\s+(UNIQUE\s+)?INDEX\s+CONCURRENTLY"
+    r"|REINDEX\s+.*CONCURRENTLY"
+    r")\b",
+    re.IGNORECASE | re.DOTALL
+)
+
+# statements that manage transactions explicitly
+_TRANSACTION_CONTROL_PAT = re.compile(
+    r"^\s*(BEGIN|START\s+TRANSACTION|COMMIT|END|ROLLBACK|ABORT)\b", re.IGNORECASE)
+
+_COPY_FROM_STDIN_PAT = re.compile(r"^\s*COPY\b.*\bFROM\s+STDIN\b", re.IGNORECASE | re.DOTALL)
+
+_DOLLAR_QUOTE_PAT = re.compile(r"\$([A-Za-z_][A-Za-z_0-9]*)?\$")
+
+
+class SqlScriptError(RuntimeError):
+    pass
+
+
+class CopyDataReader(io.RawIOBase):
+    """A file-like object over the inline data that follows a 'COPY ... FROM STDIN;' statement.
+
+    Lines are read lazily from 'lines' until the '\\.' terminator, so the data is
+    streamed to the server without being buffered in memory.
+    """
+    def __init__(self, lines):
+        self._lines = lines
+        self._buf = b''
+        self.done = False
+
+    def readable(self):
+        return True
+
+    def _next_line(self):
+        if self.done:
+            return b''
+        line = next(self._lines, None)
+        if line is None or line.rstrip('\r\n') == '\\.':
+            self.done = True
+            return b''
+        return line.encode()
+
+    def readline(self, size=-1):
+        if not self._buf:
+            self._buf = self._next_line()
+        line, self._buf = self._buf, b''
+        return line
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self._buf) < size):
+            self._buf += self._next_line()
+        if size < 0:
+            size = len(self._buf)
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def drain(self):
+        while not self.done:
+            self._next_line()
+
+
+def iter_sql_statements(lines):
+    """Split an iterable of lines of SQL into statements.
+
+    Yields (statement, copy_data) tuples where 'copy_data' is a CopyDataReader for
+    'COPY ... FROM STDIN' statements and None otherwise. 'copy_data' must be consumed
+    before advancing the iterator (it is drained automatically if it isn't).
+
+    Quoted strings, quoted identifiers, dollar quoting, and comments are respected.
+    psql meta-commands (lines starting with a backslash) are skipped.
+    """
+    lines = iter(lines)
+    stmt = []
+    # one of None, "'", '"', '--', '/*', or a dollar quote tag
+    state = None
+    escape_string = False
+    comment_depth = 0
+    for line in lines:
+        if state is None and not stmt and line.lstrip().startswith('\\'):
+            logger.warning(f"Skipping psql meta-command: '{line.strip()}'")
+            continue
+        i = 0
+        while i < len(line):
+            c = line[i]
+            if state is None:
+                # skip whitespace between statements
+                if not stmt and c.isspace():
+                    i += 1
+                    continue
+                if c == ';':
+                    statement = ''.join(stmt).strip()
+                    stmt = []
+                    if statement:
+                        if _COPY_FROM_STDIN_PAT.match(statement):
+                            copy_data = CopyDataReader(lines)
+                            yield statement, copy_data
+                            copy_data.drain()
+                        else:
+                            yield statement, None
+                    i += 1
+                    continue
+                if c == "'":
+                    state = "'"
+                    escape_string = i > 0 and line[i-1] in 'eE' and (i == 1 or not line[i-2].isalnum())
+                elif c == '"':
+                    state = '"'
+                elif line.startswith('--', i):
+                    # drop the comment
+                    break
+                elif line.startswith('/*', i):
+                    state = '/*'
+                    comment_depth = 1
+                    i += 2
+                    continue
+                elif c == '$':
+                    match = _DOLLAR_QUOTE_PAT.match(line, i)
+                    if match is not None and not (i > 0 and (line[i-1].isalnum() or line[i-1] == '_')):
+                        state = match.group(0)
+                        stmt.append(state)
+                        i = match.end()
+                        continue
+                stmt.append(c)
+                i += 1
+            elif state == '/*':
+                if line.startswith('*/', i):
+                    comment_depth -= 1
+                    i += 2
+                    if comment_depth == 0:
+                        state = None
+                        if stmt:
+                            stmt.append(' ')
+                    continue
+                if line.startswith('/*', i):
+                    comment_depth += 1
+                    i += 2
+                    continue
+                i += 1
+            elif state in ("'", '"'):
+                stmt.append(c)
+                if state == "'" and escape_string and c == '\\' and i + 1 < len(line):
+                    stmt.append(line[i+1])
+                    i += 2
+                    continue
+                if c == state:
+                    # a doubled quote is an escaped quote
+                    if i + 1 < len(line) and line[i+1] == state:
+                        stmt.append(state)
+                        i += 2
+                        continue
+                    state = None
+                i += 1
+            else:
+                # inside a dollar quoted string
+                if line.startswith(state, i):
+                    stmt.append(state)
+                    i += len(state)
+                    state = None
+                    continue
+                stmt.append(c)
+                i += 1
+        # keep the newline so that statements stay readable in error messages
+        if stmt and not stmt[-1].endswith('\n'):
+            stmt.append('\n')
+
+    statement = ''.join(stmt).strip()
+    if state not in (None, '/*'):
+        raise SqlScriptError(f"Unterminated quoted string in SQL script: '{statement[:80]}'")
+    if statement:
+        yield statement, None
+
+
+def execute_sql_script(conn, script, stop_on_error=True, batch_size=DEFAULT_BATCH_SIZE):
+    """Execute the SQL in 'script' (a file-like object or a string) over 'conn'.
+
+    If 'stop_on_error' is True (the equivalent of psql's ON_ERROR_STOP) statements are
+    sent to the server in batches of 'batch_size' and the whole script runs in one
+    transaction (statements that can't run in a transaction, eg CREATE DATABASE, commit
+    the open transaction and then run on their own). Scripts that manage their own
+    transactions run in autocommit mode.
+
+    If 'stop_on_error' is False then, like psql's default, each statement is run in its
+    own transaction and errors are logged and skipped.
+
+    'COPY ... FROM STDIN' statements stream their inline data to the server.
+    """
+    if isinstance(script, str):
+        script = io.StringIO(script)
+
+    prev_autocommit = conn.autocommit
+    conn.autocommit = not stop_on_error
+    batch = []
+    num_statements = 0
+
+    def flush():
+        if batch:
+            with conn.cursor() as cur:
+                cur.execute(";\n".join(batch))
+            batch.clear()
+
+    try:
+        for statement, copy_data in iter_sql_statements(script):
+            num_statements += 1
+            if not stop_on_error:
+                try:
+                    with conn.cursor() as cur:
+                        if copy_data is not None:
+                            cur.copy_expert(statement, copy_data)
+                        else:
+                            cur.execute(statement)
+                except conn.DatabaseError as inst:
+                    logger.error(f"Error executing '{statement}': {str(inst).strip()}")
+                continue
+
+            if _TRANSACTION_CONTROL_PAT.match(statement) and not conn.autocommit:
+                # the script manages its own transactions from here on
+                flush()
+                conn.commit()
+                conn.autocommit = True
+            elif _NON_TRANSACTIONAL_PAT.match(statement):
+                # run this statement on its own, a batch runs in an implicit transaction even in
+                # autocommit mode. Outside of autocommit mode commit the open transaction first.
+                flush()
+                in_transaction = not conn.autocommit
+                if in_transaction:
+                    conn.commit()
+                    conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(statement)
+                conn.autocommit = not in_transaction
+                continue
+
+            if copy_data is not None:
+                flush()
+                with conn.cursor() as cur:
+                    cur.copy_expert(statement, copy_data)
+                continue
+
+            batch.append(statement)
+            if len(batch) >= batch_size:
+                flush()
+        flush()
+        if not conn.autocommit:
+            conn.commit()
+    except Exception:
+        if not conn.autocommit:
+            conn.rollback()
+        raise
+    finally:
+        conn.autocommit = prev_autocommit
+
+    logger.debug(f"Executed {num_statements} SQL statements")
+    return num_statements
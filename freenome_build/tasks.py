@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import os
+import signal
+import subprocess
+import time
+from collections import OrderedDict, namedtuple
+
+from freenome_build.runner import (
+    CommandError,
+    CommandTimeoutError,
+    DEFAULT_CAPTURE_LIMIT,
+    KILL_GRACE_PERIOD,
+    LineLogger,
+    READ_SIZE,
+    TailBuffer,
+    stdin_for_input
+)
+from freenome_build.trace import span
+
+logger = logging.getLogger(__file__)  # noqa: invalid-name
+
+Task = namedtuple('Task', ['name', 'action', 'deps', 'pool'])
+
+
+class TaskFailedError(RuntimeError):
+    """Raised by TaskGraph.run when a task fails. The task's exception is '__cause__'."""
+    def __init__(self, task_name, cause):
+        self.task_name = task_name
+        super().__init__(f"Task '{task_name}' failed: {cause}")
+
+
+async def _kill_process_group_async(proc, grace_period=KILL_GRACE_PERIOD):
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            await asyncio.wait_for(proc.wait(), grace_period)
+            return
+        except asyncio.TimeoutError:
+            continue
+
+
+async def run_command_async(cmd, input=None, timeout=None, capture_limit=DEFAULT_CAPTURE_LIMIT,
+                            log_prefix=None, log_level=logging.INFO, check=True):
+    """The asyncio version of freenome_build.runner.run_streaming.
+
+    Output lines are logged with 'log_prefix' (default: the pid) so that the logs of
+    concurrent commands can be told apart. If the coroutine is cancelled the command's
+    process group is killed.
+    """
+    stdin_pipe, stdin_data = stdin_for_input(input)
+    start = time.monotonic()
+    proc = await asyncio.create_subprocess_shell(
+        cmd, stdin=stdin_pipe, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+    if log_prefix is None:
+        log_prefix = str(proc.pid)
+    captured = {'stdout': TailBuffer(capture_limit), 'stderr': TailBuffer(capture_limit)}
+    line_loggers = {
+        'stdout': LineLogger(f"[{log_prefix} stdout] ", log_level),
+        'stderr': LineLogger(f"[{log_prefix} stderr] ", log_level),
+    }
+
+    async def pump(stream, name):
+        while True:
+            data = await stream.read(READ_SIZE)
+            if not data:
+                return
+            captured[name].write(data)
+            line_loggers[name].write(data)
+
+    async def feed():
+        try:
+            proc.stdin.write(stdin_data)
+            await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            proc.stdin.close()
+
+    io_tasks = [pump(proc.stdout, 'stdout'), pump(proc.stderr, 'stderr')]
+    if stdin_data is not None:
+        io_tasks.append(feed())
+    try:
+        await asyncio.wait_for(asyncio.gather(*io_tasks), timeout)
+        await proc.wait()
+    except asyncio.TimeoutError:
+        await _kill_process_group_async(proc)
+        raise CommandTimeoutError(
+            cmd, timeout, output=captured['stdout'].getvalue(), stderr=captured['stderr'].getvalue())
+    except BaseException:
+        # this includes cancellation
+        if proc.returncode is None:
+            await _kill_process_group_async(proc)
+        raise
+    finally:
+        for line_logger in line_loggers.values():
+            line_logger.flush()
+
+    logger.debug(f"'{cmd}' exited with code {proc.returncode} after {time.monotonic() - start:.2f} seconds")
+    stdout, stderr = captured['stdout'].getvalue(), captured['stderr'].getvalue()
+    if check and proc.returncode != 0:
+        raise CommandError(proc.returncode, cmd, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout=stdout, stderr=stderr)
+
+
+class TaskGraph():
+    """Run a set of dependent steps, running independent steps concurrently.
+
+    A task's action is one of:
+    - a shell command string, run with run_command_async (the result is a CompletedProcess)
+    - a coroutine function, which is awaited
+    - any other callable, which is run in a worker thread
+
+    Actions are called without arguments (use functools.partial to bind them). A task
+    starts as soon as all of its dependencies have finished. At most 'max_concurrency'
+    tasks run at once, and at most 'pool_limits[pool]' tasks that were added with 'pool'
+    (eg to run fewer builds than uploads at once). If any task fails, all of the
+    other running tasks are cancelled (commands are killed) and TaskFailedError is raised.
+    Callables that are already running in a thread can't be interrupted, so they are left
+    to finish in the background.
+
+    eg:
+    graph = TaskGraph()
+    graph.add('build', "docker build -t db:latest .")
+    graph.add('cleanup', functools.partial(remove_old_container, 'db'))
+    graph.add('run', "docker run -d db:latest", deps=['build', 'cleanup'])
+    results = graph.run()
+    """
+    def __init__(self, max_concurrency=None, pool_limits=None):
+        self.max_concurrency = max_concurrency
+        self.pool_limits = dict(pool_limits or {})
+        self.tasks = OrderedDict()
+        # task name -> seconds that it took to run
+        self.durations = OrderedDict()
+
+    def add(self, name, action, deps=(), pool=None):
+        """Add a task. Dependencies must be added before the tasks that depend on them."""
+        if pool is not None and pool not in self.pool_limits:
+            raise ValueError(f"Task '{name}' is in unknown pool '{pool}'")
+        if name in self.tasks:
+            raise ValueError(f"Task '{name}' already exists")
+        for dep in deps:
+            if dep not in self.tasks:
+                raise ValueError(f"Task '{name}' depends on unknown task '{dep}'")
+        self.tasks[name] = Task(name, action, tuple(deps), pool)
+        return name
+
+    async def _execute(self, task):
+        if isinstance(task.action, str):
+            return await run_command_async(task.action, log_prefix=task.name)
+        elif asyncio.iscoroutinefunction(task.action):
+            return await task.action()
+        else:
+            return await asyncio.get_event_loop().run_in_executor(None, task.action)
+
+    async def _run_task(self, task, futures, semaphores):
+        # wait for our dependencies. If one fails we are cancelled by run_async
+        for dep in task.deps:
+            await asyncio.shield(futures[dep])
+        # always acquire the pool's semaphore first, so tasks can't dead lock
+        pools = [None] if task.pool is None else [task.pool, None]
+        task_semaphores = [semaphores[pool] for pool in pools if semaphores[pool] is not None]
+        acquired = []
+        try:
+            for semaphore in task_semaphores:
+                await semaphore.acquire()
+                acquired.append(semaphore)
+            logger.info(f"Starting task '{task.name}'")
+            start = time.monotonic()
+            try:
+                # tasks run concurrently on the event loop's thread, so each gets its own track
+                with span(task.name, track=task.name):
+                    result = await self._execute(task)
+            except asyncio.CancelledError:
+                raise
+            except Exception as inst:
+                raise TaskFailedError(task.name, inst) from inst
+            self.durations[task.name] = time.monotonic() - start
+            logger.info(f"Finished task '{task.name}' in {self.durations[task.name]:.2f} seconds")
+            return result
+        finally:
+            for semaphore in acquired:
+                semaphore.release()
+
+    async def run_async(self):
+        """Run all of the tasks and return a dict mapping task name to the task's result."""
+        # pool name -> semaphore. None is the limit on all tasks
+        semaphores = {pool: asyncio.Semaphore(limit) for pool, limit in self.pool_limits.items()}
+        semaphores[None] = asyncio.Semaphore(self.max_concurrency) if self.max_concurrency else None
+        futures = OrderedDict()
+        for task in self.tasks.values():
+            futures[task.name] = asyncio.ensure_future(self._run_task(task, futures, semaphores))
+        if not futures:
+            return OrderedDict()
+
+        done, pending = await asyncio.wait(list(futures.values()), return_when=asyncio.FIRST_EXCEPTION)
+        failed = [future for future in futures.values()
+                  if future in done and not future.cancelled() and future.exception() is not None]
+        if failed:
+            for future in pending:
+                future.cancel()
+            # wait for the cancelled tasks to clean up (eg kill their commands)
+            await asyncio.gather(*pending, return_exceptions=True)
+            raise failed[0].exception()
+        return OrderedDict((name, future.result()) for name, future in futures.items())
+
+    def run(self):
+        """Run all of the tasks in a new event loop. See run_async.
+
+        On python < 3.8 commands can only be run from the main thread.
+        """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(self.run_async())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
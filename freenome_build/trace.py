@@ -0,0 +1,123 @@
+import contextlib
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__file__)  # noqa: invalid-name
+
+# the active tracer, or None if tracing is disabled
+_tracer = None
+
+
+class Tracer():
+    """Collect spans as Chrome trace events.
+
+    Spans are recorded as complete ('X') events. Spans on the same thread nest by time, so
+    they are shown as a call tree in chrome://tracing or https://ui.perfetto.dev. Spans
+    that run concurrently on one thread (eg asyncio tasks) should each pass a 'track' name,
+    which gives them their own row in the trace.
+    """
+    def __init__(self):
+        self.pid = os.getpid()
+        self._events = []
+        self._tracks = {}
+        self._lock = threading.Lock()
+        # trace timestamps are in microseconds since the epoch, so traces from different
+        # runs can be lined up. Durations are measured with the monotonic clock.
+        self._epoch_offset = time.time() - time.perf_counter()
+
+    def _tid(self, track):
+        if track is None:
+            return threading.get_ident()
+        with self._lock:
+            if track not in self._tracks:
+                # thread ids are large, so small integers won't collide with them
+                tid = self._tracks[track] = len(self._tracks) + 1
+                self._events.append({
+                    'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': track}
+                })
+            return self._tracks[track]
+
+    def add_span(self, name, start, end, track=None, args=None):
+        """Record a span. 'start' and 'end' are time.perf_counter() values."""
+        event = {
+            'name': name,
+            'ph': 'X',
+            'pid': self.pid,
+            'tid': self._tid(track),
+            'ts': round((self._epoch_offset + start) * 1e6),
+            'dur': round((end - start) * 1e6),
+        }
+        if args:
+            event['args'] = args
+        with self._lock:
+            self._events.append(event)
+
+    @property
+    def events(self):
+        with self._lock:
+            return list(self._events)
+
+    def write(self, path):
+        trace = {
+            'traceEvents': self.events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'argv': sys.argv},
+        }
+        with open(path, 'w') as ofp:
+            json.dump(trace, ofp)
+        logger.info(f"Wrote {len(trace['traceEvents'])} trace events to '{path}'")
+
+
+def enable_tracing():
+    """Start recording spans and return the Tracer."""
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer()
+    return _tracer
+
+
+def disable_tracing():
+    global _tracer
+    _tracer = None
+
+
+def get_tracer():
+    """Return the active Tracer, or None if tracing is disabled."""
+    return _tracer
+
+
+@contextlib.contextmanager
+def span(name, track=None, **args):
+    """Record the time spent in a with block as a span named 'name'.
+
+    Keyword arguments are stored with the span. If the block raises, the span is marked
+    with the error. This is a no-op if tracing is disabled.
+    """
+    tracer = _tracer
+    if tracer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as inst:
+        args['error'] = f"{type(inst).__name__}: {inst}"
+        raise
+    finally:
+        tracer.add_span(name, start, time.perf_counter(), track=track, args=args)
+
+
+def traced(name):
+    """Decorator that records each call of a function as a span named 'name'."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from freenome_build.readiness import backoff_delays
+from freenome_build.trace import span
+from freenome_build.util import run_and_log
+
+logger = logging.getLogger(__file__)  # noqa: invalid-name
+
+ANACONDA_API_URL = 'https://api.anaconda.org'
+
+DEFAULT_MAX_PARALLEL_UPLOADS = 4
+DEFAULT_MAX_UPLOAD_ATTEMPTS = 5
+DEFAULT_INITIAL_RETRY_DELAY = 1.0
+DEFAULT_MAX_RETRY_DELAY = 30.0
+
+_HASH_BLOCK_SIZE = 1024*1024
+
+UploadReport = namedtuple('UploadReport', ['uploaded', 'skipped', 'num_bytes', 'seconds'])
+
+
+class UploadError(RuntimeError):
+    pass
+
+
+def md5_checksum(path):
+    hasher = hashlib.md5()
+    with open(path, 'rb') as ifp:
+        while True:
+            block = ifp.read(_HASH_BLOCK_SIZE)
+            if not block:
+                return hasher.hexdigest()
+            hasher.update(block)
+
+
+def package_basename(package_path):
+    """Return the channel relative name of a package file, eg 'linux-64/pkg-1.0-0.tar.bz2'."""
+    return '/'.join([os.path.basename(os.path.dirname(package_path)), os.path.basename(package_path)])
+
+
+def parse_package_filename(package_path):
+    """Return (name, version, build string) for a conda package file."""
+    filename = os.path.basename(package_path)
+    for extension in ('.tar.bz2', '.conda'):
+        if filename.endswith(extension):
+            filename = filename[:-len(extension)]
+            break
+    name, version, build = filename.rsplit('-', 2)
+    return name, version, build
+
+
+class AnacondaChannel():
+    """A channel on anaconda.org that belongs to 'owner'."""
+    def __init__(self, owner, token, api_url=ANACONDA_API_URL):
+        self.owner = owner
+        self.token = token
+        self.api_url = api_url
+        self.name = owner
+
+    def remote_checksum(self, package_path):
+        """Return the md5 of the channel's copy of 'package_path', or None if it doesn't have one."""
+        name, version, _ = parse_package_filename(package_path)
+        url = f"{self.api_url}/dist/{self.owner}/{name}/{version}/{package_basename(package_path)}"
+        request = urllib.request.Request(url, headers={'Authorization': f"token {self.token}"})
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return json.loads(response.read().decode()).get('md5')
+        except urllib.error.HTTPError as inst:
+            if inst.code == 404:
+                return None
+            raise
+
+    def upload(self, package_path):
+        # pass the token in the environment, so that it isn't in the logs or traces
+        run_and_log(
+            f"anaconda -t \"$ANACONDA_API_TOKEN\" upload --force -u {self.owner} {package_path}",
+            env=dict(os.environ, ANACONDA_API_TOKEN=self.token)
+        )
+
+
+class LocalChannel():
+    """A channel directory on the local file system.
+
+    This stands in for anaconda.org when testing, or when packages are shared through a
+    file system (point conda at it with 'conda index' and '-c file://...').
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.name = 'file://' + self.path
+
+    def remote_checksum(self, package_path):
+        try:
+            return md5_checksum(os.path.join(self.path, package_basename(package_path)))
+        except FileNotFoundError:
+            return None
+
+    def upload(self, package_path):
+        dest_path = os.path.join(self.path, package_basename(package_path))
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        # copy then rename, so that the channel never has a partial package in it
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path), prefix='.upload.')
+        os.close(fd)
+        try:
+            shutil.copyfile(package_path, tmp_path)
+            os.replace(tmp_path, dest_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+class Uploader():
+    """Upload packages to a channel concurrently.
+
+    Packages that the channel already has an identical copy of (with the same md5) are
+    skipped. Failed checks and uploads are retried up to 'max_attempts' times with
+    exponential backoff.
+    """
+    def __init__(self, channel, max_workers=DEFAULT_MAX_PARALLEL_UPLOADS, max_attempts=DEFAULT_MAX_UPLOAD_ATTEMPTS,
+                 initial_delay=DEFAULT_INITIAL_RETRY_DELAY, max_delay=DEFAULT_MAX_RETRY_DELAY):
+        self.channel = channel
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+
+    def _with_retries(self, description, func, *args):
+        delays = backoff_delays(self.initial_delay, self.max_delay)
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return func(*args)
+            except Exception as inst:
+                if attempt == self.max_attempts:
+                    raise UploadError(f"Failed to {description} after {attempt} attempts: {inst}") from inst
+                delay = next(delays)
+                logger.warning(f"Failed to {description} (attempt {attempt} of {self.max_attempts}), "
+                               f"retrying in {delay:.1f} seconds: {inst}")
+                time.sleep(delay)
+
+    def upload_package(self, package_path):
+        """Upload 'package_path' unless the channel already has it. Returns True if it was uploaded."""
+        checksum = md5_checksum(package_path)
+        basename = package_basename(package_path)
+        remote_checksum = self._with_retries(
+            f"check for '{basename}' in '{self.channel.name}'", self.channel.remote_checksum, package_path)
+        if remote_checksum == checksum:
+            logger.info(f"'{self.channel.name}' already has '{basename}', skipping the upload")
+            return False
+        if remote_checksum is not None:
+            logger.info(f"Replacing '{basename}' in '{self.channel.name}', its checksum doesn't match")
+        with span('upload', package=basename):
+            self._with_retries(f"upload '{basename}' to '{self.channel.name}'", self.channel.upload, package_path)
+        return True
+
+    def upload_all(self, package_paths):
+        """Upload all of 'package_paths' and return an UploadReport."""
+        # upload each package once, even if it's in the list more than once
+        package_paths = list(dict.fromkeys(package_paths))
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.upload_package, package_path) for package_path in package_paths]
+            # wait for all of the uploads so that a failure doesn't leave others running unreported
+            errors = []
+            results = []
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception as inst:
+                    errors.append(inst)
+                    results.append(None)
+        uploaded = [package_path for package_path, result in zip(package_paths, results) if result is True]
+        skipped = [package_path for package_path, result in zip(package_paths, results) if result is False]
+        report = UploadReport(
+            uploaded=uploaded,
+            skipped=skipped,
+            num_bytes=sum(os.path.getsize(package_path) for package_path in uploaded),
+            seconds=time.monotonic() - start
+        )
+        megabytes = report.num_bytes/(1024*1024)
+        logger.info(f"Uploaded {len(uploaded)} packages ({megabytes:.1f} MB) to '{self.channel.name}' in "
+                    f"{report.seconds:.1f} seconds ({megabytes/max(report.seconds, 1e-6):.1f} MB/s), "
+                    f"skipped {len(skipped)} that were already uploaded")
+        if errors:
+            raise errors[0]
+        return report
@@ -1,6 +1,6 @@
 import os
-import io
 import re
+import shlex
 import contextlib
 import subprocess
 import logging
@@ -9,6 +9,11 @@ import urllib
 import conda_build.api
 from conda_build.config import Config as CondaBuildConfig
 
+from freenome_build.build_cache import BuildCache
+from freenome_build.git_metadata import remote_repo_name
+from freenome_build.runner import run_streaming, DEFAULT_CAPTURE_LIMIT
+from freenome_build.trace import span, traced
+
 
 logger = logging.getLogger(__file__)  # noqa: invalid-name
 
@@ -48,47 +53,18 @@ def get_gcs_blob(gcp_project, remote_prefix, remote_relative_path):
     # return blob
 
 
-def run_and_log(cmd, input=None):
-    logger.info(f"Running '{cmd}'")
-
-    if input is None:
-        stdin_pipe = None
-    elif isinstance(input, io.IOBase):
-        input.flush()
-        input.seek(0)
-        stdin_pipe = input
-    elif isinstance(input, bytes):
-        stdin_pipe = subprocess.PIPE
-    elif isinstance(input, str):
-        input = input.encode()
-        stdin_pipe = subprocess.PIPE
-
-    proc = subprocess.Popen(
-        cmd, shell=True, stdin=stdin_pipe, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-    )
-    if stdin_pipe == subprocess.PIPE:
-        proc.stdin.write(input)
-    if proc.stdin:
-        proc.stdin.close()
-
-    stdout_tee_proc = subprocess.run(
-        ["tee", "/dev/stdout"], stdin=proc.stdout, stdout=subprocess.PIPE)
-    stderr_tee_proc = subprocess.run(
-        ["tee", "/dev/stderr"], stdin=proc.stderr, stdout=subprocess.PIPE)
-
-    if stderr_tee_proc.stdout:
-        logger.info(
-            f"Ran '{cmd}'\nSTDERR:\n{'='*80}\n{stderr_tee_proc.stdout.decode()}\n{'='*80}")
-    if stdout_tee_proc.stdout:
-        logger.info(
-            f"Ran '{cmd}'\nSTDOUT:\n{'='*80}\n{stdout_tee_proc.stdout.decode()}\n{'='*80}")
+def run_and_log(cmd, input=None, timeout=None, capture_limit=DEFAULT_CAPTURE_LIMIT, env=None):
+    """Run 'cmd' in a shell and log its output as it is written.
 
-    # raise an excpetion if the return code was non-zero
-    proc.wait()
-    if proc.returncode != 0:
-        raise RuntimeError(f"'{cmd}' returned with error code {proc.returncode}")
+    See freenome_build.runner.run_streaming for details. Raises CommandError (a
+    RuntimeError and a subprocess.CalledProcessError) if the command fails.
 
-    return proc
+    'cmd' is logged and recorded in traces, so it must not contain secrets. Pass them in
+    'env' instead, and refer to them in 'cmd' as shell variables (eg "$TOKEN").
+    """
+    logger.info(f"Running '{cmd}'")
+    with span('run', cmd=cmd):
+        return run_streaming(cmd, input=input, timeout=timeout, capture_limit=capture_limit, env=env)
 
 
 @contextlib.contextmanager
@@ -99,22 +75,21 @@ def change_directory(path):
     """
     prev_cwd = os.getcwd()
     os.chdir(path)
-    yield
-    os.chdir(prev_cwd)
+    try:
+        yield
+    finally:
+        os.chdir(prev_cwd)
 
 
 def get_git_repo_name(path):
-    with change_directory(path):
-        proc = subprocess.run(
-            "git config --get remote.origin.url",
-            shell=True, stdout=subprocess.PIPE, check=True
-        )
-        res = proc.stdout.decode().strip()
-        # extract the basename, and then strip '.git' off of the end
-        return os.path.basename(res)[:-4]
+    return remote_repo_name(path)
 
 
-def build_package_from_meta_yaml(path, version, skip_existing=False):
+def build_packages_from_meta_yaml(path, version, skip_existing=False):
+    """Build the recipe in 'path'/conda-build and return the paths of all of its packages.
+
+    Recipes with multiple outputs build more than one package.
+    """
     # Set the environment variable VERSION so that
     # the jinja2 templating works for the conda-build
     local_env = os.environ
@@ -129,11 +104,38 @@ def build_package_from_meta_yaml(path, version, skip_existing=False):
     )
     if len(output_file_paths) == 0:
         raise RuntimeError('No package was built.')
+    return output_file_paths
+
+
+def build_package_from_meta_yaml(path, version, skip_existing=False):
+    output_file_paths = build_packages_from_meta_yaml(path, version, skip_existing=skip_existing)
     assert len(output_file_paths) == 1, \
         "multiple file paths in conda build: {}".format(str(output_file_paths))
     return output_file_paths[0]
 
 
+def conda_build_cmd(path, version, skip_existing=False, output=False, channels=(), cpu_count=None):
+    """Return the shell command that builds the recipe in 'path'/conda-build in a new process.
+
+    This is the out of process version of build_packages_from_meta_yaml, so that several
+    recipes can be built at once. If 'output' is True the command prints the paths of the
+    packages that the recipe builds instead of building them. 'channels' are extra channels
+    to look for dependencies in, and 'cpu_count' is the number of CPUs that the build
+    scripts should use ($CPU_COUNT).
+    """
+    env = f"VERSION={shlex.quote(version)}"
+    if cpu_count is not None:
+        env += f" CPU_COUNT={cpu_count}"
+    cmd = f"{env} conda build --no-anaconda-upload"
+    if skip_existing:
+        cmd += " --skip-existing"
+    if output:
+        cmd += " --output"
+    for channel in channels:
+        cmd += f" -c {shlex.quote(channel)}"
+    return f"{cmd} {shlex.quote(os.path.dirname(get_yaml_path(path)))}"
+
+
 def build_package_using_distutils(path):
     proc = subprocess.run(
         "python setup.py bdist_conda",
@@ -151,7 +153,23 @@ def build_package_using_distutils(path):
     raise ValueError('Could not extract package file from stdout.')
 
 
-def build_package(path, version, skip_existing=False):
+@traced('conda-build')
+def build_packages(path, version, skip_existing=False, cache_key=None, build_cache=None):
+    """Build the conda package(s) for the repo at 'path' and return the paths of the package files.
+
+    If 'cache_key' is set (see freenome_build.build_cache.source_hash) and 'build_cache'
+    already has the packages for it, those are returned without building. Otherwise the
+    built packages are stored in the cache, and the cached copies are returned.
+    """
+    if cache_key is not None:
+        if build_cache is None:
+            build_cache = BuildCache()
+        cached_paths = build_cache.lookup(cache_key)
+        if cached_paths is not None:
+            logger.info(f"The sources at '{path}' haven't changed, using the cached packages {cached_paths}")
+            return cached_paths
+        return build_cache.store(cache_key, build_packages(path, version, skip_existing=skip_existing))
+
     try:
         yaml_path = get_yaml_path(path)
     except YamlNotFoundError:
@@ -159,6 +177,18 @@ def build_package(path, version, skip_existing=False):
 
     # if we can't find the yaml file, install using disttools bdist_conda
     if yaml_path is None:
-        return build_package_using_distutils(path)
+        return [build_package_using_distutils(path)]
     else:
-        return build_package_from_meta_yaml(path=path, version=version, skip_existing=skip_existing)
+        return build_packages_from_meta_yaml(path=path, version=version, skip_existing=skip_existing)
+
+
+def build_package(path, version, skip_existing=False, cache_key=None, build_cache=None):
+    """Build the conda package for the repo at 'path' and return the path of the package file.
+
+    See build_packages -- this is for recipes that build a single package.
+    """
+    output_file_paths = build_packages(
+        path, version, skip_existing=skip_existing, cache_key=cache_key, build_cache=build_cache)
+    assert len(output_file_paths) == 1, \
+        "multiple file paths in conda build: {}".format(str(output_file_paths))
+    return output_file_paths[0]
@@ -1,39 +1,129 @@
+import ast
 import logging
 import os
 import re
 import subprocess
+import threading
 
 from freenome_build import github
 
 
+# (abs path, repo name) -> (((version file, mtime), ...), version)
+_version_cache = {}
+_version_cache_lock = threading.Lock()
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _guess_repo_name(path):
+    # the repo's package is usually named after the repo's directory, which saves us from
+    # running git to find the repo name
+    return os.path.basename(os.path.abspath(path)).lower().replace('-', '_')
+
+
 def version(path, repo_name=None):
     """Return version id
 
+    The version is read statically from setup.py, the VERSION file, or the package's
+    __init__.py, and only falls back to running 'python setup.py --version'. Versions
+    are memoized until one of the files that they are read from changes.
+
     Args:
         repo_name: repo name (optional)
 
     Returns:
         (str): version id
     """
-    if repo_name is None:
-        repo_name = github.repo_name()
-
-    version = get_version_from_setup_py(path)
+    path = os.path.abspath(path)
+    with _version_cache_lock:
+        cached = _version_cache.get((path, repo_name))
+    if cached is not None and all(_mtime(fname) == mtime for fname, mtime in cached[0]):
+        return cached[1]
+
+    # (fname, mtime) of the files that the version is read from, stat'ed before they're read
+    version_files = []
+    version = _resolve_version(path, repo_name, version_files)
+    with _version_cache_lock:
+        _version_cache[(path, repo_name)] = (tuple(version_files), version)
+    return version
+
+
+def _resolve_version(path, repo_name, version_files):
+    for fname in ('setup.py', 'VERSION'):
+        version_files.append((os.path.join(path, fname), _mtime(os.path.join(path, fname))))
+    version = get_version_from_setup_py_ast(path)
     if version is not None:
         return version
 
-    version_from_init = get_version_from_init(path, repo_name)
     version_from_version_file = get_version_from_version_file(path)
-
-    assert version_from_init or version_from_version_file, "Version file cannot be found"
-    assert (version_from_init is not None) ^ (version_from_version_file is not None), "Multiple version files found"
-
+    if repo_name is None:
+        repo_name = _guess_repo_name(path)
+        # only run git to find the package when there's nothing else to read the version from
+        if version_from_version_file is None and not os.path.exists(os.path.join(path, repo_name, '__init__.py')):
+            repo_name = github.repo_name(path)
+    init_fname = os.path.join(path, repo_name, '__init__.py')
+    version_files.append((init_fname, _mtime(init_fname)))
+    version_from_init = get_version_from_init(path, repo_name)
+    assert (version_from_init is None) or (version_from_version_file is None), "Multiple version files found"
     if version_from_init:
         return version_from_init
     elif version_from_version_file:
         return version_from_version_file
-    else:
-        raise FileNotFoundError("Version file cannot be found.")
+
+    # setup.py computes the version, so we need to run it
+    version = get_version_from_setup_py(path)
+    if version is not None:
+        return version
+
+    raise FileNotFoundError("Version file cannot be found.")
+
+
+def _literal_str(node):
+    try:
+        value = ast.literal_eval(node)
+    except ValueError:
+        return None
+    return value if isinstance(value, str) else None
+
+
+def get_version_from_setup_py_ast(path):
+    """Return the version that setup.py passes to setup() if it's a literal, without running setup.py.
+
+    Handles 'setup(version="1.0")' and 'VERSION = "1.0" ... setup(version=VERSION)'.
+    Returns None if the version is computed, or if there's no setup.py.
+    """
+    try:
+        with open(os.path.join(path, 'setup.py')) as ifp:
+            tree = ast.parse(ifp.read())
+    except (FileNotFoundError, SyntaxError):
+        return None
+
+    # module level 'NAME = "literal"' assignments
+    literals = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            value = _literal_str(node.value)
+            if value is not None:
+                literals[node.targets[0].id] = value
+
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        func_name = getattr(node.func, 'id', None) or getattr(node.func, 'attr', None)
+        if func_name != 'setup':
+            continue
+        for keyword in node.keywords:
+            if keyword.arg != 'version':
+                continue
+            if isinstance(keyword.value, ast.Name):
+                return literals.get(keyword.value.id)
+            return _literal_str(keyword.value)
+    return None
 
 
 def get_version_from_setup_py(path):
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Compare the speed and page cache footprint of the data manifest hashing cache modes.
+
+For each mode the test file is dropped from the page cache, hashed, and then we report how
+much of it is left in the page cache (with util-linux's fincore).
+
+    python scripts/benchmark_md5sum.py --size-mb 2048 --dir /mnt/data
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from freenome_build.data_manifest import CACHE_MODES, calc_md5sum_from_fname
+
+
+def cached_bytes(fname):
+    if shutil.which('fincore') is None:
+        return None
+    output = subprocess.check_output(['fincore', '--bytes', '--noheadings', '--output', 'RES', fname])
+    return int(output.decode().split()[0])
+
+
+def drop_from_page_cache(fname):
+    with open(fname, 'rb') as ifp:
+        os.fsync(ifp.fileno())
+        os.posix_fadvise(ifp.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=1024, help='The size of the test file (default: 1024)')
+    parser.add_argument('--dir', default=None, help='Where to write the test file (default: $TMPDIR)')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile(dir=args.dir) as ofp:
+        block = os.urandom(1024*1024)
+        for _ in range(args.size_mb):
+            ofp.write(block)
+        ofp.flush()
+
+        print(f"{'mode':<10} {'seconds':>8} {'MB/s':>8} {'cached MB':>10}")
+        for cache_mode in CACHE_MODES:
+            for _ in range(args.repeats):
+                drop_from_page_cache(ofp.name)
+                start = time.monotonic()
+                calc_md5sum_from_fname(ofp.name, cache_mode=cache_mode)
+                seconds = time.monotonic() - start
+                cached = cached_bytes(ofp.name)
+                cached = 'n/a' if cached is None else f"{cached/(1024*1024):.0f}"
+                print(f"{cache_mode:<10} {seconds:>8.2f} {args.size_mb/seconds:>8.0f} {cached:>10}")
+
+
+if __name__ == '__main__':
+    main()
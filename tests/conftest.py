@@ -0,0 +1,24 @@
+import os
+
+import pytest
+
+from freenome_build.data_manifest import calc_md5sum_from_fname
+
+MANIFEST_HEADER = "variable_name\tlocal_path (relative)\tremote_path (absolute)\tmd5sum\tsize\tnotes\n"
+
+
+def _write_manifest(manifest_fname, local_prefix, files):
+    with open(manifest_fname, 'w') as ofp:
+        ofp.write(MANIFEST_HEADER)
+        for name, contents in files.items():
+            fname = os.path.join(local_prefix, f"{name}.txt")
+            with open(fname, 'wb') as data_ofp:
+                data_ofp.write(contents)
+            md5sum = calc_md5sum_from_fname(fname)
+            ofp.write(f"{name}\t{name}.txt\t{name}.txt\t{md5sum}\t{len(contents)}\t\n")
+
+
+@pytest.fixture
+def write_manifest():
+    """write_manifest(manifest_fname, local_prefix, {name: contents}) writes '{name}.txt' files and their manifest."""
+    return _write_manifest
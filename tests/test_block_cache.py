@@ -0,0 +1,59 @@
+import io
+import os
+
+import pytest
+
+from freenome_build.block_cache import BlockCache, RangeReader
+
+DATA = bytes(range(256))*10
+
+
+@pytest.fixture
+def fetches():
+    return []
+
+
+def _reader(fetches, block_cache, block_size=100):
+    def fetch_range(start, end):
+        fetches.append((start, end))
+        return DATA[start:end]
+    return RangeReader(fetch_range, len(DATA), 'data', block_cache, block_size=block_size)
+
+
+def test_range_reader(tmpdir, fetches):
+    reader = _reader(fetches, BlockCache(str(tmpdir)))
+    assert reader.read(10) == DATA[:10]
+    assert reader.seek(1234) == 1234
+    assert reader.read(300) == DATA[1234:1534]
+    assert reader.seek(-10, io.SEEK_END) == len(DATA) - 10
+    assert reader.read() == DATA[-10:]
+    assert reader.read(10) == b''
+    assert fetches == [(0, 100), (1200, 1300), (1300, 1400), (1400, 1500), (1500, 1600), (2500, 2560)]
+
+    # blocks are only fetched once, even by another reader
+    reader = io.BufferedReader(_reader(fetches, BlockCache(str(tmpdir))), buffer_size=100)
+    reader.seek(1250)
+    assert reader.read(100) == DATA[1250:1350]
+    assert len(fetches) == 6
+
+
+def test_block_cache_eviction(tmpdir, fetches):
+    block_cache = BlockCache(str(tmpdir), max_bytes=250)
+    reader = _reader(fetches, block_cache)
+    assert reader.read(300) == DATA[:300]
+    # the first block was evicted
+    assert sorted(os.listdir(str(tmpdir.join('data')))) == ['1', '2']
+    reader.seek(150)
+    assert reader.read(10) == DATA[150:160]
+    assert len(fetches) == 3
+    reader.seek(50)
+    assert reader.read(10) == DATA[50:60]
+    assert len(fetches) == 4
+    # block 2 was the least recently used
+    assert sorted(os.listdir(str(tmpdir.join('data')))) == ['0', '1']
+
+
+def test_range_reader_short_read(tmpdir):
+    reader = RangeReader(lambda start, end: b'', 100, 'data', BlockCache(str(tmpdir)), block_size=10)
+    with pytest.raises(IOError):
+        reader.read(10)
@@ -0,0 +1,94 @@
+import os
+import subprocess
+
+import conda_build.api
+import pytest
+
+from freenome_build import util
+from freenome_build.build_cache import BuildCache, source_hash
+
+
+@pytest.fixture
+def repo(tmpdir):
+    repo_path = str(tmpdir.mkdir('repo'))
+    os.makedirs(os.path.join(repo_path, 'conda-build'))
+    for fname, contents in (('setup.py', 'print("setup")\n'), ('conda-build/meta.yaml', 'package: {}\n')):
+        with open(os.path.join(repo_path, fname), 'w') as ofp:
+            ofp.write(contents)
+    subprocess.check_call('git init -q && git add setup.py', shell=True, cwd=repo_path)
+    return repo_path
+
+
+@pytest.fixture
+def build_cache(tmpdir, monkeypatch):
+    indexed = []
+    monkeypatch.setattr(conda_build.api, 'update_index', indexed.extend, raising=False)
+    return BuildCache(str(tmpdir.join('cache')))
+
+
+def _built_package(tmpdir):
+    package_path = str(tmpdir.mkdir('conda-bld').mkdir('linux-64').join('pkg-1.0-0.tar.bz2'))
+    with open(package_path, 'wb') as ofp:
+        ofp.write(b'PACKAGE')
+    return package_path
+
+
+def test_source_hash(repo):
+    key = source_hash(repo, '1.0')
+    assert source_hash(repo, '1.0') == key
+    assert source_hash(repo, '1.1') != key
+
+    # untracked files other than meta.yaml don't change the hash
+    with open(os.path.join(repo, 'notes.txt'), 'w') as ofp:
+        ofp.write('notes')
+    assert source_hash(repo, '1.0') == key
+
+    # uncommitted changes do
+    with open(os.path.join(repo, 'setup.py'), 'a') as ofp:
+        ofp.write('# comment\n')
+    assert source_hash(repo, '1.0') != key
+
+
+def test_source_hash_meta_yaml(repo):
+    key = source_hash(repo, '1.0')
+    with open(os.path.join(repo, 'conda-build/meta.yaml'), 'w') as ofp:
+        ofp.write('package: {name: pkg}\n')
+    assert source_hash(repo, '1.0') != key
+
+
+def test_source_hash_without_git(repo, monkeypatch):
+    monkeypatch.setenv('PATH', '')
+    key = source_hash(repo, '1.0')
+    # every file is hashed, so untracked files change the hash
+    with open(os.path.join(repo, 'notes.txt'), 'w') as ofp:
+        ofp.write('notes')
+    assert source_hash(repo, '1.0') != key
+
+
+def test_build_cache(tmpdir, build_cache):
+    assert build_cache.lookup('key') is None
+    cached_paths = build_cache.store('key', [_built_package(tmpdir)])
+    assert cached_paths == [os.path.join(build_cache.cache_dir, 'key', 'linux-64', 'pkg-1.0-0.tar.bz2')]
+    assert build_cache.lookup('key') == cached_paths
+    with open(cached_paths[0], 'rb') as ifp:
+        assert ifp.read() == b'PACKAGE'
+
+    assert not build_cache.is_uploaded('key', 'freenome')
+    build_cache.mark_uploaded('key', 'freenome')
+    assert build_cache.is_uploaded('key', 'freenome')
+    assert not build_cache.is_uploaded('key', 'other')
+
+
+def test_build_package_uses_cache(tmpdir, repo, build_cache, monkeypatch):
+    builds = []
+
+    def build_packages_from_meta_yaml(path, version, skip_existing):
+        builds.append(path)
+        return [_built_package(tmpdir.mkdir(f'build_{len(builds)}'))]
+    monkeypatch.setattr(util, 'build_packages_from_meta_yaml', build_packages_from_meta_yaml)
+
+    key = source_hash(repo, '1.0')
+    first_path = util.build_package(repo, '1.0', cache_key=key, build_cache=build_cache)
+    second_path = util.build_package(repo, '1.0', cache_key=key, build_cache=build_cache)
+    assert first_path == second_path
+    assert builds == [repo]
@@ -0,0 +1,190 @@
+import contextlib
+import gzip
+import os
+
+import pytest
+
+from freenome_build.bulk_load import (
+    dependency_levels,
+    find_data_files,
+    inspect_data_file,
+    load_data_dir,
+    TableDependencyCycleError
+)
+
+
+def test_inspect_tsv(tmpdir):
+    path = os.path.join(str(tmpdir), 'public.sample.tsv')
+    with open(path, 'w') as ofp:
+        ofp.write("id\tname\n1\ta\n")
+    data_file = inspect_data_file(path)
+    assert data_file.table == 'public.sample'
+    assert data_file.delimiter == '\t'
+    assert data_file.columns == ['id', 'name']
+    assert not data_file.compressed
+
+
+def test_inspect_gzipped_csv(tmpdir):
+    path = os.path.join(str(tmpdir), 'sample.csv.gz')
+    with gzip.open(path, 'wt') as ofp:
+        ofp.write('id,"a name"\n1,a\n')
+    data_file = inspect_data_file(path)
+    assert data_file.table == 'sample'
+    assert data_file.delimiter == ','
+    assert data_file.columns == ['id', 'a name']
+    assert data_file.compressed
+
+
+def test_inspect_sniffs_txt_delimiter(tmpdir):
+    path = os.path.join(str(tmpdir), 'sample.txt')
+    with open(path, 'w') as ofp:
+        ofp.write("id|name|value\n1|a|2\n")
+    assert inspect_data_file(path).delimiter == '|'
+
+
+def test_find_data_files_skips_unrecognized_files(tmpdir):
+    for fname in ('b.tsv', 'a.csv', 'README.md'):
+        with open(os.path.join(str(tmpdir), fname), 'w') as ofp:
+            ofp.write("id\n")
+    assert [data_file.table for data_file in find_data_files(str(tmpdir))] == ['a', 'b']
+
+
+def test_dependency_levels():
+    dependencies = {
+        'sample': {'subject'},
+        'subject': {'subject', 'site'},
+        'assay': set(),
+        'result': {'sample', 'assay', 'not_loaded'},
+    }
+    assert dependency_levels(['result', 'sample', 'subject', 'site', 'assay'], dependencies) == [
+        ['assay', 'site'], ['subject'], ['sample'], ['result']
+    ]
+
+
+def test_dependency_levels_cycle():
+    with pytest.raises(TableDependencyCycleError):
+        dependency_levels(['a', 'b'], {'a': {'b'}, 'b': {'a'}})
+
+
+class FakeCursor():
+    def __init__(self, db):
+        self.db = db
+        self.rowcount = -1
+        self._rows = []
+
+    def execute(self, sql, params=None):
+        # answer the catalog queries, and log everything else
+        if 'to_regclass' in sql:
+            self._rows = [(self.db.oids.get(params[0]), )]
+        elif 'FROM pg_index' in sql:
+            self._rows = self.db.indexes
+        elif 'FROM pg_constraint' in sql:
+            self._rows = self.db.foreign_keys
+        else:
+            self.db.log.append(('execute', sql))
+            if sql in self.db.fail_statements:
+                raise RuntimeError(f"{sql} failed")
+
+    def fetchone(self):
+        return self._rows[0]
+
+    def fetchall(self):
+        return self._rows
+
+    def copy_expert(self, sql, fp):
+        table = sql.split()[1]
+        self.db.log.append(('copy', table, sql[sql.index('WITH'):]))
+        if table in self.db.fail_copies:
+            raise RuntimeError(f"COPY into {table} failed")
+        self.rowcount = len(fp.read().splitlines())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeConnection():
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self):
+        return FakeCursor(self.db)
+
+    def commit(self):
+        self.db.log.append(('commit', ))
+
+
+class FakeDb():
+    """The catalog of a database with 'sample' referencing 'subject', and a log of what was run in it."""
+    def __init__(self, fail_copies=(), fail_statements=()):
+        self.oids = {'sample': 1, 'subject': 2}
+        self.foreign_keys = [(1, 2)]
+        self.indexes = [('sample_name_idx', 'CREATE INDEX sample_name_idx ON public.sample USING btree (name)')]
+        self.fail_copies = fail_copies
+        self.fail_statements = fail_statements
+        self.log = []
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield FakeConnection(self)
+
+
+@pytest.fixture
+def data_dir(tmpdir):
+    with open(os.path.join(str(tmpdir), 'sample.tsv'), 'w') as ofp:
+        ofp.write("id\tsubject_id\tname\n1\t1\ta\n2\t1\tb\n3\t2\tc\n")
+    with open(os.path.join(str(tmpdir), 'subject.csv'), 'w') as ofp:
+        ofp.write("id\n1\n2\n")
+    return str(tmpdir)
+
+
+def test_load_data_dir(data_dir):
+    db = FakeDb()
+    # one worker, so that the statements are logged in a deterministic order
+    assert load_data_dir(db.connection, data_dir, max_workers=1) == {'sample': 3, 'subject': 2}
+    assert db.log == [
+        ('execute', 'DROP INDEX sample_name_idx'),
+        ('commit', ),
+        # 'subject' is loaded first because 'sample' references it
+        ('copy', '"subject"', "WITH (FORMAT csv, DELIMITER E',')"),
+        ('commit', ),
+        ('copy', '"sample"', "WITH (FORMAT text, DELIMITER E'\t')"),
+        ('commit', ),
+        ('execute', db.indexes[0][1]),
+        ('commit', ),
+        ('execute', 'ANALYZE "sample"'),
+        ('commit', ),
+        ('execute', 'ANALYZE "subject"'),
+        ('commit', ),
+    ]
+
+
+def test_load_data_dir_rebuilds_indexes_after_a_failure(data_dir):
+    db = FakeDb(fail_copies=['"sample"'])
+    with pytest.raises(RuntimeError):
+        load_data_dir(db.connection, data_dir, max_workers=1)
+    assert db.log == [
+        ('execute', 'DROP INDEX sample_name_idx'),
+        ('commit', ),
+        ('copy', '"subject"', "WITH (FORMAT csv, DELIMITER E',')"),
+        ('commit', ),
+        ('copy', '"sample"', "WITH (FORMAT text, DELIMITER E'\t')"),
+        ('execute', db.indexes[0][1]),
+        ('commit', ),
+    ]
+
+
+def test_load_data_dir_raises_the_load_error_when_the_rebuild_fails(data_dir):
+    db = FakeDb(fail_copies=['"sample"'], fail_statements=[FakeDb().indexes[0][1]])
+    with pytest.raises(RuntimeError, match='COPY into "sample" failed'):
+        load_data_dir(db.connection, data_dir, max_workers=1)
+    # the rebuild was attempted
+    assert ('execute', db.indexes[0][1]) in db.log
+
+
+def test_load_data_dir_without_deferring_indexes(data_dir):
+    db = FakeDb()
+    assert load_data_dir(db.connection, data_dir, defer_indexes=False) == {'sample': 3, 'subject': 2}
+    assert not any('INDEX' in entry[1] for entry in db.log if entry[0] == 'execute')
@@ -1,9 +1,24 @@
+import errno
+import hashlib
 import os
 import pytest
 import tempfile
 import shutil
-
-from freenome_build.util import get_gcs_blob
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from freenome_build import data_manifest
+from freenome_build.block_cache import BlockCache
+from freenome_build.data_manifest import (
+    DataManifestReader,
+    DataManifestWriter,
+    FileAlreadyExistsError,
+    FileMismatchError,
+    KeyAlreadyExistsError,
+    MissingFileError,
+    calc_md5sum_from_fname
+)
+from freenome_build.util import get_gcs_blob, BlobNotFoundError
 # from freenome_build.data_manifest import DataManifest
 
 
@@ -40,6 +55,302 @@ def reset_test_manifest():
     shutil.copy(TEST_MANIFEST_FNAME+".orig", TEST_MANIFEST_FNAME)
 
 
+class FakeBlob():
+    """An in memory stand in for a google.cloud.storage.Blob."""
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+        self.md5_hash = None
+        self.size = None
+
+    def reload(self):
+        if self.path not in self.store:
+            raise BlobNotFoundError(self.path)
+        data = self.store[self.path]
+        self.size = len(data)
+        self.md5_hash = data_manifest.hex_to_base64(hashlib.md5(data).hexdigest())
+
+    def upload_from_file(self, fp, size=None):
+        chunks = []
+        while True:
+            chunk = fp.read(3)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.store[self.path] = b''.join(chunks)
+        self.reload()
+
+    def download_as_bytes(self, start=None, end=None):
+        return self.store[self.path][start:end + 1]
+
+    def download_to_file(self, fp):
+        data = self.store[self.path]
+        for i in range(0, len(data), 3):
+            fp.write(data[i:i+3])
+
+
+@pytest.fixture
+def fake_gcs(monkeypatch):
+    store = {}
+    monkeypatch.setattr(data_manifest._DataManifestBase, '_get_gcs_blob',
+                        lambda self, remote_relative_path: FakeBlob(store, remote_relative_path))
+    return store
+
+
+@pytest.fixture
+def manifest_fname(tmpdir, write_manifest):
+    fname = str(tmpdir.join('data-manifest.tsv'))
+    write_manifest(fname, str(tmpdir), {})
+    return fname
+
+
+def _write_data_file(tmpdir, name, contents):
+    fname = str(tmpdir.join(name))
+    with open(fname, 'wb') as ofp:
+        ofp.write(contents)
+    return fname
+
+
+def test_add_file_and_sync(tmpdir, fake_gcs, manifest_fname, monkeypatch):
+    fname = _write_data_file(tmpdir, 'eight_As.fa', b'>chr1\nAAAAAAAA\n')
+    # the md5sum is calculated as the file is uploaded, so we never read it separately
+    monkeypatch.setattr(data_manifest, 'calc_md5sum_from_fname', None)
+    writer = DataManifestWriter(manifest_fname, None, 'gs://bucket/')
+    writer.add_file('eight_As', fname, 'seqs/eight_As.fa', 'eight_As.fa')
+    monkeypatch.setattr(data_manifest, 'calc_md5sum_from_fname', calc_md5sum_from_fname)
+    assert writer['eight_As'].md5sum == calc_md5sum_from_fname(fname)
+    assert fake_gcs['eight_As.fa'] == b'>chr1\nAAAAAAAA\n'
+
+    local_prefix = str(tmpdir.join('local'))
+    reader = DataManifestReader(manifest_fname, local_prefix, 'gs://bucket/')
+    reader.sync(local_prefix)
+    with open(os.path.join(local_prefix, 'seqs/eight_As.fa'), 'rb') as ifp:
+        assert ifp.read() == b'>chr1\nAAAAAAAA\n'
+    reader.verify(local_prefix, check_md5sums=True)
+
+
+class RetryingBlob(FakeBlob):
+    """A FakeBlob whose upload fails partway through, and is resumed from an earlier offset."""
+    def upload_from_file(self, fp, size=None):
+        fp.read(7)
+        fp.seek(4)
+        fp.read(1)
+        fp.seek(2)
+        super().upload_from_file(fp, size=size)
+        self.store[self.path] = b'>c' + self.store[self.path]
+        self.reload()
+
+
+def test_add_file_resumed_upload(tmpdir, fake_gcs, manifest_fname, monkeypatch):
+    fname = _write_data_file(tmpdir, 'eight_As.fa', b'>chr1\nAAAAAAAA\n')
+    monkeypatch.setattr(data_manifest._DataManifestBase, '_get_gcs_blob',
+                        lambda self, remote_relative_path: RetryingBlob(fake_gcs, remote_relative_path))
+    writer = DataManifestWriter(manifest_fname, None, 'gs://bucket/')
+    # the re-read bytes aren't hashed again, so the md5sums match
+    writer.add_file('eight_As', fname, 'seqs/eight_As.fa', 'eight_As.fa')
+    assert writer['eight_As'].md5sum == calc_md5sum_from_fname(fname)
+    assert fake_gcs['eight_As.fa'] == b'>chr1\nAAAAAAAA\n'
+
+
+def test_add_existing_file(tmpdir, fake_gcs, manifest_fname):
+    fname = _write_data_file(tmpdir, 'eight_As.fa', b'AAAAAAAA')
+    fake_gcs['eight_As.fa'] = b'AAAAAAAA'
+    writer = DataManifestWriter(manifest_fname, None, 'gs://bucket/')
+    writer.add_file('eight_As', fname, 'eight_As.fa', 'eight_As.fa')
+    with pytest.raises(KeyAlreadyExistsError):
+        writer.add_file('eight_As', fname, 'eight_As.fa', 'eight_As.fa')
+
+    fake_gcs['eight_Cs.fa'] = b'CCCCCCCC'
+    with pytest.raises(FileAlreadyExistsError):
+        writer.add_file('eight_Cs', fname, 'eight_Cs.fa', 'eight_Cs.fa')
+
+
+def test_sync_verifies_downloads(tmpdir, fake_gcs, manifest_fname):
+    fname = _write_data_file(tmpdir, 'eight_As.fa', b'AAAAAAAA')
+    writer = DataManifestWriter(manifest_fname, None, 'gs://bucket/')
+    writer.add_file('eight_As', fname, 'eight_As.fa', 'eight_As.fa')
+
+    # corrupt the remote copy without changing its size
+    fake_gcs['eight_As.fa'] = b'AAAACAAA'
+    local_prefix = str(tmpdir.join('local'))
+    reader = DataManifestReader(manifest_fname, local_prefix, 'gs://bucket/')
+    with pytest.raises(FileMismatchError):
+        reader.sync(local_prefix)
+    assert not os.path.exists(os.path.join(local_prefix, 'eight_As.fa'))
+    assert not os.path.exists(os.path.join(local_prefix, 'eight_As.fa.download'))
+
+
+def test_get_local_path(tmpdir, fake_gcs, manifest_fname, monkeypatch):
+    writer = DataManifestWriter(manifest_fname, None, 'gs://bucket/')
+    writer.add_file('eight_As', _write_data_file(tmpdir, 'As.fa', b'AAAAAAAA'), 'seqs/As.fa', 'As.fa')
+    writer.add_file('eight_Cs', _write_data_file(tmpdir, 'Cs.fa', b'CCCCCCCC'), 'seqs/Cs.fa', 'Cs.fa')
+
+    downloads = []
+    download_to_file = FakeBlob.download_to_file
+
+    def slow_download_to_file(self, fp):
+        downloads.append(self.path)
+        time.sleep(0.1)
+        download_to_file(self, fp)
+    monkeypatch.setattr(FakeBlob, 'download_to_file', slow_download_to_file)
+
+    local_prefix = str(tmpdir.join('local'))
+    reader = DataManifestReader(manifest_fname, local_prefix, 'gs://bucket/')
+    # concurrent requests for the same file only download it once
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        local_paths = set(executor.map(reader.get_local_path, ['eight_As']*4))
+    assert local_paths == {os.path.join(local_prefix, 'seqs/As.fa')}
+    assert downloads == ['As.fa']
+    with open(os.path.join(local_prefix, 'seqs/As.fa'), 'rb') as ifp:
+        assert ifp.read() == b'AAAAAAAA'
+    # only the requested file is downloaded, and the lock isn't left next to it
+    assert os.listdir(os.path.join(local_prefix, 'seqs')) == ['As.fa']
+
+    assert reader.get_local_path('eight_As') == os.path.join(local_prefix, 'seqs/As.fa')
+    assert downloads == ['As.fa']
+    with pytest.raises(KeyError):
+        reader.get_local_path('eight_Gs')
+
+
+def test_selective_sync(tmpdir, fake_gcs, manifest_fname):
+    writer = DataManifestWriter(manifest_fname, None, 'gs://bucket/')
+    writer.add_file('genome', _write_data_file(tmpdir, 'genome.fa', b'ACGT'*4), 'hg38/genome.fa', 'genome.fa',
+                    note='tags=align,call')
+    writer.add_file('chroms', _write_data_file(tmpdir, 'chroms.fa', b'ACGT'), 'hg38/chroms.fa', 'chroms.fa',
+                    note='tags=call')
+    writer.add_file('blacklist', _write_data_file(tmpdir, 'blacklist.bed', b'chr1\t1\t2\n'),
+                    'hg38/blacklist.bed', 'blacklist.bed', note='tags=align priority=1 #old path: /srv/blacklist')
+    writer.add_file('model', _write_data_file(tmpdir, 'model.pkl', b'MODEL'), 'models/model.pkl', 'model.pkl')
+
+    reader = DataManifestReader(manifest_fname, None, 'gs://bucket/')
+    assert [record.name for record in reader.select()] == ['blacklist', 'chroms', 'model', 'genome']
+    assert [record.name for record in reader.select(tags=['align'])] == ['blacklist', 'genome']
+    assert [record.name for record in reader.select(patterns=['hg38/*.fa'])] == ['chroms', 'genome']
+    assert [record.name for record in reader.select(names=['model'], tags=['call'])] == [
+        'chroms', 'model', 'genome']
+    with pytest.raises(KeyError):
+        reader.select(names=['missing'])
+
+    local_prefix = str(tmpdir.join('local'))
+    reader.sync(local_prefix, tags=['align'])
+    assert sorted(os.listdir(os.path.join(local_prefix, 'hg38'))) == ['blacklist.bed', 'genome.fa']
+    assert not os.path.exists(os.path.join(local_prefix, 'models'))
+    reader.verify(local_prefix, check_md5sums=True, tags=['align'])
+    with pytest.raises(MissingFileError):
+        reader.verify(local_prefix)
+
+
+def test_download_ranges(tmpdir, monkeypatch):
+    monkeypatch.setattr(data_manifest, 'backoff_delays', lambda *args: iter(lambda: 0, None))
+    data = bytes(range(256))*41
+    blob = FakeBlob({'data': data}, 'data')
+    # fail the first attempt at every third range, and finish the ranges out of order
+    attempts = []
+    download_as_bytes = FakeBlob.download_as_bytes
+
+    def flaky_download_as_bytes(self, start, end):
+        attempts.append(start)
+        time.sleep(0.001*((start//100) % 4))
+        if (start//100) % 3 == 0 and attempts.count(start) == 1:
+            raise IOError("connection reset")
+        return download_as_bytes(self, start, end)
+    monkeypatch.setattr(FakeBlob, 'download_as_bytes', flaky_download_as_bytes)
+
+    path = str(tmpdir.join('data'))
+    md5sum = data_manifest.download_ranges(blob, path, len(data), num_streams=4, range_size=100)
+    with open(path, 'rb') as ifp:
+        assert ifp.read() == data
+    assert md5sum == calc_md5sum_from_fname(path)
+    assert len(attempts) > len(range(0, len(data), 100))
+
+
+def test_download_ranges_stops_after_a_failure(tmpdir, monkeypatch):
+    monkeypatch.setattr(data_manifest, 'backoff_delays', lambda *args: iter(lambda: 0, None))
+    data = b'A'*10000
+    fetched = []
+
+    def download_as_bytes(self, start, end):
+        fetched.append(start)
+        if start == 0:
+            raise IOError("connection reset")
+        time.sleep(0.01)
+        return data[start:end + 1]
+    monkeypatch.setattr(FakeBlob, 'download_as_bytes', download_as_bytes)
+
+    with pytest.raises(IOError):
+        data_manifest.download_ranges(
+            FakeBlob({'data': data}, 'data'), str(tmpdir.join('data')), len(data),
+            num_streams=2, range_size=100, max_attempts=3)
+    # the first range failed 3 times, and only a few of the other 99 ranges were fetched
+    assert fetched.count(0) == 3
+    assert len(fetched) < 20
+
+
+def test_sync_multi_stream(tmpdir, fake_gcs, manifest_fname):
+    fname = _write_data_file(tmpdir, 'genome.fa', b'ACGT'*1000)
+    writer = DataManifestWriter(manifest_fname, None, 'gs://bucket/')
+    writer.add_file('genome', fname, 'genome.fa', 'genome.fa')
+
+    local_prefix = str(tmpdir.join('local'))
+    reader = DataManifestReader(manifest_fname, local_prefix, 'gs://bucket/')
+    reader.multi_stream_threshold = 1000
+    reader.range_size = 300
+    reader.sync(local_prefix)
+    reader.verify(local_prefix, check_md5sums=True)
+
+    # a corrupt remote object is caught with multiple streams too
+    fake_gcs['genome.fa'] = b'ACGT'*999 + b'ACGA'
+    os.remove(os.path.join(local_prefix, 'genome.fa'))
+    with pytest.raises(FileMismatchError):
+        reader.sync(local_prefix)
+
+
+def test_open_remote(tmpdir, fake_gcs, manifest_fname):
+    contents = b''.join(f">chr{i}\n".encode() + b'ACGT'*100 + b'\n' for i in range(10))
+    writer = DataManifestWriter(manifest_fname, None, 'gs://bucket/')
+    writer.add_file('genome', _write_data_file(tmpdir, 'genome.fa', contents), 'genome.fa', 'genome.fa')
+
+    reader = DataManifestReader(manifest_fname, str(tmpdir.join('local')), 'gs://bucket/')
+    block_cache = BlockCache(str(tmpdir.join('blocks')))
+    with reader.open_remote('genome', block_cache=block_cache, block_size=256) as ifp:
+        ifp.seek(contents.index(b'>chr7'))
+        assert ifp.readline() == b'>chr7\n'
+        assert ifp.read(8) == b'ACGTACGT'
+    # only the blocks that were read were fetched
+    assert len(os.listdir(block_cache.cache_dir)) == 1
+    key = os.listdir(block_cache.cache_dir)[0]
+    assert 0 < len(os.listdir(os.path.join(block_cache.cache_dir, key))) < len(contents)//256
+    assert not os.path.exists(str(tmpdir.join('local')))
+
+
+@pytest.mark.parametrize('cache_mode', data_manifest.CACHE_MODES)
+def test_calc_md5sum_cache_modes(tmpdir, cache_mode):
+    # an odd size, so that the last O_DIRECT read is short
+    fname = _write_data_file(tmpdir, 'data', os.urandom(3*1024*1024 + 123))
+    with open(fname, 'rb') as ifp:
+        contents = ifp.read()
+    assert calc_md5sum_from_fname(fname, cache_mode=cache_mode) == \
+        data_manifest.hex_to_base64(hashlib.md5(contents).hexdigest())
+    assert b''.join(data_manifest.iter_file_blocks(fname, cache_mode, block_size=1024*1024)) == contents
+
+
+def test_direct_reads_fall_back_when_the_reads_fail(tmpdir, monkeypatch):
+    contents = os.urandom(1024*1024 + 123)
+    fname = _write_data_file(tmpdir, 'data', contents)
+    # the filesystem accepts the O_DIRECT open, and then fails the reads
+    monkeypatch.setattr(data_manifest, '_open_direct', lambda fname: os.open(fname, os.O_RDONLY))
+
+    def readv(fd, buffers):
+        raise OSError(errno.EINVAL, 'Invalid argument')
+    monkeypatch.setattr(os, 'readv', readv)
+    assert b''.join(data_manifest.iter_file_blocks(fname, 'direct', block_size=1024*1024)) == contents
+
+
+def test_calc_md5sum_unknown_cache_mode(tmpdir):
+    with pytest.raises(ValueError):
+        calc_md5sum_from_fname(_write_data_file(tmpdir, 'data', b'DATA'), cache_mode='fast')
+
+
 def _add_file_to_manifest_upload_to_gcs_and_verify_local_matches_remote():
     """Test that adding a file to the manifest works.
 
@@ -0,0 +1,189 @@
+import os
+import shutil
+import stat
+
+import conda_build.api
+import pytest
+
+from freenome_build import deploy, version_utils
+from freenome_build.deploy import (
+    Recipe,
+    RecipeDependencyCycleError,
+    build_and_upload_packages_from_repos,
+    build_order,
+    default_max_parallel_builds,
+    read_recipe
+)
+from freenome_build.recipe import read_meta_yaml
+from freenome_build.upload import LocalChannel
+
+FAKE_CONDA = """#!/bin/bash
+# the last argument is the recipe dir, and the repo is named after the package
+RECIPE_DIR="${@: -1}"
+PACKAGE="$FAKE_CONDA_BLD/linux-64/$(basename $(dirname $RECIPE_DIR))-$VERSION-0.tar.bz2"
+if [[ " $* " == *" --output "* ]]; then
+    echo $PACKAGE
+    exit 0
+fi
+echo "build $(basename $(dirname $RECIPE_DIR)) $*" >> $FAKE_LOG
+mkdir -p $(dirname $PACKAGE)
+echo PACKAGE > $PACKAGE
+"""
+
+META_YAML = """
+{{% set version = environ.get('VERSION') %}}
+package:
+  name: {name}
+  version: {{{{ version }}}}
+requirements:
+  build:
+    - python
+  run:
+{requirements}
+"""
+
+
+def _write_repo(root, name, requirements=(), outputs=None):
+    repo_path = str(root.mkdir(name))
+    os.makedirs(os.path.join(repo_path, 'conda-build'))
+    with open(os.path.join(repo_path, 'conda-build', 'meta.yaml'), 'w') as ofp:
+        ofp.write(META_YAML.format(
+            name=name, requirements=''.join(f"    - {requirement} >=1.0\n" for requirement in requirements)))
+        if outputs:
+            ofp.write("outputs:\n" + ''.join(f"  - name: {output}\n" for output in outputs))
+    return repo_path
+
+
+class FakeMetaData():
+    def __init__(self, name, values):
+        self._name = name
+        self.values = values
+
+    def name(self):
+        return self._name
+
+    def get_value(self, path):
+        return self.values.get(path)
+
+
+def _fake_render(recipe_path, **kwargs):
+    # good enough for the recipes that _write_repo writes, which have no jinja besides the version
+    data = read_meta_yaml(os.path.dirname(recipe_path), os.environ['VERSION'])
+    outputs = [dict(data, name=data['package']['name'])] + list(data.get('outputs') or ())
+    return [
+        (FakeMetaData(output['name'], {
+            f"requirements/{section}": specs for section, specs in (output.get('requirements') or {}).items()
+        }), False, False)
+        for output in outputs
+    ]
+
+
+@pytest.fixture
+def fake_render(monkeypatch):
+    monkeypatch.setattr(conda_build.api, 'render', _fake_render, raising=False)
+
+
+def _recipe(path, package_names, requirements=()):
+    return Recipe(path, '1.0', package_names, set(requirements), None)
+
+
+def test_build_order():
+    lib = _recipe('lib', ['lib'])
+    app = _recipe('app', ['app'], ['lib', 'numpy'])
+    tool = _recipe('tool', ['tool'], ['app-extras'])
+    extras = _recipe('extras', ['extras', 'app-extras'], ['lib'])
+    ordered = build_order([tool, app, extras, lib])
+    assert [recipe.path for recipe, _ in ordered] == ['lib', 'app', 'extras', 'tool']
+    assert dict((recipe.path, [dep.path for dep in upstream]) for recipe, upstream in ordered) == {
+        'lib': [], 'app': ['lib'], 'extras': ['lib'], 'tool': ['extras']}
+
+
+def test_build_order_cycle():
+    with pytest.raises(RecipeDependencyCycleError):
+        build_order([_recipe('a', ['a'], ['b']), _recipe('b', ['b'], ['a'])])
+
+
+def test_read_recipe(tmpdir, monkeypatch, fake_render):
+    monkeypatch.setattr(version_utils, 'version', lambda path: '1.0')
+    repo_path = _write_repo(tmpdir, 'app', requirements=['lib'], outputs=['app-extras'])
+    recipe = read_recipe(repo_path, use_build_cache=False)
+    assert recipe.package_names == ['app', 'app-extras']
+    assert recipe.requirements == {'lib', 'python'}
+
+
+def test_read_recipe_uses_the_rendered_recipe(tmpdir, monkeypatch):
+    monkeypatch.setattr(version_utils, 'version', lambda path: '1.0')
+    repo_path = _write_repo(tmpdir, 'app')
+
+    def render(recipe_path, **kwargs):
+        # two variants of 'app', with the compiler and the selected branch of an if rendered
+        app = FakeMetaData('app', {'requirements/build': ['gcc_linux-64 7.3.*'], 'requirements/run': ['lib >=1.0']})
+        extras = FakeMetaData('app-extras', {'requirements/run': ['app 1.0']})
+        return [(app, False, False), (app, False, False), (extras, False, False)]
+    monkeypatch.setattr(conda_build.api, 'render', render, raising=False)
+    recipe = read_recipe(repo_path, use_build_cache=False)
+    assert recipe.package_names == ['app', 'app-extras']
+    assert recipe.requirements == {'gcc_linux-64', 'lib'}
+
+
+def test_default_max_parallel_builds():
+    assert default_max_parallel_builds() >= 1
+    assert default_max_parallel_builds(cpus_per_build=10000) == 1
+
+
+def test_build_and_upload_packages_from_repos(tmpdir, monkeypatch, fake_render):
+    bin_dir = tmpdir.mkdir('bin')
+    for name, script in (('conda', FAKE_CONDA), ):
+        script_path = str(bin_dir.join(name))
+        with open(script_path, 'w') as ofp:
+            ofp.write(script)
+        os.chmod(script_path, os.stat(script_path).st_mode | stat.S_IEXEC)
+    log_path = str(tmpdir.join('log'))
+    monkeypatch.setenv('PATH', f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setenv('FAKE_CONDA_BLD', str(tmpdir.join('conda-bld')))
+    monkeypatch.setenv('FAKE_LOG', log_path)
+    monkeypatch.setenv('FREENOME_BUILD_CACHE_DIR', str(tmpdir.join('cache')))
+    monkeypatch.setattr(conda_build.api, 'update_index', lambda dir_paths: None, raising=False)
+    monkeypatch.setattr(version_utils, 'version', lambda path: '1.0')
+
+    repos = tmpdir.mkdir('repos')
+    paths = [_write_repo(repos, 'app', requirements=['lib']), _write_repo(repos, 'lib')]
+    channel = LocalChannel(str(tmpdir.join('channel')))
+    package_paths = build_and_upload_packages_from_repos(paths, use_build_cache=True, channel=channel)
+    assert sorted(os.path.basename(package_paths[path][0]) for path in paths) == [
+        'app-1.0-0.tar.bz2', 'lib-1.0-0.tar.bz2']
+    with open(log_path) as ifp:
+        log = ifp.read().splitlines()
+    builds = [line.split()[1] for line in log if line.startswith('build')]
+    assert builds == ['lib', 'app']
+    # app is built against the cached lib package
+    app_build = [line for line in log if line.startswith('build app')][0]
+    assert f"-c file://{tmpdir.join('cache')}" in app_build
+    assert sorted(os.listdir(os.path.join(channel.path, 'linux-64'))) == ['app-1.0-0.tar.bz2', 'lib-1.0-0.tar.bz2']
+
+    # nothing changed, so nothing is rebuilt or uploaded
+    os.remove(log_path)
+    shutil.rmtree(channel.path)
+    build_and_upload_packages_from_repos(paths, use_build_cache=True, channel=channel)
+    assert not os.path.exists(log_path)
+    assert not os.path.exists(channel.path)
+
+
+def test_deploy_uses_repo_paths(monkeypatch):
+    calls = []
+    monkeypatch.setattr(deploy, 'build_and_upload_package_from_repo', lambda **kwargs: calls.append('one'))
+    monkeypatch.setattr(deploy, 'build_and_upload_packages_from_repos', lambda paths, **kwargs: calls.append(paths))
+
+    class Args():
+        upload = False
+        skip_existing = False
+        use_build_cache = True
+        max_parallel_builds = None
+        max_parallel_uploads = 4
+        channel_dir = None
+    args = Args()
+    args.paths = None
+    deploy.deploy_main(args)
+    args.paths = ['a', 'b']
+    deploy.deploy_main(args)
+    assert calls == ['one', ['a', 'b']]
@@ -0,0 +1,126 @@
+import os
+import stat
+
+import conda_build.api
+import pytest
+
+from freenome_build import develop, version_utils
+from freenome_build.env_cache import EnvCache, env_key
+from freenome_build.recipe import read_meta_yaml
+
+# a fake conda that logs its commands, and creates environments with a fake python in them
+FAKE_CONDA = """#!/bin/bash
+echo "conda $*" >> $FAKE_LOG
+PREFIX=$(echo "$*" | sed -E 's/.*--prefix ([^ ]+).*/\\1/')
+case "$1" in
+    create)
+        mkdir -p $PREFIX/conda-meta $PREFIX/bin
+        printf '#!/bin/bash\\necho "python $*" >> $FAKE_LOG\\n' > $PREFIX/bin/python
+        chmod +x $PREFIX/bin/python
+        ;;
+    list)
+        echo "@EXPLICIT"
+        echo "https://repo.anaconda.com/pkgs/main/linux-64/numpy-1.15.0-py36_0.tar.bz2#md5"
+        ;;
+esac
+"""
+
+META_YAML = """
+package:
+  name: pkg
+  version: {{{{ VERSION }}}}
+requirements:
+  run:
+{requirements}
+"""
+
+
+def _write_meta_yaml(repo_path, requirements):
+    with open(os.path.join(repo_path, 'conda-build', 'meta.yaml'), 'w') as ofp:
+        ofp.write(META_YAML.format(requirements=''.join(f"    - {requirement}\n" for requirement in requirements)))
+
+
+class FakeMetaData():
+    def __init__(self, data):
+        self.data = data
+
+    def name(self):
+        return self.data['package']['name']
+
+    def get_value(self, path):
+        section, key = path.split('/')
+        return (self.data.get(section) or {}).get(key)
+
+
+def fake_render(recipe_path, **kwargs):
+    return [(FakeMetaData(read_meta_yaml(os.path.dirname(recipe_path), os.environ['VERSION'])), False, False)]
+
+
+@pytest.fixture
+def fake_conda(tmpdir, monkeypatch):
+    bin_dir = tmpdir.mkdir('bin')
+    conda_path = str(bin_dir.join('conda'))
+    with open(conda_path, 'w') as ofp:
+        ofp.write(FAKE_CONDA)
+    os.chmod(conda_path, os.stat(conda_path).st_mode | stat.S_IEXEC)
+    log_path = str(tmpdir.join('log'))
+    monkeypatch.setenv('PATH', f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setenv('FAKE_LOG', log_path)
+    monkeypatch.setenv('FREENOME_BUILD_ENV_CACHE_DIR', str(tmpdir.join('envs')))
+    monkeypatch.setattr(version_utils, 'version', lambda path: '1.0')
+    monkeypatch.setattr(conda_build.api, 'render', fake_render, raising=False)
+
+    def read_log():
+        if not os.path.exists(log_path):
+            return []
+        with open(log_path) as ifp:
+            commands = [line.split()[:2] for line in ifp.read().splitlines()]
+        os.remove(log_path)
+        return commands
+    return read_log
+
+
+def test_env_key():
+    assert env_key(['numpy', 'python >=3.6']) == env_key(['python >=3.6', 'numpy'])
+    assert env_key(['numpy']) != env_key(['numpy >=1.15'])
+
+
+def test_develop_reuses_environments(tmpdir, fake_conda):
+    repo_path = str(tmpdir.mkdir('repo'))
+    os.makedirs(os.path.join(repo_path, 'conda-build'))
+    _write_meta_yaml(repo_path, ['numpy', 'python >=3.6'])
+
+    # the first time we solve the environment
+    prefix = str(tmpdir.join('env_1'))
+    develop.setup_development_environment(repo_path, prefix=prefix)
+    assert fake_conda() == [['conda', 'create'], ['conda', 'list'], ['python', 'setup.py']]
+    assert EnvCache.installed_key(prefix) == env_key(['numpy', 'python >=3.6'])
+
+    # the environment already has the requirements
+    develop.setup_development_environment(repo_path, prefix=prefix)
+    assert fake_conda() == [['python', 'setup.py']]
+
+    # a new environment is created from the cached spec
+    develop.setup_development_environment(repo_path, prefix=str(tmpdir.join('env_2')))
+    log = fake_conda()
+    assert log == [['conda', 'create'], ['python', 'setup.py']]
+
+    # the requirements changed, so the environment is solved again
+    _write_meta_yaml(repo_path, ['numpy >=1.15', 'python >=3.6'])
+    develop.setup_development_environment(repo_path, prefix=prefix)
+    assert fake_conda() == [['conda', 'install'], ['conda', 'list'], ['python', 'setup.py']]
+
+
+def test_develop_installs_python(tmpdir, fake_conda):
+    repo_path = str(tmpdir.mkdir('repo'))
+    os.makedirs(os.path.join(repo_path, 'conda-build'))
+    _write_meta_yaml(repo_path, ['numpy'])
+    prefix = str(tmpdir.join('env'))
+    develop.setup_development_environment(repo_path, prefix=prefix)
+    assert fake_conda() == [['conda', 'create'], ['conda', 'list'], ['python', 'setup.py']]
+    assert EnvCache.installed_key(prefix) == env_key(['numpy', 'python'])
+
+
+def test_install_without_requirements(tmpdir, fake_conda):
+    develop._install_requirements([], str(tmpdir.join('env')))
+    assert fake_conda() == []
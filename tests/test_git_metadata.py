@@ -0,0 +1,81 @@
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from freenome_build import git_metadata as git_metadata_module
+from freenome_build.git_metadata import GitMetadataError, git_metadata, remote_repo_name
+from freenome_build.github import environment_name, repo_name
+
+
+def _git(path, *args):
+    subprocess.run(['git'] + list(args), cwd=path, check=True, stdout=subprocess.PIPE)
+
+
+@pytest.fixture
+def repo(tmpdir):
+    path = str(tmpdir.mkdir('My-Repo'))
+    _git(path, 'init', '-q')
+    _git(path, 'config', 'user.email', 'test@example.com')
+    _git(path, 'config', 'user.name', 'test')
+    _git(path, 'remote', 'add', 'origin', 'git@github.com:freenome/my-repo.git')
+    for contents in ('1', '2'):
+        with open(os.path.join(path, 'file'), 'w') as ofp:
+            ofp.write(contents)
+        _git(path, 'add', 'file')
+        _git(path, 'commit', '-q', '-m', contents)
+        if contents == '1':
+            _git(path, 'tag', 'v1')
+    os.makedirs(os.path.join(path, 'subdir'))
+    git_metadata_module.clear_git_metadata_cache()
+    return path
+
+
+def test_git_metadata(repo):
+    cwd = os.getcwd()
+    metadata = git_metadata(os.path.join(repo, 'subdir'))
+    assert os.getcwd() == cwd
+    assert os.path.realpath(metadata.toplevel) == os.path.realpath(repo)
+    assert metadata.remote_url == 'git@github.com:freenome/my-repo.git'
+    assert len(metadata.head_sha) == 40
+    assert metadata.describe == 'tags/v1'
+    assert metadata.dirty is False
+
+    assert repo_name(repo) == 'my_repo'
+    assert remote_repo_name(repo) == 'my-repo'
+    assert environment_name(repo) == 'tags__v1'
+
+
+def test_git_metadata_is_cached(repo):
+    assert git_metadata(repo).dirty is False
+    with open(os.path.join(repo, 'file'), 'w') as ofp:
+        ofp.write('3')
+    assert git_metadata(repo).dirty is False
+    assert git_metadata(repo, refresh=True).dirty is True
+
+
+def test_git_metadata_not_a_repo(tmpdir):
+    path = str(tmpdir.mkdir('not_a_repo'))
+    assert git_metadata(path).toplevel is None
+    with pytest.raises(GitMetadataError):
+        remote_repo_name(path)
+
+
+def test_git_metadata_concurrently(repo, tmpdir):
+    other = str(tmpdir.mkdir('not_a_repo'))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        toplevels = list(executor.map(lambda path: git_metadata(path).toplevel, [repo, other]*8))
+    assert toplevels[1::2] == [None]*8
+    assert {os.path.realpath(toplevel) for toplevel in toplevels[::2]} == {os.path.realpath(repo)}
+
+
+def test_git_metadata_reads_status_lazily(repo, monkeypatch):
+    git_args = []
+    git = git_metadata_module._git
+    monkeypatch.setattr(git_metadata_module, '_git', lambda path, *args: git_args.append(args) or git(path, *args))
+    assert remote_repo_name(repo) == 'my-repo'
+    assert [args[0] for args in git_args] == ['rev-parse', 'config']
+    assert git_metadata(repo).dirty is False
+    assert git_metadata(repo).dirty is False
+    assert [args[0] for args in git_args] == ['rev-parse', 'config', 'status']
@@ -0,0 +1,67 @@
+import json
+import os
+import stat
+
+import pytest
+
+from freenome_build.k8s import iter_json_objects, PodWatcher, PodFailedError
+
+
+def _pod(phase, waiting_reason=None):
+    pod = {'metadata': {'name': 'test-pod'}, 'status': {'phase': phase, 'conditions': []}}
+    if waiting_reason is not None:
+        pod['status']['containerStatuses'] = [
+            {'name': 'database', 'state': {'waiting': {'reason': waiting_reason}}}
+        ]
+    return pod
+
+
+def _write_fake_kubectl(dirname, pods, delay=0.05, exit_early=False):
+    """Write a fake kubectl that prints 'pods' as pretty printed JSON, one per 'delay' seconds."""
+    path = os.path.join(dirname, 'kubectl')
+    with open(path, 'w') as ofp:
+        ofp.write("#!/usr/bin/env python\n")
+        ofp.write("import sys, time\n")
+        for pod in pods:
+            ofp.write(f"sys.stdout.write({json.dumps(json.dumps(pod, indent=4))} + '\\n')\n")
+            ofp.write("sys.stdout.flush()\n")
+            ofp.write(f"time.sleep({delay})\n")
+        if not exit_early:
+            ofp.write("time.sleep(60)\n")
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+def test_iter_json_objects_split_chunks():
+    stream = json.dumps({'a': 1}, indent=4) + "\n" + json.dumps({'b': [1, 2]}, indent=4)
+    chunks = [stream[i:i+3] for i in range(0, len(stream), 3)]
+    assert list(iter_json_objects(chunks)) == [{'a': 1}, {'b': [1, 2]}]
+
+
+@pytest.mark.timeout(10)
+def test_pod_watcher_running(tmpdir):
+    kubectl = _write_fake_kubectl(str(tmpdir), [_pod('Pending'), _pod('Pending'), _pod('Running')])
+    phase_durations = PodWatcher('test-pod', kubectl=kubectl).wait_until_running()
+    assert list(phase_durations) == ['Pending', 'Running']
+    assert phase_durations['Pending'] > 0
+
+
+@pytest.mark.timeout(10)
+def test_pod_watcher_image_pull_error(tmpdir):
+    kubectl = _write_fake_kubectl(str(tmpdir), [_pod('Pending'), _pod('Pending', 'ErrImagePull')])
+    with pytest.raises(PodFailedError, match='ErrImagePull'):
+        PodWatcher('test-pod', kubectl=kubectl).wait_until_running()
+
+
+@pytest.mark.timeout(10)
+def test_pod_watcher_timeout(tmpdir):
+    kubectl = _write_fake_kubectl(str(tmpdir), [_pod('Pending')])
+    with pytest.raises(PodFailedError, match='after 0.5 seconds'):
+        PodWatcher('test-pod', kubectl=kubectl, max_wait_time=0.5).wait_until_running()
+
+
+@pytest.mark.timeout(10)
+def test_pod_watcher_stream_ends(tmpdir):
+    kubectl = _write_fake_kubectl(str(tmpdir), [_pod('Pending')], exit_early=True)
+    with pytest.raises(PodFailedError, match='exited before'):
+        PodWatcher('test-pod', kubectl=kubectl).wait_until_running()
@@ -0,0 +1,135 @@
+import json
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from freenome_build import data_manifest, manifest_service
+from freenome_build.data_manifest import FileMismatchError
+from freenome_build.manifest_service import ManifestServer, ManifestServiceError, lookup
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    loads = []
+    reader_init = data_manifest.DataManifestReader.__init__
+
+    def counting_init(self, *args, **kwargs):
+        loads.append(args[0])
+        reader_init(self, *args, **kwargs)
+    monkeypatch.setattr(data_manifest.DataManifestReader, '__init__', counting_init)
+    return loads
+
+
+@pytest.fixture
+def server(tmpdir):
+    server = ManifestServer(str(tmpdir.join('manifest.sock')))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_lookup(tmpdir, server, loads, write_manifest):
+    local_prefix = str(tmpdir.mkdir('data'))
+    manifest_fname = str(tmpdir.join('manifest.tsv'))
+    write_manifest(manifest_fname, local_prefix, {'a': b'AAAA', 'b': b'BBBB'})
+
+    for _ in range(3):
+        response = lookup(manifest_fname, 'a', local_prefix, socket_path=server.server_address)
+        assert response == {'path': os.path.join(local_prefix, 'a.txt'), 'verified': False}
+    assert lookup(manifest_fname, 'a', local_prefix, verify=True, socket_path=server.server_address)['verified']
+    assert lookup(manifest_fname, 'a', local_prefix, socket_path=server.server_address)['verified']
+    # the manifest was only parsed once
+    assert len(loads) == 1
+
+    with pytest.raises(KeyError):
+        lookup(manifest_fname, 'c', local_prefix, socket_path=server.server_address)
+
+    # changing the manifest reloads it, and forgets what was verified
+    write_manifest(manifest_fname, local_prefix, {'a': b'AAAA', 'c': b'CCCCC'})
+    assert lookup(manifest_fname, 'c', local_prefix, socket_path=server.server_address)['verified'] is False
+    assert lookup(manifest_fname, 'a', local_prefix, socket_path=server.server_address)['verified'] is False
+    assert len(loads) == 2
+
+    # a modified file isn't verified anymore
+    lookup(manifest_fname, 'a', local_prefix, verify=True, socket_path=server.server_address)
+    with open(os.path.join(local_prefix, 'a.txt'), 'wb') as ofp:
+        ofp.write(b'AAAB')
+    assert lookup(manifest_fname, 'a', local_prefix, socket_path=server.server_address)['verified'] is False
+    with pytest.raises(FileMismatchError):
+        lookup(manifest_fname, 'a', local_prefix, verify=True, socket_path=server.server_address)
+
+
+def test_lookup_without_service(tmpdir, loads, monkeypatch, write_manifest):
+    monkeypatch.setattr(manifest_service, '_local_service', manifest_service.ManifestService())
+    local_prefix = str(tmpdir.mkdir('data'))
+    manifest_fname = str(tmpdir.join('manifest.tsv'))
+    write_manifest(manifest_fname, local_prefix, {'a': b'AAAA'})
+    socket_path = str(tmpdir.join('missing.sock'))
+    for _ in range(2):
+        response = lookup(manifest_fname, 'a', local_prefix, verify=True, socket_path=socket_path)
+        assert response == {'path': os.path.join(local_prefix, 'a.txt'), 'verified': True}
+    assert len(loads) == 1
+
+
+def test_one_server_per_socket(server):
+    with pytest.raises(ManifestServiceError):
+        ManifestServer(server.server_address)
+
+
+def test_lookup_falls_back_when_the_service_fails(tmpdir, loads, monkeypatch, write_manifest):
+    monkeypatch.setattr(manifest_service, '_local_service', manifest_service.ManifestService())
+    local_prefix = str(tmpdir.mkdir('data'))
+    manifest_fname = str(tmpdir.join('manifest.tsv'))
+    write_manifest(manifest_fname, local_prefix, {'a': b'AAAA'})
+    expected = {'path': os.path.join(local_prefix, 'a.txt'), 'verified': False}
+
+    # a hung service never answers
+    hung_socket_path = str(tmpdir.join('hung.sock'))
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as hung_sock:
+        hung_sock.bind(hung_socket_path)
+        hung_sock.listen(1)
+        start = time.monotonic()
+        assert lookup(manifest_fname, 'a', local_prefix, socket_path=hung_socket_path, timeout=0.2) == expected
+        assert time.monotonic() - start < 5
+
+    # a service that dies mid-request
+    dying_socket_path = str(tmpdir.join('dying.sock'))
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as dying_sock:
+        dying_sock.bind(dying_socket_path)
+        dying_sock.listen(1)
+
+        def accept_and_close():
+            conn, _ = dying_sock.accept()
+            conn.close()
+        thread = threading.Thread(target=accept_and_close)
+        thread.start()
+        assert lookup(manifest_fname, 'a', local_prefix, socket_path=dying_socket_path) == expected
+        thread.join()
+
+
+def test_lookup_waits_for_the_service_to_verify(tmpdir, loads):
+    # a service that takes longer than the timeout to hash a file
+    socket_path = str(tmpdir.join('slow.sock'))
+    response = {'path': 'a.txt', 'verified': True}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as slow_sock:
+        slow_sock.bind(socket_path)
+        slow_sock.listen(1)
+
+        def answer_slowly():
+            conn, _ = slow_sock.accept()
+            with conn, conn.makefile('rwb') as conn_file:
+                conn_file.readline()
+                time.sleep(0.5)
+                conn_file.write(json.dumps(response).encode('utf8') + b'\n')
+        thread = threading.Thread(target=answer_slowly)
+        thread.start()
+        assert lookup('manifest.tsv', 'a', str(tmpdir), verify=True, socket_path=socket_path, timeout=0.1) == response
+        thread.join()
+    # the file wasn't verified in this process too
+    assert loads == []
@@ -0,0 +1,157 @@
+import threading
+
+import pytest
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
+
+from freenome_build.pool import ConnectionPool, PoolClosedError, PoolTimeoutError
+from freenome_build.sql import execute_sql_script
+
+
+class FakeCursor():
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql):
+        if self.conn.fail_health_check:
+            raise RuntimeError("server closed the connection unexpectedly")
+        for statement in sql.split(';\n'):
+            if statement.startswith('SET '):
+                name, value = statement[len('SET '):].split(' TO ')
+                self.conn.settings[name] = value
+            elif statement == 'RESET ALL':
+                if self.conn.fail_reset:
+                    raise RuntimeError("server closed the connection unexpectedly")
+                assert self.conn.autocommit
+                self.conn.settings.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeConnection():
+    def __init__(self):
+        self.closed = 0
+        self.autocommit = False
+        self.status = TRANSACTION_STATUS_IDLE
+        self.fail_health_check = False
+        self.num_rollbacks = 0
+        self.fail_reset = False
+        # the session's settings that differ from the defaults
+        self.settings = {}
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def get_transaction_status(self):
+        return self.status
+
+    def commit(self):
+        self.status = TRANSACTION_STATUS_IDLE
+
+    def rollback(self):
+        self.num_rollbacks += 1
+        self.status = TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+def _pool(**kwargs):
+    connections = []
+
+    def connect():
+        connections.append(FakeConnection())
+        return connections[-1]
+    return ConnectionPool(connect, **kwargs), connections
+
+
+def test_pool_reuses_connections():
+    pool, connections = _pool()
+    with pool.connection() as conn_1:
+        pass
+    with pool.connection() as conn_2:
+        pass
+    assert conn_1 is conn_2
+    assert len(connections) == 1
+
+
+def test_pool_rolls_back_open_transactions():
+    pool, _ = _pool()
+    with pool.connection() as conn:
+        conn.status = TRANSACTION_STATUS_INTRANS
+    assert conn.num_rollbacks == 1
+
+
+def test_pool_resets_session_settings():
+    pool, connections = _pool()
+    with pool.connection() as conn:
+        # eg a pg_dump script
+        execute_sql_script(conn, "SET search_path TO '';\nSET statement_timeout TO 0;\nSELECT 1;\n")
+        assert conn.settings == {'search_path': "''", 'statement_timeout': '0'}
+    with pool.connection() as conn:
+        assert conn.settings == {}
+        assert not conn.autocommit
+    assert len(connections) == 1
+
+
+def test_pool_discards_connections_that_cant_be_reset():
+    pool, connections = _pool()
+    with pool.connection() as conn:
+        conn.fail_reset = True
+    assert conn.closed
+    assert pool.size == 0
+
+
+def test_pool_replaces_closed_connections():
+    pool, connections = _pool()
+    with pool.connection() as conn:
+        pass
+    conn.closed = 1
+    with pool.connection() as new_conn:
+        assert new_conn is not conn
+    assert pool.size == 1
+
+
+def test_pool_health_check():
+    pool, connections = _pool(health_check_interval=0)
+    with pool.connection() as conn:
+        pass
+    conn.fail_health_check = True
+    with pool.connection() as new_conn:
+        assert new_conn is not conn
+    assert conn.closed
+    assert pool.size == 1
+
+
+@pytest.mark.timeout(5)
+def test_pool_size_limit():
+    pool, connections = _pool(max_size=2, timeout=0.2)
+    conn_1 = pool.getconn()
+    conn_2 = pool.getconn()
+    with pytest.raises(PoolTimeoutError):
+        pool.getconn()
+
+    # a waiting thread gets the connection as soon as it is returned
+    result = []
+    thread = threading.Thread(target=lambda: result.append(pool.getconn()))
+    pool.timeout = 5
+    thread.start()
+    pool.putconn(conn_1)
+    thread.join()
+    assert result == [conn_1]
+    pool.putconn(conn_2)
+    assert len(connections) == 2
+
+
+def test_pool_close():
+    pool, _ = _pool()
+    conn = pool.getconn()
+    pool.close()
+    pool.putconn(conn)
+    assert conn.closed
+    assert pool.size == 0
+    with pytest.raises(PoolClosedError):
+        pool.getconn()
@@ -0,0 +1,126 @@
+import socket
+import struct
+import threading
+from contextlib import closing
+
+import pytest
+
+from freenome_build.readiness import (
+    backoff_delays,
+    postgres_probe,
+    tcp_probe,
+    wait_for_postgres,
+    DbNotReadyError
+)
+
+
+def _error_response(code):
+    payload = b'SFATAL\x00C' + code.encode() + b'\x00Mthe database system is starting up\x00\x00'
+    return b'E' + struct.pack('!i', len(payload) + 4) + payload
+
+
+AUTH_OK_RESPONSE = b'R' + struct.pack('!ii', 8, 0)
+
+
+class FakePostgresServer():
+    """Accept connections and answer every startup message with 'responses[i]'."""
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(8)
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with closing(conn):
+                if conn.recv(1024) and self.responses:
+                    conn.sendall(self.responses.pop(0) if len(self.responses) > 1 else self.responses[0])
+
+    def close(self):
+        self.sock.close()
+
+
+def _closed_port():
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_tcp_probe_closed_port():
+    assert not tcp_probe('127.0.0.1', _closed_port())
+
+
+def test_postgres_probe_ready():
+    server = FakePostgresServer([AUTH_OK_RESPONSE])
+    try:
+        assert postgres_probe('127.0.0.1', server.port)
+    finally:
+        server.close()
+
+
+def test_postgres_probe_starting_up():
+    server = FakePostgresServer([_error_response('57P03')])
+    try:
+        assert not postgres_probe('127.0.0.1', server.port)
+    finally:
+        server.close()
+
+
+def test_postgres_probe_auth_error_is_ready():
+    server = FakePostgresServer([_error_response('28000')])
+    try:
+        assert postgres_probe('127.0.0.1', server.port)
+    finally:
+        server.close()
+
+
+def test_wait_for_postgres_after_startup():
+    server = FakePostgresServer([_error_response('57P03'), _error_response('57P03'), AUTH_OK_RESPONSE])
+    try:
+        wait_for_postgres('127.0.0.1', server.port, max_wait_time=5, initial_delay=0.01)
+    finally:
+        server.close()
+
+
+@pytest.mark.timeout(5)
+def test_wait_for_postgres_timeout():
+    with pytest.raises(DbNotReadyError, match="within 0.3 seconds"):
+        wait_for_postgres('127.0.0.1', _closed_port(), max_wait_time=0.3, initial_delay=0.01)
+
+
+@pytest.mark.timeout(5)
+def test_wait_for_postgres_wakes_on_log_line():
+    server = FakePostgresServer([_error_response('57P03'), AUTH_OK_RESPONSE])
+    try:
+        # the initial delay is much longer than the test timeout, so this only
+        # passes if the log line wakes up the waiter
+        wait_for_postgres(
+            '127.0.0.1', server.port, max_wait_time=60, initial_delay=60,
+            log_cmd="echo 'database system is ready to accept connections'"
+        )
+    finally:
+        server.close()
+
+
+@pytest.mark.timeout(5)
+def test_wait_for_postgres_without_the_log_command():
+    server = FakePostgresServer([_error_response('57P03'), AUTH_OK_RESPONSE])
+    try:
+        wait_for_postgres(
+            '127.0.0.1', server.port, max_wait_time=5, initial_delay=0.01, log_cmd="not-a-command logs -f db")
+    finally:
+        server.close()
+
+
+def test_backoff_delays_are_bounded():
+    delays = backoff_delays(initial_delay=0.1, max_delay=1.0)
+    values = [next(delays) for _ in range(20)]
+    assert all(0 < value <= 1.0 for value in values)
+    assert values[-1] >= 0.5
@@ -0,0 +1,63 @@
+import os
+
+import conda_build.api
+
+from freenome_build.recipe import read_meta_yaml, render_requirements
+
+META_YAML = """
+{% set data = load_setup_py_data() %}
+package:
+  name: pkg
+  version: {{ VERSION }}
+requirements:
+  build:
+    - python
+  run:
+    - numpy   >=1.15
+    - requests
+outputs:
+  - name: pkg-extras
+    requirements:
+      run:
+        - pkg
+"""
+
+
+class FakeMetaData():
+    def __init__(self, name, values):
+        self._name = name
+        self.values = values
+
+    def name(self):
+        return self._name
+
+    def get_value(self, path):
+        return self.values.get(path)
+
+
+def test_read_meta_yaml(tmpdir):
+    tmpdir.mkdir('conda-build').join('meta.yaml').write(META_YAML)
+    data = read_meta_yaml(str(tmpdir), '1.2.3')
+    assert data['package'] == {'name': 'pkg', 'version': '1.2.3'}
+    assert [output['name'] for output in data['outputs']] == ['pkg-extras']
+
+
+def test_render_requirements(tmpdir, monkeypatch):
+    tmpdir.mkdir('conda-build').join('meta.yaml').write(META_YAML)
+    rendered_versions = []
+
+    def render(recipe_path, **kwargs):
+        assert recipe_path == str(tmpdir.join('conda-build'))
+        rendered_versions.append(os.environ['VERSION'])
+        return [
+            (FakeMetaData('pkg', {'requirements/run': ['numpy   >=1.15', 'requests'],
+                                  'requirements/build': ['gcc'],
+                                  'test/requires': ['pytest']}), False, False),
+            (FakeMetaData('pkg-extras', {'requirements/run': ['pkg 1.2.3', 'requests']}), False, False),
+        ]
+    monkeypatch.setattr(conda_build.api, 'render', render, raising=False)
+    monkeypatch.delenv('VERSION', raising=False)
+
+    assert render_requirements(str(tmpdir), '1.2.3') == ('pkg', ['numpy >=1.15', 'pytest', 'requests'])
+    assert rendered_versions == ['1.2.3']
+    assert 'VERSION' not in os.environ
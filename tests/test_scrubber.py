@@ -0,0 +1,102 @@
+import errno
+import os
+
+from freenome_build.data_manifest import FileMismatchError, MissingFileError
+from freenome_build import scrubber
+from freenome_build.scrubber import RateLimiter, Scrubber
+
+
+def test_rate_limiter():
+    now = [0.0]
+    sleeps = []
+
+    def sleep(delay):
+        sleeps.append(delay)
+        now[0] += delay
+    rate_limiter = RateLimiter(100, sleep=sleep, clock=lambda: now[0])
+    for _ in range(5):
+        rate_limiter.consume(50)
+    assert sum(sleeps) == 2.5
+    # idle time isn't saved up for a burst
+    now[0] += 100
+    rate_limiter.consume(50)
+    rate_limiter.consume(50)
+    assert sum(sleeps) == 3.0
+
+
+def test_scrubber(tmpdir, write_manifest):
+    local_prefix = str(tmpdir.mkdir('data'))
+    manifest_fname = str(tmpdir.join('manifest.tsv'))
+    write_manifest(manifest_fname, local_prefix, {'a': b'AAAA', 'b': b'BBBB', 'c': b'CCCC'})
+    # corrupt one file without changing its size, and remove another
+    with open(os.path.join(local_prefix, 'a.txt'), 'wb') as ofp:
+        ofp.write(b'AAAB')
+    os.remove(os.path.join(local_prefix, 'c.txt'))
+
+    bad = []
+    checkpoint_fname = str(tmpdir.join('checkpoint.json'))
+    scrubber = Scrubber([(manifest_fname, local_prefix)], checkpoint_fname=checkpoint_fname,
+                        on_mismatch=lambda fname, record, error: bad.append((record.name, type(error))))
+    scrubber.run(num_passes=1)
+    assert bad == [('a', FileMismatchError), ('c', MissingFileError)]
+
+
+def test_scrubber_resumes(tmpdir, write_manifest):
+    local_prefix = str(tmpdir.mkdir('data'))
+    manifest_fname = str(tmpdir.join('manifest.tsv'))
+    write_manifest(manifest_fname, local_prefix, {'a': b'AAAA', 'b': b'BBBB', 'c': b'CCCC'})
+    checkpoint_fname = str(tmpdir.join('checkpoint.json'))
+
+    # stop the scrubber after it has verified the first file
+    class Stop(Exception):
+        pass
+    scrubbed = []
+    scrubber = Scrubber([(manifest_fname, local_prefix)], checkpoint_fname=checkpoint_fname)
+    scrub_record = scrubber._scrub_record
+
+    def stop_after_one(manifest_fname, local_prefix, record):
+        if scrubbed:
+            raise Stop()
+        scrubbed.append(record.name)
+        return scrub_record(manifest_fname, local_prefix, record)
+    scrubber._scrub_record = stop_after_one
+    try:
+        scrubber.run(num_passes=1)
+    except Stop:
+        pass
+
+    # a new scrubber picks up where the last one stopped
+    scrubber = Scrubber([(manifest_fname, local_prefix)], checkpoint_fname=checkpoint_fname)
+    scrub_record = scrubber._scrub_record
+    scrubber._scrub_record = lambda *args: scrubbed.append(args[2].name) or scrub_record(*args)
+    scrubber.run(num_passes=1)
+    assert scrubbed == ['a', 'b', 'c']
+
+    # the next pass starts from the beginning, and so does a pass over a changed manifest
+    write_manifest(manifest_fname, local_prefix, {'a': b'AAAA', 'b': b'BBBB', 'd': b'DDDD'})
+    scrubbed.clear()
+    scrubber.run(num_passes=1)
+    assert scrubbed == ['a', 'b', 'd']
+
+
+def test_scrubber_reports_unreadable_files(tmpdir, monkeypatch, write_manifest):
+    local_prefix = str(tmpdir.mkdir('data'))
+    manifest_fname = str(tmpdir.join('manifest.tsv'))
+    write_manifest(manifest_fname, local_prefix, {'a': b'AAAA', 'b': b'BBBB'})
+    missing_manifest_fname = str(tmpdir.join('missing.tsv'))
+
+    # reading 'a' fails like a bad sector would
+    iter_file_blocks = scrubber.iter_file_blocks
+
+    def failing_iter_file_blocks(fname, *args, **kwargs):
+        if fname.endswith('a.txt'):
+            raise OSError(errno.EIO, 'Input/output error', fname)
+        return iter_file_blocks(fname, *args, **kwargs)
+    monkeypatch.setattr(scrubber, 'iter_file_blocks', failing_iter_file_blocks)
+
+    bad = []
+    Scrubber(
+        [(missing_manifest_fname, local_prefix), (manifest_fname, local_prefix)],
+        on_mismatch=lambda fname, record, error: bad.append((fname, record and record.name, type(error)))
+    ).run(num_passes=1)
+    assert bad == [(missing_manifest_fname, None, FileNotFoundError), (manifest_fname, 'a', OSError)]
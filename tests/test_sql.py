@@ -0,0 +1,120 @@
+import io
+
+import pytest
+
+from freenome_build.sql import iter_sql_statements, execute_sql_script, SqlScriptError
+
+
+def _statements(sql):
+    return [
+        (stmt, copy_data.read() if copy_data is not None else None)
+        for stmt, copy_data in iter_sql_statements(io.StringIO(sql))
+    ]
+
+
+def test_split_simple_statements():
+    assert _statements("SELECT 1;\nSELECT 2;\n\nSELECT 3") == [
+        ('SELECT 1', None), ('SELECT 2', None), ('SELECT 3', None)]
+
+
+def test_split_respects_quotes_and_comments():
+    sql = (
+        "-- a comment; with a semicolon\n"
+        "CREATE TABLE \"a;b\" (x text); /* block ; /* nested ; */ */\n"
+        "INSERT INTO t VALUES ('it''s;', E'\\';');\n"
+        "CREATE FUNCTION f() RETURNS int AS $body$ SELECT 1; $body$ LANGUAGE sql;\n"
+    )
+    assert [stmt for stmt, _ in _statements(sql)] == [
+        'CREATE TABLE "a;b" (x text)',
+        "INSERT INTO t VALUES ('it''s;', E'\\';')",
+        'CREATE FUNCTION f() RETURNS int AS $body$ SELECT 1; $body$ LANGUAGE sql',
+    ]
+
+
+def test_split_copy_from_stdin():
+    sql = "COPY t (x) FROM stdin;\na;b\nc\n\\.\nSELECT 1;\n"
+    assert _statements(sql) == [('COPY t (x) FROM stdin', b'a;b\nc\n'), ('SELECT 1', None)]
+
+
+def test_split_skips_meta_commands():
+    assert _statements("\\set ON_ERROR_STOP 1\nSELECT 1;\n") == [('SELECT 1', None)]
+
+
+def test_split_unterminated_string():
+    with pytest.raises(SqlScriptError):
+        _statements("SELECT 'abc;\n")
+
+
+class FakeCursor():
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql):
+        self.conn.log.append(('execute', self.conn.autocommit, sql))
+
+    def copy_expert(self, sql, fp):
+        self.conn.log.append(('copy', self.conn.autocommit, sql, fp.read()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeConnection():
+    DatabaseError = Exception
+
+    def __init__(self):
+        self.autocommit = False
+        self.log = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.log.append(('commit',))
+
+    def rollback(self):
+        self.log.append(('rollback',))
+
+
+def test_execute_batches_statements_in_one_transaction():
+    conn = FakeConnection()
+    execute_sql_script(conn, "INSERT INTO t VALUES (1);\nINSERT INTO t VALUES (2);\nINSERT INTO t VALUES (3);",
+                       batch_size=2)
+    assert conn.log == [
+        ('execute', False, 'INSERT INTO t VALUES (1);\nINSERT INTO t VALUES (2)'),
+        ('execute', False, 'INSERT INTO t VALUES (3)'),
+        ('commit',),
+    ]
+
+
+def test_execute_non_transactional_statement():
+    conn = FakeConnection()
+    execute_sql_script(conn, "CREATE ROLE a;\nCREATE DATABASE a;\nGRANT ALL ON DATABASE a TO a;")
+    assert conn.log == [
+        ('execute', False, 'CREATE ROLE a'),
+        ('commit',),
+        ('execute', True, 'CREATE DATABASE a'),
+        ('execute', False, 'GRANT ALL ON DATABASE a TO a'),
+        ('commit',),
+    ]
+
+
+def test_execute_non_transactional_statement_after_a_transaction():
+    conn = FakeConnection()
+    execute_sql_script(conn, "BEGIN;\nINSERT INTO t VALUES (1);\nCOMMIT;\nCREATE DATABASE x;\nSELECT 1;")
+    assert conn.log == [
+        ('commit',),
+        ('execute', True, 'BEGIN;\nINSERT INTO t VALUES (1);\nCOMMIT'),
+        # not batched with its neighbours, which would run it in an implicit transaction
+        ('execute', True, 'CREATE DATABASE x'),
+        ('execute', True, 'SELECT 1'),
+    ]
+
+
+def test_execute_streams_copy_data():
+    conn = FakeConnection()
+    execute_sql_script(conn, "COPY t (x) FROM stdin;\n1\n2\n\\.\n")
+    assert conn.log == [('copy', False, 'COPY t (x) FROM stdin', b'1\n2\n'), ('commit',)]
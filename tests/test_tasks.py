@@ -0,0 +1,115 @@
+import asyncio
+import time
+
+import pytest
+
+from freenome_build.runner import CommandError
+from freenome_build.tasks import run_command_async, TaskGraph, TaskFailedError
+
+
+def test_run_command_async():
+    graph = TaskGraph()
+    graph.add('echo', "echo HELLO; echo WORLD 1>&2")
+    result = graph.run()['echo']
+    assert result.stdout == b'HELLO\n'
+    assert result.stderr == b'WORLD\n'
+
+
+def test_run_command_async_with_input():
+    graph = TaskGraph()
+
+    async def cat():
+        return await run_command_async('cat', input=b'a'*1000000)
+    graph.add('cat', cat)
+    assert graph.run()['cat'].stdout == b'a'*1000000
+
+
+@pytest.mark.timeout(5)
+def test_independent_tasks_run_concurrently():
+    graph = TaskGraph()
+    for i in range(4):
+        graph.add(f'sleep_{i}', "sleep 0.5")
+    start = time.monotonic()
+    graph.run()
+    assert time.monotonic() - start < 1.5
+
+
+def test_dependencies_run_in_order():
+    order = []
+    graph = TaskGraph()
+    graph.add('a', lambda: order.append('a'))
+    graph.add('b', "sleep 0.1", deps=['a'])
+    graph.add('c', lambda: order.append('c'), deps=['b'])
+    graph.add('d', lambda: order.append('d') or 'D', deps=['a'])
+    results = graph.run()
+    assert order.index('a') < order.index('c')
+    assert order.index('a') < order.index('d')
+    assert results['d'] == 'D'
+    assert list(graph.durations) != []
+
+
+def test_unknown_dependency():
+    graph = TaskGraph()
+    with pytest.raises(ValueError):
+        graph.add('a', "true", deps=['b'])
+
+
+@pytest.mark.timeout(5)
+def test_failure_cancels_other_tasks():
+    ran = []
+    graph = TaskGraph()
+    graph.add('slow', "sleep 30")
+    graph.add('fails', "echo BROKEN 1>&2; exit 1")
+    graph.add('dependent', lambda: ran.append('dependent'), deps=['fails'])
+    start = time.monotonic()
+    with pytest.raises(TaskFailedError) as excinfo:
+        graph.run()
+    assert time.monotonic() - start < 3
+    assert excinfo.value.task_name == 'fails'
+    assert isinstance(excinfo.value.__cause__, CommandError)
+    assert excinfo.value.__cause__.stderr == b'BROKEN\n'
+    assert ran == []
+
+
+def test_max_concurrency():
+    running = []
+    max_running = []
+
+    async def task():
+        running.append(1)
+        max_running.append(len(running))
+        await asyncio.sleep(0.05)
+        running.pop()
+    graph = TaskGraph(max_concurrency=2)
+    for i in range(6):
+        graph.add(f'task_{i}', task)
+    graph.run()
+    assert max(max_running) == 2
+
+
+def test_pool_limits():
+    running = {'build': [], 'upload': []}
+    max_running = {'build': 0, 'upload': 0}
+
+    def make_task(pool):
+        async def task():
+            running[pool].append(1)
+            max_running[pool] = max(max_running[pool], len(running[pool]))
+            await asyncio.sleep(0.05)
+            running[pool].pop()
+        return task
+    graph = TaskGraph(pool_limits={'build': 1, 'upload': 3})
+    for i in range(4):
+        graph.add(f'build_{i}', make_task('build'), pool='build')
+        graph.add(f'upload_{i}', make_task('upload'), deps=[f'build_{i}'], pool='upload')
+    graph.run()
+    assert max_running['build'] == 1
+
+    graph = TaskGraph(pool_limits={'build': 1, 'upload': 3})
+    for i in range(4):
+        graph.add(f'upload_{i}', make_task('upload'), pool='upload')
+    graph.run()
+    assert max_running['upload'] == 3
+
+    with pytest.raises(ValueError):
+        graph.add('test', "true", pool='test')
@@ -1,8 +1,12 @@
+import json
 import os
+import stat
 import subprocess
 
 import pytest
+import yaml
 
+from freenome_build import db
 from freenome_build.db import (
     start_local_database,
     start_k8s_database,
@@ -10,8 +14,12 @@ from freenome_build.db import (
     insert_test_data,
     reset_data,
     stop_local_database,
+    start_many_local_test_databases,
+    stop_many_local_databases,
     stop_k8s_database,
-    DbConnectionData
+    DbConnectionData,
+    _ephemeral_pod_config,
+    PGDATA_PATH
 )
 from freenome_build.util import run_and_log
 
@@ -74,6 +82,51 @@ def test_db_module_interface():
     stop_local_database(conn_data)
 
 
+def test_many_db_cli():
+    """Check that we can start, connect to, and stop several test dbs at once."""
+    conn_strings = None
+    try:
+        start_cmd = f"freenome-build db --path {DB_DIR} start-many 3"
+        conn_strings = json.loads(subprocess.check_output(start_cmd, shell=True).decode())
+        assert len(set(conn_strings)) == 3
+        for conn_string in conn_strings:
+            connect_cmd = f"psql {conn_string}"
+            stdout = subprocess.check_output(
+                connect_cmd, shell=True, input=b"SELECT * FROM test; \\q").decode().strip()
+            assert stdout == "test \n------\n test\n(1 row)"
+    finally:
+        if conn_strings is None:
+            return
+        stop_cmd = "freenome-build db stop-many -"
+        subprocess.run(stop_cmd, shell=True, check=True, input=json.dumps(conn_strings).encode())
+
+
+def test_many_db_module_interface():
+    conn_datas = start_many_local_test_databases(DB_DIR, 'freenome_build', 2)
+    stop_many_local_databases(conn_datas)
+
+
+def test_ephemeral_db_module_interface():
+    conn_data = start_local_database(DB_DIR, 'freenome_build', ephemeral=True)
+    try:
+        setup_db(conn_data, DB_DIR)
+        with conn_data.connection(user='postgres') as conn, conn.cursor() as cur:
+            cur.execute("SHOW fsync")
+            assert cur.fetchone() == ('off', )
+    finally:
+        stop_local_database(conn_data)
+
+
+def test_ephemeral_pod_config():
+    pod_config = yaml.safe_load(_ephemeral_pod_config(
+        os.path.join(os.path.dirname(__file__), "../freenome_build/database_template/db_pod_config.yaml")))
+    container = pod_config['spec']['containers'][0]
+    assert container['args'][0] == 'postgres'
+    assert 'fsync=off' in container['args']
+    assert container['volumeMounts'] == [{'name': 'ephemeral-pgdata', 'mountPath': PGDATA_PATH}]
+    assert pod_config['spec']['volumes'][0]['emptyDir'] == {'medium': 'Memory'}
+
+
 def _test_k8s_connection(testing_pod_id: str, conn_data: DbConnectionData):
     # Try connecting with our new connection. pg_isready doesn't take connection
     # strings so we need to take it apart a little.
@@ -144,3 +197,38 @@ def test_existing_db_container():
     # Stop the container and then try to create a container with the same port
     run_and_log(f"docker stop {conn_data.dbname}_{conn_data.port}")
     start_local_database("/not/a/valid/path", "db_test", dbname=conn_data.dbname, port=conn_data.port)
+
+
+# a fake docker client that records its arguments
+FAKE_DOCKER = """#!/bin/bash
+echo "$*" >> $FAKE_LOG
+"""
+
+
+def test_many_dbs_removes_containers_that_dont_come_up(tmpdir, monkeypatch):
+    bin_dir = tmpdir.mkdir('bin')
+    docker_path = str(bin_dir.join('docker'))
+    with open(docker_path, 'w') as ofp:
+        ofp.write(FAKE_DOCKER)
+    os.chmod(docker_path, os.stat(docker_path).st_mode | stat.S_IEXEC)
+    log_path = str(tmpdir.join('log'))
+    monkeypatch.setenv('PATH', f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setenv('FAKE_LOG', log_path)
+
+    ports = iter([5001, 5002])
+    monkeypatch.setattr(db, '_find_free_port', lambda: next(ports))
+
+    def wait_for_db_cluster_to_start(host, port, max_wait_time, log_cmd=None):
+        if port == 5002:
+            raise TimeoutError(f"port {port} didn't come up")
+    monkeypatch.setattr(db, '_wait_for_db_cluster_to_start', wait_for_db_cluster_to_start)
+
+    with pytest.raises(TimeoutError):
+        start_many_local_test_databases(DB_DIR, 'test_db', 2)
+    with open(log_path) as ifp:
+        cmds = ifp.read().splitlines()
+    # the container that came up is stopped, and the one that didn't is removed
+    assert 'kill test_db_5001' in cmds
+    assert 'rm -f test_db_5001' in cmds
+    assert 'rm -f test_db_5002' in cmds
+    assert 'kill test_db_5002' not in cmds
@@ -0,0 +1,66 @@
+import json
+import threading
+
+import pytest
+
+from freenome_build.tasks import TaskGraph
+from freenome_build.trace import disable_tracing, enable_tracing, get_tracer, span, traced
+
+
+@pytest.fixture
+def tracer():
+    yield enable_tracing()
+    disable_tracing()
+
+
+def _spans(tracer):
+    return {event['name']: event for event in tracer.events if event['ph'] == 'X'}
+
+
+def test_disabled_tracing_is_a_noop():
+    assert get_tracer() is None
+    with span('nothing'):
+        pass
+
+
+def test_nested_spans(tracer):
+    with span('outer', stage='test'):
+        with span('inner'):
+            pass
+    spans = _spans(tracer)
+    outer, inner = spans['outer'], spans['inner']
+    assert outer['args'] == {'stage': 'test'}
+    assert outer['tid'] == inner['tid'] == threading.get_ident()
+    assert outer['ts'] <= inner['ts']
+    assert inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur']
+
+
+def test_span_records_errors(tracer):
+    @traced('broken')
+    def broken():
+        raise ValueError("BROKEN")
+
+    with pytest.raises(ValueError):
+        broken()
+    assert _spans(tracer)['broken']['args'] == {'error': 'ValueError: BROKEN'}
+
+
+def test_task_graph_tasks_get_their_own_tracks(tracer):
+    graph = TaskGraph()
+    graph.add('a', "sleep 0.1")
+    graph.add('b', "sleep 0.1")
+    graph.run()
+    spans = _spans(tracer)
+    assert spans['a']['tid'] != spans['b']['tid']
+    track_names = {event['args']['name'] for event in tracer.events if event['ph'] == 'M'}
+    assert track_names == {'a', 'b'}
+
+
+def test_write_trace(tracer, tmpdir):
+    with span('step'):
+        pass
+    trace_path = str(tmpdir.join('trace.json'))
+    tracer.write(trace_path)
+    with open(trace_path) as ifp:
+        trace = json.load(ifp)
+    assert [event['name'] for event in trace['traceEvents']] == ['step']
@@ -0,0 +1,126 @@
+import json
+import os
+import stat
+
+import pytest
+
+from freenome_build.runner import CommandError
+from freenome_build.trace import disable_tracing, enable_tracing
+from freenome_build.upload import (
+    AnacondaChannel,
+    LocalChannel,
+    Uploader,
+    UploadError,
+    md5_checksum,
+    parse_package_filename
+)
+
+# a fake anaconda client that records its arguments, and fails if $FAKE_ANACONDA_FAIL is set
+FAKE_ANACONDA = """#!/bin/bash
+echo "$*" >> $FAKE_LOG
+[[ -z "$FAKE_ANACONDA_FAIL" ]]
+"""
+
+
+def _package(tmpdir, filename='pkg-1.0-py36_0.tar.bz2', contents=b'PACKAGE'):
+    subdir = tmpdir.join('conda-bld', 'linux-64')
+    subdir.ensure(dir=True)
+    package_path = str(subdir.join(filename))
+    with open(package_path, 'wb') as ofp:
+        ofp.write(contents)
+    return package_path
+
+
+class FlakyChannel(LocalChannel):
+    """A local channel whose uploads fail 'num_failures' times before they succeed."""
+    def __init__(self, path, num_failures):
+        super().__init__(path)
+        self.num_failures = num_failures
+        self.num_uploads = 0
+
+    def upload(self, package_path):
+        self.num_uploads += 1
+        if self.num_uploads <= self.num_failures:
+            raise ConnectionResetError("connection reset by peer")
+        super().upload(package_path)
+
+
+def test_parse_package_filename():
+    assert parse_package_filename('/tmp/linux-64/my-pkg-1.0.2-py36_0.tar.bz2') == ('my-pkg', '1.0.2', 'py36_0')
+
+
+def test_upload_skips_identical_packages(tmpdir):
+    channel = LocalChannel(str(tmpdir.join('channel')))
+    package_path = _package(tmpdir)
+    other_path = _package(tmpdir, 'other-1.0-0.tar.bz2', b'OTHER')
+    uploader = Uploader(channel)
+
+    report = uploader.upload_all([package_path, other_path, package_path])
+    assert report.uploaded == [package_path, other_path]
+    assert report.skipped == []
+    assert report.num_bytes == len(b'PACKAGE') + len(b'OTHER')
+    assert md5_checksum(os.path.join(channel.path, 'linux-64', 'pkg-1.0-py36_0.tar.bz2')) == md5_checksum(package_path)
+
+    report = uploader.upload_all([package_path, other_path])
+    assert report.uploaded == []
+    assert report.skipped == [package_path, other_path]
+
+    # a package with the same name and different contents replaces the channel's copy
+    package_path = _package(tmpdir, contents=b'CHANGED')
+    assert uploader.upload_all([package_path]).uploaded == [package_path]
+    with open(os.path.join(channel.path, 'linux-64', 'pkg-1.0-py36_0.tar.bz2'), 'rb') as ifp:
+        assert ifp.read() == b'CHANGED'
+
+
+def test_upload_retries(tmpdir):
+    channel = FlakyChannel(str(tmpdir.join('channel')), num_failures=2)
+    uploader = Uploader(channel, max_attempts=3, initial_delay=0.01)
+    package_path = _package(tmpdir)
+    assert uploader.upload_all([package_path]).uploaded == [package_path]
+    assert channel.num_uploads == 3
+
+
+def test_upload_gives_up(tmpdir):
+    channel = FlakyChannel(str(tmpdir.join('channel')), num_failures=5)
+    uploader = Uploader(channel, max_attempts=3, initial_delay=0.01)
+    package_path = _package(tmpdir)
+    with pytest.raises(UploadError):
+        uploader.upload_all([package_path])
+    assert channel.num_uploads == 3
+    assert channel.remote_checksum(package_path) is None
+
+
+@pytest.mark.parametrize('fail', [False, True])
+def test_anaconda_upload_keeps_the_token_out_of_traces(tmpdir, monkeypatch, fail):
+    bin_dir = tmpdir.mkdir('bin')
+    anaconda_path = str(bin_dir.join('anaconda'))
+    with open(anaconda_path, 'w') as ofp:
+        ofp.write(FAKE_ANACONDA)
+    os.chmod(anaconda_path, os.stat(anaconda_path).st_mode | stat.S_IEXEC)
+    log_path = str(tmpdir.join('log'))
+    monkeypatch.setenv('PATH', f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setenv('FAKE_LOG', log_path)
+    if fail:
+        monkeypatch.setenv('FAKE_ANACONDA_FAIL', '1')
+
+    tracer = enable_tracing()
+    try:
+        channel = AnacondaChannel('freenome', 'SECRET-TOKEN')
+        if fail:
+            with pytest.raises(CommandError):
+                channel.upload(_package(tmpdir))
+        else:
+            channel.upload(_package(tmpdir))
+    finally:
+        disable_tracing()
+    trace_path = str(tmpdir.join('trace.json'))
+    tracer.write(trace_path)
+
+    with open(trace_path) as ifp:
+        trace = ifp.read()
+    assert 'SECRET-TOKEN' not in trace
+    cmds = [event['args']['cmd'] for event in json.loads(trace)['traceEvents'] if 'cmd' in event.get('args', {})]
+    assert len(cmds) == 1 and cmds[0].startswith('anaconda')
+    # the client still gets the token
+    with open(log_path) as ifp:
+        assert ifp.read().startswith('-t SECRET-TOKEN upload --force -u freenome ')
@@ -1,5 +1,10 @@
-import pytest
+import subprocess
 import tempfile
+import time
+
+import pytest
+
+from freenome_build.runner import CommandError, CommandTimeoutError
 from freenome_build.util import run_and_log
 
 
@@ -28,3 +33,43 @@ def test_run_and_log_lots_of_data():
         ofp.write(b'a'*100000000)
         ofp.flush()
         run_and_log(f'cat {ofp.name}')
+
+
+@pytest.mark.timeout(5)
+def test_run_and_log_lots_of_stderr():
+    """ensure that we don't dead lock when the command fills the stderr pipe before writing to stdout"""
+    proc = run_and_log("head -c 10000000 /dev/zero 1>&2; echo DONE")
+    assert proc.stdout == b'DONE\n'
+
+
+@pytest.mark.timeout(5)
+def test_run_and_log_lots_of_input():
+    """ensure that we don't dead lock when the command writes output before it has read all of its input"""
+    data = b'a'*5000000
+    proc = run_and_log('cat', input=data, capture_limit=len(data))
+    assert proc.stdout == data
+
+
+def test_run_and_log_capture_is_bounded():
+    proc = run_and_log("seq 1 100000", capture_limit=100)
+    assert len(proc.stdout) == 100
+    assert proc.stdout.endswith(b'99999\n100000\n')
+
+
+def test_run_and_log_error():
+    with pytest.raises(CommandError) as excinfo:
+        run_and_log("echo FAILED 1>&2; exit 3")
+    assert isinstance(excinfo.value, RuntimeError)
+    assert isinstance(excinfo.value, subprocess.CalledProcessError)
+    assert excinfo.value.returncode == 3
+    assert excinfo.value.stderr == b'FAILED\n'
+
+
+@pytest.mark.timeout(5)
+def test_run_and_log_timeout_kills_process_group():
+    with tempfile.NamedTemporaryFile() as ofp:
+        with pytest.raises(CommandTimeoutError):
+            # the background sleep is in the same process group so it should be killed too
+            run_and_log(f"(sleep 1; echo STILL RUNNING > {ofp.name}) & sleep 10", timeout=0.2)
+        time.sleep(1.5)
+        assert ofp.read() == b''
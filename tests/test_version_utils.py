@@ -11,3 +11,68 @@ def test_get_version():
     # want to test something about the version string - just fix the test if we
     # release version 3.
     assert vsn[0] == '2'
+
+
+def _write(path, fname, contents):
+    with open(os.path.join(path, fname), 'w') as ofp:
+        ofp.write(contents)
+
+
+def test_get_version_from_setup_py_ast(tmpdir):
+    path = str(tmpdir)
+    _write(path, 'setup.py', "import setuptools\nsetuptools.setup(name='pkg', version='1.2.3')\n")
+    assert freenome_build.version_utils.get_version_from_setup_py_ast(path) == '1.2.3'
+
+    _write(path, 'setup.py', "from setuptools import setup\nVERSION = '1.2.4'\nsetup(name='pkg', version=VERSION)\n")
+    assert freenome_build.version_utils.get_version_from_setup_py_ast(path) == '1.2.4'
+
+    _write(path, 'setup.py', "from setuptools import setup\nsetup(name='pkg', version=open('VERSION').read())\n")
+    assert freenome_build.version_utils.get_version_from_setup_py_ast(path) is None
+
+
+def test_version_is_resolved_statically_and_memoized(tmpdir, monkeypatch):
+    path = str(tmpdir.mkdir('my-pkg'))
+    os.makedirs(os.path.join(path, 'my_pkg'))
+    _write(path, 'setup.py', "from setuptools import setup\nsetup(name='pkg', version=open('VERSION').read())\n")
+    _write(path, 'my_pkg/__init__.py', "__version__ = '0.1.0'\n")
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the version should be resolved without running a subprocess")
+    monkeypatch.setattr(freenome_build.version_utils.subprocess, 'check_output', fail)
+    monkeypatch.setattr(freenome_build.version_utils.github, 'repo_name', fail)
+    assert freenome_build.version_utils.version(path) == '0.1.0'
+
+    resolved = []
+    monkeypatch.setattr(freenome_build.version_utils, '_resolve_version',
+                        lambda path, repo_name, version_files: resolved.append(path) or '0.2.0')
+    assert freenome_build.version_utils.version(path) == '0.1.0'
+    assert resolved == []
+
+    # changing a version file invalidates the memoized version
+    _write(path, 'my_pkg/__init__.py', "__version__ = '0.2.0'\n")
+    os.utime(os.path.join(path, 'my_pkg/__init__.py'), ns=(0, 0))
+    assert freenome_build.version_utils.version(path) == '0.2.0'
+    assert resolved == [path]
+
+
+def test_version_doesnt_run_git_when_it_isnt_needed(tmpdir, monkeypatch):
+    # the directory isn't named after the package, eg a CI checkout
+    path = str(tmpdir.mkdir('checkout'))
+    _write(path, 'VERSION', "1.0.0\n")
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the repo name isn't needed to read the VERSION file")
+    monkeypatch.setattr(freenome_build.version_utils.github, 'repo_name', fail)
+    assert freenome_build.version_utils.version(path) == '1.0.0'
+    assert freenome_build.version_utils.version(path) == '1.0.0'
+
+    # the package's __init__.py is only found with the repo name from git, and then it's memoized
+    os.remove(os.path.join(path, 'VERSION'))
+    os.makedirs(os.path.join(path, 'pkg'))
+    _write(path, 'pkg/__init__.py', "__version__ = '2.0.0'\n")
+    repo_names = []
+    monkeypatch.setattr(freenome_build.version_utils.github, 'repo_name',
+                        lambda path: repo_names.append(path) or 'pkg')
+    assert freenome_build.version_utils.version(path) == '2.0.0'
+    assert freenome_build.version_utils.version(path) == '2.0.0'
+    assert repo_names == [path]